@@ -0,0 +1,76 @@
+"""
+The text extractor web_scraper shipped with before it grew parser choices,
+kept verbatim (html5lib tree, recursive walk) as the reference its output
+is compared against.
+"""
+
+import html5lib
+
+NOISE_PATTERNS = ['var ', 'function()', '.js', '.css', 'google-analytics', 'disqus', '{', '}']
+
+def parse_html(html_content):
+    """Parse HTML content and extract text with hyperlinks in markdown format."""
+    if not html_content:
+        return ""
+
+    document = html5lib.parse(html_content)
+    result = []
+    seen_texts = set()  # To avoid duplicates
+
+    def should_skip_element(elem) -> bool:
+        """Check if the element should be skipped."""
+        # Skip script and style tags
+        if elem.tag in ['{http://www.w3.org/1999/xhtml}script',
+                        '{http://www.w3.org/1999/xhtml}style']:
+            return True
+        # Skip empty elements or elements with only whitespace
+        if not any(text.strip() for text in elem.itertext()):
+            return True
+        return False
+
+    def process_element(elem, depth=0):
+        """Process an element and its children recursively."""
+        if should_skip_element(elem):
+            return
+
+        # Handle text content
+        if hasattr(elem, 'text') and elem.text:
+            text = elem.text.strip()
+            if text and text not in seen_texts:
+                # Check if this is an anchor tag
+                if elem.tag == '{http://www.w3.org/1999/xhtml}a':
+                    href = None
+                    for attr, value in elem.items():
+                        if attr.endswith('href'):
+                            href = value
+                            break
+                    if href and not href.startswith(('#', 'javascript:')):
+                        # Format as markdown link
+                        link_text = f"[{text}]({href})"
+                        result.append("  " * depth + link_text)
+                        seen_texts.add(text)
+                else:
+                    result.append("  " * depth + text)
+                    seen_texts.add(text)
+
+        # Process children
+        for child in elem:
+            process_element(child, depth + 1)
+
+        # Handle tail text
+        if hasattr(elem, 'tail') and elem.tail:
+            tail = elem.tail.strip()
+            if tail and tail not in seen_texts:
+                result.append("  " * depth + tail)
+                seen_texts.add(tail)
+
+    # Start processing from the body tag
+    body = document.find('.//{http://www.w3.org/1999/xhtml}body')
+    if body is not None:
+        process_element(body)
+    else:
+        # Fallback to processing the entire document
+        process_element(document)
+
+    # Filter out common unwanted patterns
+    return '\n'.join(line for line in result if not any(pattern in line.lower() for pattern in NOISE_PATTERNS))
@@ -0,0 +1,72 @@
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+TOOLS_DIR = Path(__file__).resolve().parent.parent / "tools"
+sys.path.insert(0, str(TOOLS_DIR))
+
+from llm_stub_server import FaultConfig, start_stub_server  # noqa: E402
+
+@pytest.fixture
+def stub():
+    """A stub LLM server on a free port; yields its StubState and base URL."""
+    server = start_stub_server(config=FaultConfig(stream_chunk_delay=0, batch_latency=0.2))
+    host, port = server.server_address
+    server.base_url = f"http://{host}:{port}"
+    server.state = server.RequestHandlerClass.state
+    yield server
+    server.shutdown()
+    server.server_close()
+
+class Site:
+    """Pages served by a local HTTP server: path -> (status, headers, body), plus a log of (time, path) requests."""
+
+    def __init__(self):
+        self.pages = {}
+        self.requests = []
+        self.delays = {}  # path -> seconds to wait before answering
+        self.base_url = None
+
+    def add(self, path, body, status=200, content_type="text/html; charset=utf-8", **headers):
+        if content_type is not None:
+            headers["Content-Type"] = content_type
+        self.pages[path] = (status, headers,
+                            body.encode("utf-8") if isinstance(body, str) else body)
+
+    def url(self, path):
+        return self.base_url + path
+
+    def paths(self):
+        return [path for _, path in self.requests]
+
+@pytest.fixture
+def site():
+    """A local HTTP server for web_scraper tests; pages not added are 404s."""
+    state = Site()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            state.requests.append((time.monotonic(), self.path))
+            time.sleep(state.delays.get(self.path, 0))
+            status, headers, body = state.pages.get(self.path, (404, {"Content-Type": "text/plain"}, b"not found"))
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name.replace("_", "-"), value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state.base_url = "http://127.0.0.1:%d" % server.server_address[1]
+    yield state
+    server.shutdown()
+    server.server_close()
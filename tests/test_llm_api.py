@@ -0,0 +1,578 @@
+import io
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import llm_api
+from llm_stub_server import FaultConfig, start_stub_server
+
+def test_client_pool_builds_one_client_per_endpoint_under_contention(stub):
+    pool = llm_api.ClientPool()
+    results = []
+    barrier = threading.Barrier(8)
+
+    def get():
+        barrier.wait()
+        results.append(pool.get("local", f"{stub.base_url}/v1"))
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    try:
+        assert len({id(client) for client in results}) == 1
+        (stats,) = pool.stats().values()
+        assert stats["reuses"] == 7
+    finally:
+        pool.close()
+
+def _stored_bytes(cache):
+    return cache._connect().execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+def test_response_cache_tracks_size_and_evicts_least_recently_used(tmp_path):
+    cache = llm_api.ResponseCache(str(tmp_path), max_bytes=1000)
+    for index in range(8):
+        cache.put(f"key{index}", "x" * 100)
+    cache.put("key0", "y" * 150)  # Replacing an entry adjusts the total by the difference
+    assert cache.stats()["bytes"] == _stored_bytes(cache) == 850
+    assert cache.get("key1") == "x" * 100
+
+    cache.put("key8", "z" * 300)
+    assert cache.stats()["bytes"] == _stored_bytes(cache) <= 900
+    # key2 was the least recently used entry; key1 was just read
+    assert cache.get("key2") is None
+    assert cache.get("key1") == "x" * 100
+
+def test_response_cache_expires_entries_and_counts_across_instances(tmp_path):
+    cache = llm_api.ResponseCache(str(tmp_path), ttl=60)
+    cache.put("old", "a" * 10)
+    cache._connect().execute("UPDATE responses SET created_at = created_at - 120 WHERE key = 'old'")
+    cache.put("new", "b" * 10)
+    assert cache.stats()["bytes"] == _stored_bytes(cache) == 10
+
+    # A second handle on the same directory, as another process would have
+    other = llm_api.ResponseCache(str(tmp_path), ttl=60)
+    assert other.get("new") == "b" * 10
+    assert other.get("old") is None
+    assert cache.stats()["total_hits"] == 1
+    assert cache.stats()["total_misses"] == 1
+
+def test_cli_opens_the_response_cache_only_for_cacheable_requests(local_stub, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(llm_api, "_response_caches", {})
+    options = ["--provider", "local", "--model", "stub", "--cache-dir", str(tmp_path)]
+    llm_api.main(["--prompt", "sampled", *options])
+    assert capsys.readouterr().out == "echo: sampled\n"
+    assert not (tmp_path / "responses.sqlite3").exists()
+
+    for _ in range(2):
+        llm_api.main(["--prompt", "greedy", "--temperature", "0", *options])
+    assert capsys.readouterr().out == "echo: greedy\n" * 2
+    assert (tmp_path / "responses.sqlite3").exists()
+    assert local_stub.state.counters["requests"] == 2
+
+def test_response_cache_rolls_back_failed_transactions(tmp_path):
+    cache = llm_api.ResponseCache(str(tmp_path))
+    cache.put("key", "value")
+    try:
+        with cache._transaction() as db:
+            db.execute("DELETE FROM responses")
+            raise RuntimeError("boom")
+    except RuntimeError:
+        pass
+    assert cache.get("key") == "value"
+
+FAST_RETRIES = llm_api.RetryPolicy(max_attempts=3, base_delay=0.01, jitter=False)
+
+@pytest.fixture
+def local_stub(stub, monkeypatch):
+    """The stub as the 'local' provider, with fresh circuit breakers."""
+    monkeypatch.setenv("LOCAL_LLM_BASE_URL", f"{stub.base_url}/v1")
+    monkeypatch.setattr(llm_api, "_circuit_breakers", {})
+    return stub
+
+def _request(prompt="hello", model="stub"):
+    return llm_api.LLMRequest(prompt, provider="local", model=model)
+
+def test_retries_retryable_errors_then_succeeds(local_stub):
+    local_stub.state.update({"fail_first": 2, "error_status": [503]})
+    policy = llm_api.ResiliencePolicy(retry=FAST_RETRIES)
+    response = llm_api._complete_resilient(_request(), policy=policy)
+    assert response.text == "echo: hello"
+    assert local_stub.state.counters["requests"] == 3
+
+def test_does_not_retry_client_errors(local_stub):
+    local_stub.state.update({"error_rate": 1.0, "error_status": [400]})
+    policy = llm_api.ResiliencePolicy(retry=FAST_RETRIES)
+    with pytest.raises(Exception) as error:
+        llm_api._complete_resilient(_request(), policy=policy)
+    assert llm_api._error_status(error.value) == 400
+    assert local_stub.state.counters["requests"] == 1
+
+def test_circuit_breaker_fails_fast_and_recovers(local_stub):
+    breaker = llm_api._circuit_breakers["local"] = llm_api.CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+    policy = llm_api.ResiliencePolicy(retry=llm_api.RetryPolicy(max_attempts=1))
+    local_stub.state.update({"error_rate": 1.0, "error_status": [503]})
+    for _ in range(2):
+        with pytest.raises(Exception):
+            llm_api._complete_resilient(_request(), policy=policy)
+    with pytest.raises(llm_api.CircuitOpenError):
+        llm_api._complete_resilient(_request(), policy=policy)
+    assert local_stub.state.counters["requests"] == 2
+
+    time.sleep(0.25)
+    local_stub.state.update({"error_rate": 0.0})
+    assert llm_api._complete_resilient(_request(), policy=policy).text == "echo: hello"
+    assert breaker.state == "closed"
+
+def test_non_retryable_error_during_trial_does_not_wedge_the_breaker(local_stub):
+    breaker = llm_api._circuit_breakers["local"] = llm_api.CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    policy = llm_api.ResiliencePolicy(retry=llm_api.RetryPolicy(max_attempts=1))
+    local_stub.state.update({"error_rate": 1.0, "error_status": [503]})
+    with pytest.raises(Exception):
+        llm_api._complete_resilient(_request(), policy=policy)
+    assert breaker.state == "open"
+
+    time.sleep(0.15)
+    # The half-open trial gets a 400: the provider is up, the request was bad
+    local_stub.state.update({"error_status": [400]})
+    with pytest.raises(Exception) as error:
+        llm_api._complete_resilient(_request(), policy=policy)
+    assert not isinstance(error.value, llm_api.CircuitOpenError)
+
+    local_stub.state.update({"error_rate": 0.0})
+    assert llm_api._complete_resilient(_request(), policy=policy).text == "echo: hello"
+    results = llm_api.query_llm_batch_sync(["a", "b"], provider="local", model="stub", resilience=policy)
+    assert [result.response for result in results] == ["echo: a", "echo: b"]
+
+def test_interrupted_trial_frees_the_breaker(local_stub):
+    breaker = llm_api.CircuitBreaker(failure_threshold=1, reset_timeout=0.0)
+    llm_api._circuit_breakers["local"] = breaker
+    breaker.record_failure()
+
+    class Interrupted(BaseException):
+        pass
+
+    class InterruptingClient:
+        class chat:
+            class completions:
+                @staticmethod
+                def create(**kwargs):
+                    raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        llm_api._complete_with_retries(_request(), InterruptingClient(), llm_api.DEFAULT_RESILIENCE)
+    assert llm_api._complete_resilient(_request()).text == "echo: hello"
+
+def test_hedge_answers_when_the_primary_is_slow(stub, local_stub):
+    slow = start_stub_server(config=FaultConfig(latency=2.0))
+    try:
+        slow_client = llm_api.create_llm_client("local", f"http://127.0.0.1:{slow.server_address[1]}/v1", max_retries=0)
+        policy = llm_api.ResiliencePolicy(retry=FAST_RETRIES, hedge=("local", "hedge-model"), hedge_after=0.1)
+        started = time.monotonic()
+        response = llm_api._complete_resilient(_request(), slow_client, policy)
+        assert response.text == "echo: hello"
+        assert time.monotonic() - started < 1.5
+        assert local_stub.state.counters["requests"] == 1
+    finally:
+        slow.shutdown()
+        slow.server_close()
+
+def test_hedged_request_is_reported_apart_from_retries(stub, local_stub):
+    slow = start_stub_server(config=FaultConfig(latency=1.0))
+    calls = []
+    sink = llm_api.add_metrics_sink(type("Sink", (), {"emit": staticmethod(calls.append)})())
+    try:
+        # A pooled client, so both legs' HTTP requests are seen by the transport hooks
+        slow_client = llm_api.get_llm_client("local", f"http://127.0.0.1:{slow.server_address[1]}/v1")
+        policy = llm_api.ResiliencePolicy(retry=FAST_RETRIES, hedge=("local", "hedge-model"), hedge_after=0.1)
+        response = llm_api.query_llm_response("hello", client=slow_client, provider="local", model="stub",
+                                              resilience=policy)
+        assert response.text == "echo: hello"
+        (metrics,) = calls
+        assert metrics.hedged is True
+        assert metrics.retries == 0
+    finally:
+        llm_api.remove_metrics_sink(sink)
+        slow.shutdown()
+        slow.server_close()
+
+def test_falls_back_when_the_primary_keeps_failing(local_stub):
+    failing = start_stub_server(config=FaultConfig(error_rate=1.0, error_status=(503,)))
+    try:
+        failing_client = llm_api.create_llm_client("local", f"http://127.0.0.1:{failing.server_address[1]}/v1", max_retries=0)
+        policy = llm_api.ResiliencePolicy(retry=FAST_RETRIES, fallbacks=(("local", "fallback-model"),))
+        response = llm_api._complete_resilient(_request(), failing_client, policy)
+        assert response.text == "echo: hello"
+        assert failing.RequestHandlerClass.state.counters["requests"] == 3
+        assert local_stub.state.counters["requests"] == 1
+    finally:
+        failing.shutdown()
+        failing.server_close()
+
+def test_batch_job_resumes_after_interruption(local_stub, tmp_path):
+    # OpenAI batches carry whole-second creation times, so the stub may count up to a second already passed
+    local_stub.state.update({"batch_latency": 2.5})
+    prompts = [{"id": f"item{index}", "prompt": f"question {index}"} for index in range(5)]
+    options = dict(provider="local", model="stub", job_dir=str(tmp_path), poll_interval=0.05, max_poll_interval=0.1)
+
+    with pytest.raises(TimeoutError):
+        llm_api.run_batch_job(prompts, timeout=0.2, **options)
+    (state_file,) = tmp_path.glob("*.json")
+    assert len(json.loads(state_file.read_text())["batches"]) == 1
+
+    # Running it again picks up the submitted batch instead of submitting a new one
+    results = llm_api.run_batch_job(prompts, **options)
+    assert [result.id for result in results] == [prompt["id"] for prompt in prompts]
+    assert [result.response for result in results] == [f"echo: question {index}" for index in range(5)]
+    assert len(local_stub.state.batches) == 1
+
+    # A completed job is answered from disk
+    requests_so_far = local_stub.state.counters["requests"]
+    local_stub.shutdown()
+    assert [result.response for result in llm_api.run_batch_job(prompts, **options)] == [result.response for result in results]
+    assert local_stub.state.counters["requests"] == requests_so_far
+
+def test_semantic_cache_answers_near_duplicate_prompts(local_stub, tmp_path):
+    cache = llm_api.SemanticCache(str(tmp_path), threshold=0.9)
+    options = dict(provider="local", model="stub", temperature=0, semantic_cache=cache)
+
+    first = llm_api.query_llm("What is the capital of France?", **options)
+    assert first == "echo: What is the capital of France?"
+    assert llm_api.query_llm("what is the capital of  France", **options) == first
+    assert local_stub.state.counters["requests"] == 1
+
+    # A different system prompt or an unrelated question is a miss
+    assert llm_api.query_llm("What is the capital of France?", system="Answer in French.", **options) == first
+    assert llm_api.query_llm("How tall is Mont Blanc?", **options) == "echo: How tall is Mont Blanc?"
+    assert local_stub.state.counters["requests"] == 3
+    assert cache.stats()["hits"] == 1
+
+def test_semantic_cache_reuses_the_least_recently_used_slot(tmp_path):
+    cache = llm_api.SemanticCache(str(tmp_path), max_entries=2)
+    for prompt in ("first prompt here", "second prompt here", "third prompt here"):
+        cache.put(llm_api.LLMRequest(prompt, provider="local", model="stub"), prompt.upper())
+    assert cache.stats()["entries"] == 2
+    assert cache.get(llm_api.LLMRequest("first prompt here", provider="local", model="stub")) is None
+    response, similarity = cache.get(llm_api.LLMRequest("third prompt here", provider="local", model="stub"))
+    assert response == "THIRD PROMPT HERE"
+    assert similarity > 0.99
+
+    # Reopening the index keeps the stored vectors
+    reopened = llm_api.SemanticCache(str(tmp_path), max_entries=2)
+    assert reopened.get(llm_api.LLMRequest("second prompt here", provider="local", model="stub"))[0] == "SECOND PROMPT HERE"
+
+def test_semantic_cache_put_finds_slots_without_scanning_entries(tmp_path):
+    cache = llm_api.SemanticCache(str(tmp_path), max_entries=50, ttl=60)
+    for index in range(50):
+        cache.put(llm_api.LLMRequest(f"prompt number {index}", provider="local", model="stub"), str(index))
+    db = cache._connect()
+    db.execute("UPDATE entries SET created_at = created_at - 120 WHERE slot = 7")
+
+    statements = []
+    db.set_trace_callback(statements.append)
+    try:
+        cache.put(llm_api.LLMRequest("a fresh prompt", provider="local", model="stub"), "fresh")
+    finally:
+        db.set_trace_callback(None)
+    # The expired entry's slot is the one reused, not the least recently used one
+    assert db.execute("SELECT response FROM entries WHERE slot = 7").fetchone()[0] == "fresh"
+    assert cache.stats()["entries"] == 50
+    for statement in statements:
+        if statement.startswith(("SELECT", "DELETE", "INSERT OR IGNORE")):
+            plan = " ".join(row[-1] for row in db.execute("EXPLAIN QUERY PLAN " + statement.replace("?", "0")))
+            assert "SCAN entries" not in plan or "USING" in plan, (statement, plan)
+
+def _serve_in_background(**options):
+    thread = threading.Thread(target=llm_api.serve_daemon, kwargs=dict(idle_timeout=1.0, **options), daemon=True)
+    thread.start()
+    path = options.get("socket_path") or llm_api.default_socket_path()
+    deadline = time.monotonic() + 5
+    while not llm_api._daemon_running(path):
+        assert time.monotonic() < deadline, "daemon did not start"
+        time.sleep(0.02)
+    return thread
+
+def test_daemon_socket_is_private_to_its_user(tmp_path, monkeypatch, capsys):
+    import llm_client
+    monkeypatch.delenv("LLM_API_SOCKET", raising=False)
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    path = llm_api.default_socket_path()
+    assert path == llm_client.default_socket_path() == str(tmp_path / "llm_api" / "llm_api.sock")
+
+    thread = _serve_in_background()
+    try:
+        assert (tmp_path / "llm_api").stat().st_mode & 0o777 == 0o700
+        assert (tmp_path / "llm_api" / "llm_api.sock").stat().st_mode & 0o077 == 0
+        assert llm_client.run_via_daemon(["--help"]) == 0
+        assert "Query an LLM" in capsys.readouterr().out
+
+        # A socket or a listener belonging to someone else is never sent the command line
+        monkeypatch.setattr(llm_client, "_peer_uid", lambda sock: os.getuid() + 1)
+        assert llm_client.run_via_daemon(["--help"]) is None
+        monkeypatch.setattr(llm_client.os, "getuid", lambda: os.stat(path).st_uid + 1)
+        assert llm_client.run_via_daemon(["--help"]) is None
+        assert "not a socket owned by this user" in capsys.readouterr().err
+    finally:
+        thread.join(timeout=10)
+
+def test_daemon_refuses_a_shared_socket_directory(tmp_path, monkeypatch):
+    monkeypatch.delenv("LLM_API_SOCKET", raising=False)
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    (tmp_path / "llm_api").mkdir(mode=0o777)
+    os.chmod(tmp_path / "llm_api", 0o777)
+    with pytest.raises(ValueError, match="mode 0700"):
+        llm_api.serve_daemon()
+
+def test_batch_runs_concurrently_and_returns_input_order(local_stub):
+    local_stub.state.update({"latency": 0.3})
+    prompts = [{"id": f"item{index}", "prompt": f"question {index}"} for index in range(6)]
+    prompts.insert(2, {"id": "broken", "prompt": "question", "provider": "nope"})
+    llm_api.get_llm_client("local")  # Importing the SDK is not part of the batch
+    started = time.monotonic()
+    results = llm_api.query_llm_batch_sync(prompts, provider="local", model="stub", max_concurrency=3)
+    elapsed = time.monotonic() - started
+    # Six stub requests, three at a time
+    assert 0.55 < elapsed < 1.5
+    assert [result.id for result in results] == [prompt["id"] for prompt in prompts]
+    assert [result.response for result in results if result.ok] == [f"echo: question {index}" for index in range(6)]
+    assert results[2].error_type == "ValueError" and results[2].response is None
+    assert all(result.usage["input_tokens"] for result in results if result.ok)
+
+def test_rate_limiter_paces_requests_beyond_the_minute_allowance():
+    import asyncio
+
+    async def run():
+        limiter = llm_api.RateLimiter(tokens_per_minute=6000)
+        await limiter.acquire(6000)  # The full bucket is available at once
+        started = time.monotonic()
+        await limiter.acquire(50)  # Then 100 tokens refill per second
+        return time.monotonic() - started
+
+    assert 0.4 < asyncio.run(run()) < 1.0
+
+def test_cli_streams_batch_results_as_jsonl(local_stub, tmp_path, capsys):
+    prompts_file = tmp_path / "prompts.jsonl"
+    prompts_file.write_text('{"id": "a", "prompt": "first"}\n\n"second"\n')
+    with pytest.raises(SystemExit) as exit:
+        llm_api.main(["--prompts-file", str(prompts_file), "--provider", "local", "--model", "stub", "--no-cache"])
+    assert exit.value.code == 0
+    records = sorted((json.loads(line) for line in capsys.readouterr().out.splitlines()), key=lambda record: record["index"])
+    assert [(record["id"], record["response"]) for record in records] == [("a", "echo: first"), (None, "echo: second")]
+
+@pytest.mark.parametrize("provider, path, reports_usage", [
+    ("local", "/v1", False),
+    ("openai", "/v1", True),  # Asks for usage in the final chunk
+    ("anthropic", "", True),
+])
+def test_stream_yields_deltas_as_they_arrive(stub, monkeypatch, provider, path, reports_usage):
+    monkeypatch.setenv("OPENAI_API_KEY", "stub")
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "stub")
+    stub.state.update({"stream_chunk_delay": 0.1})
+    client = llm_api.create_llm_client(provider, f"{stub.base_url}{path}", max_retries=0)
+    stats = llm_api.StreamStats()
+    arrivals = []
+    for delta in llm_api.query_llm_stream("one two three four", client=client, provider=provider, model="stub", stats=stats):
+        arrivals.append((time.monotonic(), delta))
+    assert "".join(delta for _, delta in arrivals).strip() == "echo: one two three four"
+    assert len(arrivals) == 5
+    # Text is handed over as it is generated, not all at the end
+    assert arrivals[-1][0] - arrivals[0][0] > 0.3
+    assert stats.time_to_first_token < stats.finished_at - stats.started_at - 0.3
+    assert stats.chunks == 5 and stats.output_tokens > 0 and stats.tokens_per_second > 0
+    assert (stats.input_tokens > 0) == reports_usage
+
+def test_async_stream_and_cli_stream(local_stub, capsys):
+    import asyncio
+
+    async def collect():
+        return [delta async for delta in llm_api.aquery_llm_stream("async hello", provider="local", model="stub")]
+
+    assert "".join(asyncio.run(collect())).strip() == "echo: async hello"
+
+    llm_api.main(["--prompt", "streamed", "--provider", "local", "--model", "stub", "--stream"])
+    captured = capsys.readouterr()
+    assert captured.out.strip() == "echo: streamed"
+    assert "time to first token" in captured.err
+
+def _save_image(path, mode, size):
+    from PIL import Image
+    image = Image.effect_noise(size, 40)  # Detail that PNG cannot squeeze, unlike a flat test card
+    if mode == "P":
+        image = image.convert("RGB").quantize(64)
+    elif mode != "L":
+        image = image.convert(mode)
+    image.save(path)
+    return path
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "P", "LA"])
+def test_image_payload_is_downscaled_and_recompressed(tmp_path, mode):
+    from PIL import Image
+    path = _save_image(tmp_path / f"shot-{mode}.png", mode, (2000, 800))
+    payload = llm_api.prepare_image_payload(str(path), llm_api.ImageOptions.for_provider("anthropic"))
+    assert payload.mime_type == "image/jpeg"
+    assert payload.dimensions == (1568, 627)
+    assert payload.original_bytes == path.stat().st_size
+    assert payload.bytes_saved == payload.original_bytes - len(payload.content) > 0
+    with Image.open(io.BytesIO(payload.content)) as uploaded:
+        assert uploaded.format == "JPEG" and uploaded.size == (1568, 627) and uploaded.mode in ("RGB", "L")
+
+def test_image_payload_keeps_the_original_when_recompression_does_not_help(tmp_path):
+    from PIL import Image
+    path = tmp_path / "icon.png"
+    Image.new("P", (16, 16)).save(path)  # A flat PNG is smaller than any JPEG of it
+    payload = llm_api.prepare_image_payload(str(path), llm_api.ImageOptions(format="jpeg"))
+    assert payload.mime_type == "image/png" and payload.content == path.read_bytes()
+    assert payload.dimensions == (16, 16) and payload.bytes_saved == 0
+
+def test_image_payload_is_memoized_until_the_file_changes(tmp_path):
+    path = _save_image(tmp_path / "shot.png", "RGB", (400, 300))
+    options = llm_api.ImageOptions(max_dimension=200, format="webp")
+    first = llm_api.prepare_image_payload(str(path), options)
+    assert llm_api.prepare_image_payload(str(path), options) is first
+    assert first.mime_type == "image/webp" and first.dimensions == (200, 150)
+    assert llm_api.encode_image_file(str(path), options) == (first.data, "image/webp")
+
+    _save_image(path, "RGB", (800, 300))
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+    assert llm_api.prepare_image_payload(str(path), options).dimensions == (200, 75)
+
+class FakeGemini:
+    """Stands in for the google.generativeai module: records uploads and generate_content calls."""
+
+    def __init__(self, expires_in=48 * 3600):
+        self.expires_in = expires_in
+        self.uploads = []
+        self.calls = []
+
+    def upload_file(self, file, mime_type):
+        import datetime
+        self.uploads.append((file.read(), mime_type))
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.expires_in)
+        return type("File", (), {"name": f"files/{len(self.uploads)}", "expiration_time": expiration})()
+
+    def GenerativeModel(self, model, system_instruction=None):
+        gemini = self
+
+        class Model:
+            def generate_content(self, contents, generation_config=None):
+                gemini.calls.append({"model": model, "system": system_instruction, "contents": contents,
+                                     "config": generation_config})
+                usage = type("Usage", (), {"prompt_token_count": 12, "candidates_token_count": 3,
+                                           "cached_content_token_count": 0})()
+                return type("Response", (), {"text": "fake answer", "usage_metadata": usage})()
+
+        return Model()
+
+def test_gemini_sends_the_prompt_once_and_reuses_uploads(tmp_path, monkeypatch):
+    monkeypatch.setattr(llm_api, "_gemini_files", {})
+    image = _save_image(tmp_path / "shot.jpg", "RGB", (64, 64))
+    gemini = FakeGemini()
+    options = dict(client=gemini, provider="gemini", model="gemini-2.0-flash", image_path=str(image))
+    for question in ("What is shown?", "What colour is it?"):
+        response = llm_api.query_llm_response(question, **options)
+        assert response.text == "fake answer"
+        assert response.usage["input_tokens"] == 12 and response.usage["output_tokens"] == 3
+
+    first, second = gemini.calls
+    assert first["contents"][1:] == ["What is shown?"] and second["contents"][1:] == ["What colour is it?"]
+    assert first["contents"][0] is second["contents"][0]
+    assert gemini.uploads == [(image.read_bytes(), "image/jpeg")]
+
+    history = [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}]
+    llm_api.query_llm_response("And now?", client=gemini, provider="gemini", model="gemini-2.0-flash",
+                               system="Be brief.", history=history)
+    call = gemini.calls[-1]
+    assert call["system"] == "Be brief."
+    assert call["contents"] == [{"role": "user", "parts": ["Hi"]}, {"role": "model", "parts": ["Hello"]},
+                                {"role": "user", "parts": ["And now?"]}]
+
+def test_gemini_uploads_again_once_the_file_is_about_to_expire(tmp_path, monkeypatch):
+    monkeypatch.setattr(llm_api, "_gemini_files", {})
+    image = _save_image(tmp_path / "shot.png", "RGB", (64, 64))
+    gemini = FakeGemini(expires_in=60)
+    for _ in range(2):
+        llm_api.query_llm_response("What is shown?", client=gemini, provider="gemini", model="gemini-2.0-flash",
+                                   image_path=str(image))
+    assert [mime_type for _, mime_type in gemini.uploads] == ["image/png", "image/png"]
+
+def test_metrics_sinks_record_every_call(local_stub, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(llm_api, "_metrics_sinks", [])
+    jsonl_path, prometheus_path = tmp_path / "metrics.jsonl", tmp_path / "llm.prom"
+    llm_api.add_metrics_sink(llm_api.JsonlMetricsSink(str(jsonl_path)))
+    llm_api.add_metrics_sink(llm_api.PrometheusTextfileSink(str(prometheus_path)))
+    cache = llm_api.ResponseCache(str(tmp_path / "cache"))
+    options = dict(provider="local", model="stub", temperature=0, cache=cache, resilience=llm_api.ResiliencePolicy(retry=FAST_RETRIES))
+
+    local_stub.state.update({"fail_first": 1, "error_status": [503]})
+    assert llm_api.query_llm("first", **options) == "echo: first"
+    assert llm_api.query_llm("first", **options) == "echo: first"  # From the cache
+    local_stub.state.update({"error_rate": 1.0, "error_status": [400]})
+    assert llm_api.query_llm("second", **options) is None
+
+    retried, hit, failed = [json.loads(line) for line in jsonl_path.read_text().splitlines()]
+    assert retried["retries"] == 1 and retried["input_tokens"] > 0 and retried["payload_bytes"] > 0
+    assert retried["time_to_first_byte"] <= retried["latency"] and retried["cost_usd"] == 0.0
+    assert hit["cache_hit"] and hit["retries"] == 0 and hit["payload_bytes"] is None
+    assert failed["error"] == "BadRequestError"
+
+    prometheus = prometheus_path.read_text()
+    labels = 'provider="local",model="stub"'
+    for line in (f"llm_requests_total{{{labels}}} 3", f"llm_errors_total{{{labels}}} 1",
+                 f"llm_cache_hits_total{{{labels}}} 1", f"llm_retries_total{{{labels}}} 1",
+                 f'llm_request_latency_seconds_bucket{{{labels},le="+Inf"}} 3'):
+        assert line in prometheus.splitlines()
+
+    summary = llm_api.summarize_metrics([str(jsonl_path)])[("local", "stub")]
+    assert (summary["calls"], summary["errors"], summary["cache_hits"]) == (3, 1, 1)
+    assert summary["p50"] <= summary["p95"] <= summary["p99"]
+    llm_api.main(["--stats", "--metrics-file", str(jsonl_path)])
+    table = capsys.readouterr().out.splitlines()
+    assert table[0].split()[:5] == ["provider", "model", "calls", "errors", "hits"]
+    assert table[1].split()[:5] == ["local", "stub", "3", "1", "1"]
+
+SYSTEM = "You are a careful assistant. " * 40
+HISTORY = ({"role": "user", "content": "Here is a long document. " * 40}, {"role": "assistant", "content": "Noted."})
+
+def test_messages_are_split_into_system_history_and_prompt(local_stub):
+    messages = [{"role": "system", "content": "Be brief."}, {"role": "system", "content": "Use French."},
+                *HISTORY, {"role": "user", "content": "Summarise it."}]
+    assert llm_api.split_messages(messages) == ("Be brief.\n\nUse French.", HISTORY, "Summarise it.")
+    assert llm_api.query_llm_messages(messages, provider="local", model="stub") == "echo: Summarise it."
+    with pytest.raises(ValueError):
+        llm_api.split_messages([{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}])
+
+    request = llm_api._openai_request(llm_api.LLMRequest("Summarise it.", "local", "stub", system="Be brief.", history=HISTORY))
+    # Stable parts first, so providers with automatic prefix caching can reuse them
+    assert [message["role"] for message in request["messages"]] == ["system", "user", "assistant", "user"]
+
+def test_openai_compatible_prefix_is_reported_as_cached(local_stub):
+    options = dict(provider="local", model="stub", system=SYSTEM, history=HISTORY)
+    first = llm_api.query_llm_response("First question?", **options)
+    second = llm_api.query_llm_response("Second question?", **options)
+    assert first.usage["cached_tokens"] == 0
+    assert 0 < second.usage["cached_tokens"] < second.usage["input_tokens"]
+
+def test_anthropic_prompt_caching_breakpoints(stub, monkeypatch):
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "stub")
+    client = llm_api.create_llm_client("anthropic", stub.base_url, max_retries=0)
+    options = dict(client=client, provider="anthropic", model="stub", system=SYSTEM, history=HISTORY)
+
+    request = llm_api._anthropic_request(llm_api.LLMRequest("Question?", "anthropic", "stub",
+                                                            system=SYSTEM, history=HISTORY))
+    assert request["system"][-1]["cache_control"] == llm_api.ANTHROPIC_CACHE_CONTROL
+    assert request["messages"][1]["content"][-1]["cache_control"] == llm_api.ANTHROPIC_CACHE_CONTROL
+    assert "cache_control" not in request["messages"][-1]["content"][-1]
+
+    first = llm_api.query_llm_response("First question?", **options)
+    second = llm_api.query_llm_response("Second question?", **options)
+    assert first.usage["cache_write_tokens"] > 0 and first.usage["cached_tokens"] == 0
+    assert second.usage["cached_tokens"] == first.usage["cache_write_tokens"] and second.usage["cache_write_tokens"] == 0
+    # input_tokens counts the whole prompt, cached part included
+    assert second.usage["input_tokens"] > second.usage["cached_tokens"]
+
+    uncached = llm_api.query_llm_response("Third question?", prompt_caching=False, **options)
+    assert uncached.usage["cached_tokens"] == uncached.usage["cache_write_tokens"] == 0
@@ -0,0 +1,955 @@
+import asyncio
+import codecs
+import logging
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+import baseline_extractor
+import web_scraper
+
+PAGES = sorted((Path(__file__).parent / "data" / "pages").glob("*.html"))
+
+# Fragments every parser extracts as the baseline does
+FRAGMENTS = [
+    "<html><body><p>Hello <b>world</b> tail</p><p>x<br>after br</p><!-- c -->ctail<div><script>var x=1</script>"
+    "stail<a href='/x'>link</a> t2 <a>nohref</a><a href='#f'>frag</a></div><p>Hello</p></body></html>",
+    "<div><span> </span>tail of empty</div><div><img src=a>img tail</div>",
+    "<p><!--only comment-->text after comment</p><p><style>.a{}</style></p>",
+    "<table><tr><td>a<td>b</table><ul><li>one<li>two<li>one</ul>",
+    "<table><caption>cap</caption><td>cell</td><tr><th>head</th></tr><tfoot><td>foot</td></table>",
+    "<table><tbody><td>x<td>y<tr><td>z</tbody><td>w</table>",
+    "<table><tr><td>a</td></tr><select><option>o</option></select><tr><td>b</td></tr></table>",
+    "<div>before<table>stray<td>c</td>tail</table>after</div>",
+    "<body><p>a</p></body><p>after body</p>",
+    "<body><p>a</p></body>tail text<!--c-->",
+    "<body><p>a</p></body><!--c--><p>x</p>",
+    "<p>function() ok</p><p>Some .JS file</p><a xlink:href='y'>sv</a>",
+    "<div><div><div></div>deep tail</div></div><p><span><script>x</script></span>after span</p>",
+    "<p><?pi x?>pi tail</p><svg><text>svg text</text></svg>",
+]
+
+# Where lxml's own tree building still differs from HTML5's: (fragment, lxml's text)
+LXML_DIVERGENCES = [
+    # Content after </html> starts a new document that lxml drops
+    ("<html><body><p>a</p></body></html><p>after html</p>", "  a"),
+    # Misnested formatting elements are closed where they end rather than reopened
+    ("<p><b>x<i>y</b>z</i>w</p>", "    x\n      y\n    zw"),
+]
+
+def incremental_text(html: str) -> str:
+    """parse_page's text when the document goes through extract_lines_incremental."""
+    lines = web_scraper.extract_lines_incremental([html[start:start + 4096] for start in range(0, len(html), 4096)])
+    return "\n".join(line for line in lines if not web_scraper._NOISE.search(line.lower()))
+
+@pytest.mark.parametrize("parser", web_scraper.PARSERS)
+@pytest.mark.parametrize("page", PAGES, ids=lambda path: path.stem)
+def test_recorded_pages_match_baseline(page, parser):
+    html = page.read_text(encoding="utf-8")
+    expected = baseline_extractor.parse_html(html)
+    assert expected
+    assert web_scraper.parse_html(html, parser=parser) == expected
+
+@pytest.mark.parametrize("page", PAGES, ids=lambda path: path.stem)
+def test_recorded_pages_match_baseline_incrementally(page):
+    html = page.read_text(encoding="utf-8")
+    assert incremental_text(html) == baseline_extractor.parse_html(html)
+
+@pytest.mark.parametrize("parser", web_scraper.PARSERS)
+@pytest.mark.parametrize("fragment", FRAGMENTS)
+def test_fragments_match_baseline(fragment, parser):
+    assert web_scraper.parse_html(fragment, parser=parser) == baseline_extractor.parse_html(fragment)
+
+@pytest.mark.parametrize("fragment, lxml_text", LXML_DIVERGENCES)
+def test_known_lxml_divergences(fragment, lxml_text):
+    assert web_scraper.parse_html(fragment, parser="lxml") == lxml_text
+    assert incremental_text(fragment) == lxml_text
+    assert web_scraper.parse_html(fragment, parser="selectolax") == baseline_extractor.parse_html(fragment)
+    assert baseline_extractor.parse_html(fragment) != lxml_text
+
+def test_incremental_keeps_fostered_content_in_place():
+    fragment = "<table><tr><td>a</td></tr><select><option>o</option></select><tr><td>b</td></tr></table>"
+    assert web_scraper.parse_html(fragment, parser="lxml") == "    o\n        a\n        b"
+    assert incremental_text(fragment) == "        a\n    o\n        b"
+
+def test_large_page_is_extracted_incrementally(monkeypatch):
+    pages = [page.read_text(encoding="utf-8") for page in PAGES]
+    parts, size = [], 0
+    while size <= web_scraper.INCREMENTAL_PARSE_SIZE:
+        for html in pages:
+            body = html[html.find(">", html.find("<body")) + 1:html.rfind("</body>")]
+            # Numbered so later copies are not all dropped as already seen
+            parts.append(f"<section><h2>Copy {len(parts)}</h2>{body}</section>")
+            size += len(parts[-1])
+    html = "<html><body>" + "".join(parts) + "</body></html>"
+    calls = []
+    incremental = web_scraper.extract_lines_incremental
+    monkeypatch.setattr(web_scraper, "extract_lines_incremental", lambda *args: calls.append(1) or incremental(*args))
+    text, _, _ = web_scraper.parse_page(html)
+    assert calls
+    assert text == web_scraper.parse_html(html, parser="lxml")
+    assert text == baseline_extractor.parse_html(html)
+
+def test_explicit_parser_is_used_for_large_pages(monkeypatch):
+    def incremental(*args, **kwargs):
+        raise AssertionError("extract_lines_incremental used despite an explicit parser")
+
+    monkeypatch.setattr(web_scraper, "INCREMENTAL_PARSE_SIZE", 10)
+    html = "<p>a</p><p>b <a href='/c'>c</a></p>"
+    assert web_scraper.parse_page(html, "https://example.com/")[:2] == ("  a\n  b\n    [c](/c)",
+                                                                         ["https://example.com/c"])
+    monkeypatch.setattr(web_scraper, "extract_lines_incremental", incremental)
+    for parser in web_scraper.PARSERS:
+        assert web_scraper.parse_page(html, "https://example.com/", parser=parser)[:2] == (
+            "  a\n  b\n    [c](/c)", ["https://example.com/c"])
+
+def test_document_without_elements_is_empty(caplog):
+    with caplog.at_level(logging.ERROR, logger=web_scraper.logger.name):
+        for parser in web_scraper.PARSERS:
+            assert web_scraper.parse_html("<!-- only a comment -->", parser=parser) == ""
+    assert not caplog.records
+
+@pytest.mark.parametrize("parser", web_scraper.PARSERS)
+@pytest.mark.parametrize("page", PAGES, ids=lambda path: path.stem)
+def test_main_content_of_recorded_pages(page, parser):
+    html = page.read_text(encoding="utf-8")
+    full = web_scraper.parse_html(html, parser=parser)
+    reductions = []
+    for level in sorted(web_scraper.MAIN_CONTENT_LEVELS):
+        text, _, reduction = web_scraper.parse_page(html, parser=parser, main_content=level)
+        assert text and 0 <= reduction < 1
+        assert reduction == pytest.approx(1 - len(text) / len(full))
+        # Main content only ever drops lines, never reorders or rewrites them
+        remaining = iter(full.split("\n"))
+        assert all(line in remaining for line in text.split("\n"))
+        reductions.append(reduction)
+    assert reductions == sorted(reductions)
+
+@pytest.mark.parametrize("name, boilerplate, content, reduction", [
+    ("python-idle-help", ["[Report a Bug](../bugs.html)", "Navigation", "Previous topic"],
+     "IDLE has two main window types, the Shell window and the Editor window.", 0.5),
+    ("rust-book-ownership", ["Keyboard shortcuts", "to search in the book"],
+     "All programs have to manage the way they use a computer’s memory while running.", 0.03),
+    ("npm-folders", ["See also"], "npm puts various things on your computer.", 0.03),
+])
+def test_main_content_drops_boilerplate_and_keeps_the_article(name, boilerplate, content, reduction):
+    html = (Path(__file__).parent / "data" / "pages" / f"{name}.html").read_text(encoding="utf-8")
+    full = web_scraper.parse_html(html)
+    text, _, removed = web_scraper.parse_page(html, main_content=2)
+    lines = {line.strip() for line in text.split("\n")}
+    for line in boilerplate:
+        assert line in {line.strip() for line in full.split("\n")} and line not in lines
+    assert content in text
+    assert removed > reduction
+
+def test_main_content_counts_words_of_unspaced_scripts():
+    html = (Path(__file__).parent / "data" / "pages" / "racc-usage-ja.html").read_text(encoding="utf-8")
+    lead = "Racc は文法規則から Ruby で書かれたパーサを生成するパーサジェネレータです。"
+    for level in sorted(web_scraper.MAIN_CONTENT_LEVELS):
+        assert lead in web_scraper.parse_html(html, main_content=level)
+
+LINK_FARM = "<div>" + " | ".join(f"<a href='/t/{index}'>Topic {index}</a>" for index in range(12)) + "</div>"
+
+def paragraph(name):
+    """A block long enough to be content at every level; the extractor drops repeated text, so each is unique."""
+    return " ".join(f"The {name} paragraph makes point {index} in plain words." for index in range(5))
+
+@pytest.mark.parametrize("parser", web_scraper.PARSERS)
+def test_main_content_scores_blocks_by_link_density_and_length(parser):
+    html = (f"<html><body>{LINK_FARM}<div class='sidebar'><p>{paragraph('sidebar')}</p></div><h2>Heading</h2>"
+            f"<p>{paragraph('first')}</p><p>Short aside.</p><p>{paragraph('second')}</p><p>Closing remark.</p>"
+            f"<footer><p>{paragraph('footer')}</p></footer><p>Trailing note.</p></body></html>")
+    kept = {}
+    for level in web_scraper.MAIN_CONTENT_LEVELS:
+        text = web_scraper.parse_html(html, parser=parser, main_content=level)
+        kept[level] = [line.strip() for line in text.split("\n")]
+    # Link lists and blocks inside boilerplate are never content
+    assert kept[1] == ["Heading", paragraph("first"), "Short aside.", paragraph("second"), "Closing remark.",
+                       "Trailing note."]
+    # From level 2 short blocks need content on one side, from level 3 on both; headings need it after them
+    assert kept[2] == ["Heading", paragraph("first"), "Short aside.", paragraph("second"), "Closing remark."]
+    assert kept[3] == ["Heading", paragraph("first"), "Short aside.", paragraph("second")]
+
+def test_main_content_level_is_validated():
+    with pytest.raises(ValueError, match="Main-content level"):
+        web_scraper.parse_page("<p>text</p>", main_content=4)
+
+def test_iter_pages_reports_the_reduction(site):
+    site.add("/article", f"<html><body><nav><a href='/'>Home</a> <a href='/about'>About</a></nav>"
+                         f"<p>{ARTICLE}</p><footer><p>Copyright notice</p></footer></body></html>")
+    site.add("/plain", f"<html><body><p>{ARTICLE}</p></body></html>")
+    article, plain = scrape([site.url("/article"), site.url("/plain")], main_content=2)
+    assert article.reduction > 0 and "Copyright" not in article.text and ARTICLE in article.text
+    assert plain.reduction == 0
+    assert scrape([site.url("/plain")])[0].reduction is None
+
+class FakeContext:
+    def __init__(self, fail_close=False):
+        self.closed = False
+        self.fail_close = fail_close
+
+    async def close(self):
+        if self.fail_close:
+            raise RuntimeError("close failed")
+        self.closed = True
+
+class FakeBrowser:
+    def __init__(self):
+        self.fail = False
+        self.created = []
+
+    async def new_context(self):
+        if self.fail:
+            raise RuntimeError("browser gone")
+        self.created.append(FakeContext())
+        return self.created[-1]
+
+def browser_fetcher(monkeypatch, *contexts):
+    async def fetch_page(url, context, *args):
+        assert not context.closed
+        return f"<p>{url}</p>"
+
+    monkeypatch.setattr(web_scraper, "fetch_page", fetch_page)
+    fetcher = web_scraper.BrowserFetcher(len(contexts), web_scraper.BrowserOptions(recycle_after=2))
+    fetcher._browser = FakeBrowser()
+    fetcher._contexts = asyncio.Queue()
+    for context in contexts:
+        fetcher._contexts.put_nowait((context, 0))
+    return fetcher
+
+def test_browser_context_is_replaced_before_it_is_closed(monkeypatch):
+    first = FakeContext()
+    fetcher = browser_fetcher(monkeypatch, first)
+
+    async def run():
+        for index in range(4):
+            assert (await fetcher.fetch(f"https://example.com/{index}")).html
+
+    asyncio.run(run())
+    assert first.closed
+    assert len(fetcher._browser.created) == 2 and fetcher._browser.created[0].closed
+    context, served = fetcher._contexts.get_nowait()
+    assert context is fetcher._browser.created[1] and not context.closed and served == 0
+
+def test_browser_context_is_kept_when_no_replacement_can_be_made(monkeypatch):
+    first = FakeContext()
+    fetcher = browser_fetcher(monkeypatch, first)
+    fetcher._browser.fail = True
+
+    async def run():
+        for index in range(3):
+            assert (await fetcher.fetch(f"https://example.com/{index}")).html
+
+    asyncio.run(run())
+    assert not first.closed
+    assert fetcher._contexts.get_nowait() == (first, 3)
+
+def test_browser_context_close_failure_keeps_the_replacement(monkeypatch):
+    first = FakeContext(fail_close=True)
+    fetcher = browser_fetcher(monkeypatch, first)
+
+    async def run():
+        for index in range(2):
+            await fetcher.fetch(f"https://example.com/{index}")
+
+    asyncio.run(run())
+    assert fetcher._contexts.get_nowait() == (fetcher._browser.created[0], 0)
+
+class FakeResponse:
+    def __init__(self, status):
+        self.status = status
+        self.headers = {"content-type": "text/html; charset=utf-8"}
+
+class FakeRequest:
+    def __init__(self, resource_type, url):
+        self.resource_type, self.url = resource_type, url
+
+class FakeRoute:
+    def __init__(self, request, handled):
+        self.request, self.handled = request, handled
+
+    async def abort(self):
+        self.handled.append(("aborted", self.request.url))
+
+    async def continue_(self):
+        self.handled.append(("continued", self.request.url))
+
+class FakePage:
+    """
+    Enough of a Playwright page for fetch_page: navigation lands on ``final_url`` and renders ``html``.
+
+    Navigation passes each of ``subrequests`` ((resource type, URL) pairs) through the routed
+    handler, recording what it did in ``handled``; ``waits`` records every readiness wait.
+    """
+
+    def __init__(self, html, status, final_url, subrequests=()):
+        self.html, self.status, self.final_url = html, status, final_url
+        self.subrequests = subrequests
+        self.url = "about:blank"
+        self.handler = None
+        self.handled = []
+        self.waits = []
+
+    async def route(self, pattern, handler):
+        self.handler = handler
+
+    async def goto(self, url, wait_until, timeout):
+        self.url = self.final_url
+        for resource_type, request_url in self.subrequests:
+            if self.handler is None:
+                self.handled.append(("continued", request_url))
+            else:
+                await self.handler(FakeRoute(FakeRequest(resource_type, request_url), self.handled))
+        return FakeResponse(self.status) if self.status is not None else None
+
+    async def wait_for_load_state(self, state, timeout):
+        self.waits.append(state)
+
+    async def wait_for_selector(self, selector, state, timeout):
+        self.waits.append(f"selector:{selector}")
+
+    async def evaluate(self, script, arg):
+        if isinstance(arg, list):  # The DOM-quiet wait
+            self.waits.append(f"quiet:{arg[0]}")
+            return None
+        return [self.html, len(self.html)]
+
+    async def close(self):
+        pass
+
+class RenderingContext(FakeContext):
+    def __init__(self, *page_args):
+        super().__init__()
+        self.page_args = page_args
+
+    async def new_page(self):
+        return FakePage(*self.page_args)
+
+@pytest.mark.parametrize("browser_status, status", [(201, 201), (None, 200)])
+def test_browser_tier_record_has_the_rendered_status_and_url(site, browser_status, status):
+    site.add("/app", "<html><body><div id='root'></div><script src='/app.js'></script></body></html>")
+    rendered = f"<html><body><p>{ARTICLE}</p></body></html>"
+
+    async def run():
+        async with web_scraper.PageFetcher(1, "auto") as fetcher:
+            fetcher.browser._contexts = asyncio.Queue()
+            fetcher.browser._contexts.put_nowait((RenderingContext(rendered, browser_status, site.url("/app/home")), 0))
+            page = await fetcher.fetch(site.url("/app"))
+            fetcher.browser._contexts = None  # No real browser to shut down
+            return page
+
+    page = asyncio.run(run())
+    page.text = web_scraper.parse_page(page.html)[0]
+    record = web_scraper.page_record(page)
+    assert record["tier"] == "browser" and record["escalation"] == "empty-app-root"
+    # The browser's main response, or the HTTP one when the browser saw none
+    assert record["status"] == status
+    assert record["url"] == site.url("/app")
+    assert record["final_url"] == site.url("/app/home")
+    assert ARTICLE in record["text"]
+
+def test_browser_options_block_resource_types_and_domains_with_subdomains():
+    options = web_scraper.BrowserOptions(block_resources=["image", "font"], block_domains=["Tracker.example"])
+    assert options.blocks(FakeRequest("image", "https://site.example/logo.png"))
+    assert options.blocks(FakeRequest("font", "https://site.example/face.woff2"))
+    assert options.blocks(FakeRequest("script", "https://tracker.example/t.js"))
+    assert options.blocks(FakeRequest("xhr", "https://cdn.TRACKER.example/beacon"))
+    assert not options.blocks(FakeRequest("script", "https://nottracker.example/t.js"))
+    assert not options.blocks(FakeRequest("script", "https://tracker.example.org/t.js"))
+    assert not options.blocks(FakeRequest("document", "https://site.example/"))
+
+@pytest.mark.parametrize("ready, strategy", [
+    ("networkidle", ("networkidle", "")),
+    ("domcontentloaded", ("domcontentloaded", "")),
+    ("selector:article .body", ("selector", "article .body")),
+    ("quiet:500", ("quiet", "500")),
+])
+def test_browser_options_readiness_strategies(ready, strategy):
+    assert web_scraper.BrowserOptions(ready=ready).ready_strategy == strategy
+
+@pytest.mark.parametrize("ready, message", [
+    ("visible", "Unknown readiness strategy"),
+    ("load:5", "Unknown readiness strategy"),
+    ("selector:", "needs a CSS selector"),
+    ("quiet:", "needs milliseconds"),
+    ("quiet:soon", "needs milliseconds"),
+])
+def test_browser_options_reject_bad_readiness(ready, message):
+    with pytest.raises(ValueError, match=message):
+        web_scraper.BrowserOptions(ready=ready)
+
+class RenderingContextOf(FakeContext):
+    def __init__(self, page):
+        super().__init__()
+        self.page = page
+
+    async def new_page(self):
+        return self.page
+
+def render(page, options):
+    timings, outcome = {}, {}
+    html = asyncio.run(web_scraper.fetch_page("https://site.example/", RenderingContextOf(page), options,
+                                              timings, outcome=outcome))
+    return html, timings, outcome
+
+def test_fetch_page_aborts_blocked_requests_and_times_each_phase():
+    page = FakePage("<p>Rendered</p>", 200, "https://site.example/", subrequests=[
+        ("script", "https://site.example/app.js"),
+        ("image", "https://site.example/hero.jpg"),
+        ("script", "https://ads.tracker.example/ad.js"),
+        ("stylesheet", "https://site.example/site.css"),
+    ])
+    options = web_scraper.BrowserOptions(block_resources=["image"], block_domains=["tracker.example"])
+    html, timings, outcome = render(page, options)
+    assert html == "<p>Rendered</p>" and outcome["status"] == 200
+    assert page.handled == [("continued", "https://site.example/app.js"),
+                            ("aborted", "https://site.example/hero.jpg"),
+                            ("aborted", "https://ads.tracker.example/ad.js"),
+                            ("continued", "https://site.example/site.css")]
+    assert timings["blocked"] == 2
+    assert set(timings) == {"blocked", "navigate", "ready", "content"}
+    assert all(timings[phase] >= 0 for phase in ("navigate", "ready", "content"))
+
+def test_fetch_page_without_blocklists_installs_no_route():
+    page = FakePage("<p>Rendered</p>", 200, "https://site.example/", subrequests=[("image", "https://site.example/a.png")])
+    _, timings, _ = render(page, web_scraper.BrowserOptions(block_resources=(), block_domains=()))
+    assert page.handler is None and timings["blocked"] == 0
+
+@pytest.mark.parametrize("ready, waits", [
+    ("networkidle", ["load", "networkidle"]),
+    ("load", ["load"]),
+    ("domcontentloaded", ["domcontentloaded"]),
+    ("selector:#content", ["domcontentloaded", "selector:#content"]),
+    ("quiet:250", ["domcontentloaded", "quiet:250"]),
+])
+def test_fetch_page_waits_as_the_readiness_strategy_says(ready, waits):
+    page = FakePage("<p>Rendered</p>", 200, "https://site.example/")
+    render(page, web_scraper.BrowserOptions(ready=ready))
+    assert page.waits == waits
+
+# Stands in for Chromium: serves /json/version on the requested port (0: a random one)
+# and reports it in DevToolsActivePort in the profile directory, as Chromium does
+FAKE_CHROMIUM = r"""import http.server, json, os, sys
+options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith("--") and "=" in arg)
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps([] if self.path == "/json/list" else {"Browser": "Fake"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+server = http.server.HTTPServer(("127.0.0.1", int(options["remote-debugging-port"])), Handler)
+with open(os.path.join(options["user-data-dir"], "DevToolsActivePort"), "w") as f:
+    f.write(f"{server.server_address[1]}\n/devtools/browser/fake\n")
+server.serve_forever()
+"""
+
+def test_browser_service_publishes_a_random_port_in_a_private_file(tmp_path, monkeypatch):
+    executable = tmp_path / "chromium"
+    executable.write_text(f"#!{sys.executable}\n{FAKE_CHROMIUM}")
+    executable.chmod(0o755)
+    monkeypatch.delenv("WEB_SCRAPER_CDP_URL", raising=False)
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path / "run"))
+    state_path = Path(web_scraper.browser_service_state_path())
+    assert state_path.parent == tmp_path / "run" / "web_scraper"
+
+    services = [web_scraper.BrowserService(executable=str(executable)) for _ in range(2)]
+    try:
+        for service in services:
+            service.start()
+        # Each launch gets its own port, and only the state file says which
+        assert services[0].endpoint != services[1].endpoint
+        assert web_scraper.browser_service_endpoint() == services[1].endpoint
+        assert state_path.parent.stat().st_mode & 0o777 == 0o700
+        assert state_path.stat().st_mode & 0o777 == 0o600
+
+        # A state file others could have written is not trusted
+        state_path.chmod(0o644)
+        assert web_scraper.browser_service_endpoint() is None
+        state_path.chmod(0o600)
+        state_path.parent.chmod(0o755)
+        assert web_scraper.browser_service_endpoint() is None
+    finally:
+        state_path.parent.chmod(0o700)
+        for service in services:
+            service.stop()
+
+def stored_bytes(cache: web_scraper.PageCache) -> int:
+    db = cache._connect()
+    return (db.execute("SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+            + db.execute("SELECT COALESCE(SUM(text_size), 0) FROM pages").fetchone()[0])
+
+def cached_page(url: str, body: str, text: str = "text") -> web_scraper.PageResult:
+    return web_scraper.PageResult(url, text=text, html=f"<html><body>{body}</body></html>", tier="http", status=200)
+
+def test_page_cache_keeps_a_running_size_total(tmp_path):
+    cache = web_scraper.PageCache(str(tmp_path))
+    cache.put(cached_page("https://example.com/a", "shared"))
+    cache.put(cached_page("https://example.com/b", "shared"))
+    assert cache.stats()["bodies"] == 1
+    # Replacing one page's body keeps the body the other page still uses
+    cache.put(cached_page("https://example.com/a", "changed", text="longer text"))
+    assert cache.stats()["bodies"] == 2
+    # Replacing the other's drops the body nothing refers to any more
+    cache.put(cached_page("https://example.com/b", "changed"))
+    assert cache.stats()["bodies"] == 1
+    assert cache.stats()["bytes"] == stored_bytes(cache)
+    page, _ = cache.get("https://example.com/a")
+    assert page.text == "longer text" and "changed" in page.html
+
+    # An existing cache file gets its total from the stored rows
+    cache._connect().execute("DELETE FROM counters WHERE name = 'bytes'")
+    assert web_scraper.PageCache(str(tmp_path)).stats()["bytes"] == stored_bytes(cache)
+    cache.clear()
+    assert cache.stats()["bytes"] == 0 == stored_bytes(cache)
+
+def test_page_cache_evicts_least_recently_used_pages(tmp_path):
+    cache = web_scraper.PageCache(str(tmp_path))
+    cache.put(cached_page("https://example.com/0", "x" * 2000))
+    cache.max_bytes = stored_bytes(cache) * 3
+    for index in range(1, 6):
+        cache.put(cached_page(f"https://example.com/{index}", f"{index}" * 2000))
+        cache.get("https://example.com/0")  # Kept fresh
+    assert cache.stats()["bytes"] == stored_bytes(cache) <= cache.max_bytes
+    assert cache.get("https://example.com/0") is not None
+    assert cache.get("https://example.com/5") is not None
+    assert cache.get("https://example.com/1") is None
+
+def test_page_cache_expires_entries_with_their_bodies(tmp_path):
+    cache = web_scraper.PageCache(str(tmp_path), ttl=60)
+    cache.put(cached_page("https://example.com/old", "old"))
+    cache.put(cached_page("https://example.com/new", "new"))
+    cache._connect().execute("UPDATE pages SET validated_at = validated_at - 120 WHERE url LIKE '%old'")
+    assert cache.get("https://example.com/old") is None
+    assert cache.stats()["bodies"] == 1
+    assert cache.stats()["bytes"] == stored_bytes(cache)
+
+def scrape(urls, **options):
+    """Run iter_pages over plain HTTP and return its pages in input order."""
+    async def run():
+        return [page async for page in web_scraper.iter_pages(urls, tier="http", **options)]
+
+    return sorted(asyncio.run(run()), key=lambda page: page.index)
+
+def test_scheduler_caps_connections_per_host():
+    async def run():
+        scheduler = web_scraper.FetchScheduler(per_host=2)
+        for index in range(3):
+            await scheduler.add(("a", index), f"https://a.example/{index}")
+        await scheduler.add(("b", 0), "https://b.example/0")
+        await scheduler.close()
+        handed = [await scheduler.next() for _ in range(3)]
+        assert [item for item, _ in handed] == [("a", 0), ("a", 1), ("b", 0)]
+        # a.example is at its cap until one of its fetches is done
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(scheduler.next(), 0.05)
+        await scheduler.done("a.example")
+        assert await scheduler.next() == (("a", 2), "a.example")
+        for host in ("a.example", "a.example", "b.example"):
+            await scheduler.done(host)
+        assert await scheduler.next() is None
+
+    asyncio.run(run())
+
+def test_scheduler_hands_out_lower_priorities_first_in_order_added():
+    async def run():
+        scheduler = web_scraper.FetchScheduler(per_host=10)
+        for item, priority in (("deep", 2), ("seed1", 0), ("link", 1), ("seed2", 0)):
+            await scheduler.add(item, f"https://example.com/{item}", priority)
+        await scheduler.close()
+        return [(await scheduler.next())[0] for _ in range(4)]
+
+    assert asyncio.run(run()) == ["seed1", "seed2", "link", "deep"]
+
+def test_scheduler_spaces_requests_to_a_host_without_holding_back_others():
+    async def run():
+        scheduler = web_scraper.FetchScheduler(per_host=5, delay=0.2)
+        for index in range(2):
+            await scheduler.add(("slow", index), f"https://slow.example/{index}")
+        await scheduler.add(("other", 0), "https://other.example/0")
+        await scheduler.close()
+        started = time.monotonic()
+        order = []
+        for _ in range(3):
+            item, host = await scheduler.next()
+            order.append((item, time.monotonic() - started))
+            await scheduler.done(host)
+        return order
+
+    order = asyncio.run(run())
+    assert [item for item, _ in order] == [("slow", 0), ("other", 0), ("slow", 1)]
+    assert order[1][1] < 0.1 <= 0.18 <= order[2][1]
+
+def test_scheduler_probes_a_new_host_with_one_connection():
+    async def run():
+        scheduler = web_scraper.FetchScheduler(per_host=3, probe_hosts=True)
+        for index in range(3):
+            await scheduler.add(index, f"https://example.com/{index}")
+        assert (await scheduler.next())[0] == 0
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(scheduler.next(), 0.05)
+        await scheduler.host_ready("example.com")
+        return [(await scheduler.next())[0] for _ in range(2)]
+
+    assert asyncio.run(run()) == [1, 2]
+
+def test_robots_rules_and_crawl_delay(site):
+    site.add("/robots.txt", "User-agent: *\nDisallow: /private\nCrawl-delay: 2\n", content_type="text/plain")
+
+    async def run():
+        robots = web_scraper.RobotsCache()
+        try:
+            return (await robots.allowed(site.url("/public")), await robots.allowed(site.url("/private/page")),
+                    await robots.crawl_delay(site.url("/public")))
+        finally:
+            await robots.close()
+
+    assert asyncio.run(run()) == (True, False, 2.0)
+    assert site.paths() == ["/robots.txt"]
+
+@pytest.mark.parametrize("status, allowed", [(404, True), (500, True), (403, False), (401, False)])
+def test_robots_status_codes(site, status, allowed):
+    site.add("/robots.txt", "User-agent: *\nDisallow: /\n", status=status, content_type="text/plain")
+
+    async def run():
+        robots = web_scraper.RobotsCache()
+        try:
+            return await robots.allowed(site.url("/page"))
+        finally:
+            await robots.close()
+
+    assert asyncio.run(run()) is allowed
+
+def test_robots_unreachable_allows_everything():
+    async def run():
+        robots = web_scraper.RobotsCache()
+        try:
+            return await robots.allowed("http://127.0.0.1:9/page")
+        finally:
+            await robots.close()
+
+    assert asyncio.run(run()) is True
+
+def test_iter_pages_honours_robots_and_crawl_delay(site):
+    # urllib.robotparser only reads whole-second delays
+    site.add("/robots.txt", "User-agent: *\nDisallow: /private\nCrawl-delay: 1\n", content_type="text/plain")
+    for name in ("one", "two", "private"):
+        site.add(f"/{name}", f"<html><body><p>Page {name} with enough words to stand on its own</p></body></html>")
+    pages = scrape([site.url("/one"), site.url("/private"), site.url("/two")], robots=True, cache=None)
+    assert [page.error for page in pages] == [None, "Disallowed by robots.txt", None]
+    assert "Page two" in pages[2].text
+    assert "/private" not in site.paths()
+    starts = [at for at, path in site.requests if path in ("/one", "/two")]
+    assert starts[1] - starts[0] >= 0.95
+
+def test_iter_pages_times_out_a_slow_host_without_stalling_others(site):
+    site.add("/slow", "<p>slow</p>")
+    site.add("/fast", "<p>fast</p>")
+    site.delays["/slow"] = 2
+    started = time.monotonic()
+    pages = scrape([site.url("/slow"), site.url("/fast")], timeout=0.5)
+    assert pages[0].error and pages[1].text.strip() == "fast"
+    assert time.monotonic() - started < 2
+
+def test_iter_pages_yields_in_completion_order(site):
+    for name in ("slow", "fast", "quick"):
+        site.add(f"/{name}", f"<html><body><p>Page {name}</p></body></html>")
+    site.delays["/slow"] = 0.5
+
+    async def run():
+        return [(page.index, time.monotonic()) async for page in
+                web_scraper.iter_pages([site.url("/slow"), site.url("/fast"), site.url("/quick")], tier="http")]
+
+    started = time.monotonic()
+    yielded = asyncio.run(run())
+    assert [index for index, _ in yielded][-1] == 0
+    assert sorted(index for index, _ in yielded) == [0, 1, 2]
+    # The fast pages are handed over while the slow one is still being fetched
+    assert all(at - started < 0.5 for index, at in yielded if index)
+
+def test_iter_pages_pauses_fetching_for_a_slow_consumer(site):
+    urls = []
+    for index in range(40):
+        site.add(f"/{index}", f"<html><body><p>Page {index}</p></body></html>")
+        urls.append(site.url(f"/{index}"))
+
+    async def run():
+        pages = web_scraper.iter_pages(urls, tier="http", max_concurrent=1, http_concurrency=2, max_pending=1)
+        first = await pages.__anext__()
+        await asyncio.sleep(0.5)
+        fetched_while_stalled = len(site.requests)
+        rest = [page async for page in pages]
+        return first, fetched_while_stalled, rest
+
+    first, fetched_while_stalled, rest = asyncio.run(run())
+    _, parse_workers = web_scraper.get_parse_pool()
+    # Besides the page handed over, each stage holds at most its queue plus one page per worker
+    # blocked on a full queue: parse_workers parsed and waiting, parse_workers parsing, one
+    # pending and two fetch workers
+    assert fetched_while_stalled <= 1 + 2 * parse_workers + 1 + 2
+    assert fetched_while_stalled < len(urls)
+    assert sorted(page.index for page in [first] + rest) == list(range(len(urls)))
+    assert all(page.ok for page in rest)
+
+def test_main_prints_each_page_as_it_completes(site, monkeypatch, capfd):
+    site.add("/slow", "<html><body><p>Slow page</p></body></html>")
+    site.add("/fast", "<html><body><p>Fast page</p></body></html>")
+    site.delays["/slow"] = 0.5
+    monkeypatch.setattr(sys, "argv", ["web_scraper.py", "--tier", "http", "--no-cache",
+                                      site.url("/slow"), site.url("/fast")])
+    web_scraper.main()
+    out = capfd.readouterr().out
+    assert out.index("Fast page") < out.index("Slow page")
+
+def test_seen_set_treats_equivalent_urls_as_one():
+    seen = web_scraper.SeenSet(merge_every=4)
+    assert seen.add("https://Example.com/page?b=2&a=1#top")
+    assert not seen.add("https://example.com/page?a=1&b=2")
+    assert not seen.add("https://example.com/page?a=1&b=2&utm_source=feed")
+    urls = [f"https://example.com/{index}" for index in range(10)]
+    assert all(seen.add(url) for url in urls)
+    assert len(seen) == 11
+    assert all(url in seen for url in urls) and "https://example.com/other" not in seen
+
+    restored = web_scraper.SeenSet(seen.to_bytes())
+    assert len(restored) == 11
+    assert all(url in restored for url in urls) and "https://example.com/page?b=2&a=1" in restored
+    assert not restored.add(urls[3]) and restored.add("https://example.com/other")
+
+def crawl_site(site):
+    """A seed page linking to six pages, each linking one level deeper, plus links the crawl filters out."""
+    names = "abcdef"
+    site.add("/", "<html><body><p>Seed page</p>" + "".join(f"<a href='/{name}'>{name}</a>" for name in names)
+             + "<a href='/skip/me'>skip</a><a href='http://other.invalid/x'>away</a></body></html>")
+    for name in names:
+        site.add(f"/{name}", f"<html><body><p>Page {name}</p><a href='/{name}/deep'>deeper</a></body></html>")
+    return [site.url("/")] + [site.url(f"/{name}") for name in names]
+
+def test_crawler_follows_links_within_its_limits(site):
+    expected = crawl_site(site)
+    crawler = web_scraper.Crawler(max_depth=1, same_host=True, exclude=[r"/skip/"])
+    pages = scrape([site.url("/")], crawler=crawler)
+    assert sorted(page.url for page in pages) == sorted(expected)
+    assert all(page.ok for page in pages)
+    assert crawler.completed == crawler.scheduled == 7
+
+    limited = web_scraper.Crawler(max_depth=2, same_host=True, exclude=[r"/skip/"], max_pages=4)
+    assert len(scrape([site.url("/")], crawler=limited)) == 4
+
+class FailingCache(web_scraper.PageCache):
+    """A PageCache whose database fails for some URLs, as a locked or corrupt one would."""
+
+    def __init__(self, cache_dir, fail_get=(), fail_put=()):
+        super().__init__(cache_dir)
+        self.fail_get, self.fail_put = fail_get, fail_put
+
+    def get(self, url, parser=None):
+        if url.endswith(self.fail_get):
+            raise sqlite3.OperationalError("database is locked")
+        return super().get(url, parser)
+
+    def put(self, page, parser=None):
+        if page.url.endswith(self.fail_put):
+            raise sqlite3.OperationalError("disk I/O error")
+        super().put(page, parser)
+
+def test_crawl_survives_a_failing_cache(site, tmp_path, caplog):
+    expected = crawl_site(site)
+    cache = FailingCache(str(tmp_path), fail_get=("/b",), fail_put=("/c",))
+    crawler = web_scraper.Crawler(max_depth=1, same_host=True, exclude=[r"/skip/"])
+
+    async def run():
+        pages = web_scraper.iter_pages([site.url("/")], tier="http", crawler=crawler, cache=cache)
+        return [page async for page in pages]
+
+    pages = {page.url: page for page in asyncio.run(asyncio.wait_for(run(), 10))}
+    assert sorted(pages) == sorted(expected)
+    assert pages[site.url("/b")].error == "OperationalError: database is locked"
+    # A page that cannot be stored is still returned; only caching it failed
+    assert pages[site.url("/c")].ok and "Page c" in pages[site.url("/c")].text
+    assert "Could not cache" in caplog.text
+    assert crawler.completed == 7
+
+def test_crawl_resumes_from_its_checkpoint(site, tmp_path):
+    expected = crawl_site(site)
+    checkpoint = str(tmp_path / "crawl.json")
+    options = dict(tier="http", max_concurrent=1, http_concurrency=1, per_host=1)
+
+    async def first_run():
+        crawler = web_scraper.Crawler(max_depth=1, same_host=True, exclude=[r"/skip/"], checkpoint=checkpoint)
+        pages = web_scraper.iter_pages([site.url("/")], crawler=crawler, **options)
+        seen = []
+        async for page in pages:
+            seen.append(page.url)
+            if len(seen) == 3:
+                break
+            await asyncio.sleep(0.2)  # A slow consumer: later pages are parsed and waiting when it stops
+        await pages.aclose()
+        return seen
+
+    async def second_run():
+        crawler = web_scraper.Crawler(max_depth=1, same_host=True, exclude=[r"/skip/"], checkpoint=checkpoint)
+        return [page.url async for page in web_scraper.iter_pages([site.url("/")], crawler=crawler, **options)]
+
+    first = asyncio.run(first_run())
+    second = asyncio.run(second_run())
+    # Pages handed out before the stop are not fetched again; every other page is
+    assert not set(first) & set(second)
+    assert sorted(first + second) == sorted(expected)
+
+    # A finished crawl's checkpoint has an empty frontier
+    assert asyncio.run(second_run()) == []
+
+ARTICLE = " ".join(f"Sentence {index} of the syndicated article says something about topic {index % 7}."
+                   for index in range(60))
+FOOTER = "Copyright Example Publishing. All rights reserved, reproduction prohibited."
+
+def test_deduplicator_collapses_near_duplicates_and_repeated_lines():
+    deduplicator = web_scraper.Deduplicator(0.9)
+    first = web_scraper.PageResult("https://a.example/story", text=f"{ARTICLE}\n{FOOTER}")
+    copy = web_scraper.PageResult("https://b.example/story", text=f"{ARTICLE} Mirrored.\n{FOOTER}")
+    other = web_scraper.PageResult("https://a.example/other", text=f"A different page entirely.\n{FOOTER}")
+    for page in (first, copy, other):
+        deduplicator.apply(page)
+    assert first.text == f"{ARTICLE}\n{FOOTER}"
+    assert copy.text == "" and copy.duplicate_of == first.url and copy.similarity >= 0.9
+    assert other.text == "A different page entirely." and other.repeated_lines == 1
+    report = deduplicator.report()
+    assert report["near_duplicates"][0]["url"] == copy.url
+    assert report["repeated_lines"] == [{"text": FOOTER, "suppressed": 1}]
+    with pytest.raises(ValueError):
+        web_scraper.Deduplicator(0.5)
+
+def test_dedupe_keeps_the_earliest_input_page_whatever_finishes_first(site):
+    site.add("/original", f"<html><body><p>{ARTICLE}</p><p>{FOOTER}</p></body></html>")
+    site.add("/other", f"<html><body><p>A different page entirely.</p><p>{FOOTER}</p></body></html>")
+    site.add("/mirror", f"<html><body><p>{ARTICLE} Mirrored.</p><p>{FOOTER}</p></body></html>")
+    site.delays["/original"] = 0.5  # Fetched last
+    urls = [site.url(path) for path in ("/original", "/other", "/mirror")]
+
+    async def run():
+        return [page async for page in web_scraper.iter_pages(urls, tier="http", deduplicator=web_scraper.Deduplicator())]
+
+    pages = asyncio.run(run())
+    assert [page.index for page in pages] == [0, 1, 2]
+    original, other, mirror = pages
+    assert ARTICLE in original.text and FOOTER in original.text
+    assert FOOTER not in other.text and other.repeated_lines == 1
+    assert mirror.text == "" and mirror.duplicate_of == urls[0]
+
+def test_dedupe_continues_past_a_failed_page(site, tmp_path):
+    site.add("/original", f"<html><body><p>{ARTICLE}</p></body></html>")
+    site.add("/broken", "<html><body><p>Never read</p></body></html>")
+    site.add("/mirror", f"<html><body><p>{ARTICLE} Mirrored.</p></body></html>")
+    urls = [site.url(path) for path in ("/original", "/broken", "/mirror")]
+    cache = FailingCache(str(tmp_path), fail_get=("/broken",))
+
+    async def run():
+        pages = web_scraper.iter_pages(urls, tier="http", cache=cache, deduplicator=web_scraper.Deduplicator())
+        return [page async for page in pages]
+
+    original, broken, mirror = asyncio.run(asyncio.wait_for(run(), 10))
+    assert broken.index == 1 and broken.error == "OperationalError: database is locked"
+    assert mirror.duplicate_of == urls[0]
+
+def fetch_http(site, path, max_size=web_scraper.DEFAULT_MAX_PAGE_SIZE):
+    async def run():
+        client = web_scraper.create_http_client(2)
+        try:
+            return await web_scraper.fetch_page_http(site.url(path), client, max_size=max_size)
+        finally:
+            await client.aclose()
+
+    return asyncio.run(run())
+
+def test_http_fetch_stops_at_the_size_limit(site):
+    body = "<html><body>" + "<p>Enough words in this paragraph to count as real content.</p>" * 2000 + "</body></html>"
+    site.add("/big", body)
+    page = fetch_http(site, "/big", max_size=10000)
+    assert page.truncated and page.size == 10000 and page.html == body[:10000]
+    assert page.escalation is None and page.error is None
+    page = fetch_http(site, "/big", max_size=None)
+    assert not page.truncated and page.html == body
+
+@pytest.mark.parametrize("content_type, body, error", [
+    ("application/pdf", b"%PDF-1.7 binary", "Unsupported content type: application/pdf"),
+    ("image/png; charset=binary", b"\x89PNG\r\n", "Unsupported content type: image/png"),
+    (None, b"\x00\x01\x02binary", "Binary content"),
+])
+def test_http_fetch_skips_non_html(site, content_type, body, error):
+    site.add("/file", body, content_type=content_type)
+    page = fetch_http(site, "/file")
+    assert page.error == error and page.html is None and page.escalation is None
+
+def test_http_fetch_reads_plain_text_and_untyped_html(site):
+    site.add("/notes.txt", "Plain text notes", content_type="text/plain")
+    site.add("/untyped", "<html><body><p>No content type</p></body></html>", content_type=None)
+    assert fetch_http(site, "/notes.txt").html == "Plain text notes"
+    assert "No content type" in fetch_http(site, "/untyped").html
+
+JAPANESE = "東京の天気は晴れ、最高気温は二十五度の予報です。" * 20
+
+@pytest.mark.parametrize("head", [
+    '<meta charset="Shift_JIS">',
+    '<meta http-equiv="Content-Type" content="text/html; charset=shift_jis">',
+    "",  # No declaration at all: detected
+])
+def test_http_fetch_decodes_pages_without_a_header_charset(site, head):
+    html = f"<html><head>{head}</head><body><p>{JAPANESE}</p></body></html>"
+    site.add("/sjis", html.encode("shift_jis"), content_type="text/html")
+    page = fetch_http(site, "/sjis")
+    assert page.escalation is None
+    assert JAPANESE in web_scraper.parse_page(page.html)[0]
+
+def test_http_fetch_escalates_when_the_encoding_cannot_be_told(site, monkeypatch):
+    find_spec = web_scraper.importlib.util.find_spec
+    monkeypatch.setattr(web_scraper.importlib.util, "find_spec",
+                        lambda name, *args: None if name == "charset_normalizer" else find_spec(name, *args))
+    site.add("/sjis", f"<html><body><p>{JAPANESE}</p></body></html>".encode("shift_jis"), content_type="text/html")
+    site.add("/declared", f"<html><body><p>{JAPANESE}</p></body></html>".encode("shift_jis"),
+             content_type="text/html; charset=Shift_JIS")
+    assert fetch_http(site, "/sjis").escalation == "unknown-encoding"
+    assert fetch_http(site, "/declared").escalation is None
+
+def test_byte_order_mark_decides_the_encoding():
+    assert web_scraper.detect_encoding(codecs.BOM_UTF8 + b"<p>x</p>", "iso-8859-1") == "utf-8-sig"
+    assert web_scraper.detect_encoding("<p>x</p>".encode("utf-16")) == "utf-16"
+    assert web_scraper.detect_encoding(b"<meta charset=utf-16><p>x</p>") == "utf-8"
+
+PARAGRAPHS = "<p>" + "Plenty of server-rendered prose sits in this paragraph. " * 10 + "</p>"
+
+@pytest.mark.parametrize("html, status, escalation", [
+    (f"<html><body>{PARAGRAPHS}<script src='/app.js'></script></body></html>", 200, None),
+    ("<html><body><div id='root'></div><script src='/app.js'></script></body></html>", 200, "empty-app-root"),
+    ("<html><body><noscript>Please enable JavaScript to continue.</noscript></body></html>", 200, "noscript-warning"),
+    ("<html><body><p>Loading</p><script src='/bundle.js'></script></body></html>", 200, "js-shell"),
+    ("<html><title>Just a moment...</title><body>Checking your browser</body></html>", 403, "bot-challenge"),
+    ("<html><body><p>Forbidden</p></body></html>", 403, None),
+    ("<html><body><p>Short static page</p></body></html>", 200, None),
+])
+def test_escalation_rules(site, html, status, escalation):
+    assert web_scraper.needs_browser(html, status) == escalation
+    site.add("/page", html, status=status)
+    page = fetch_http(site, "/page")
+    assert page.escalation == escalation
+    # Error statuses are failures unless the browser might still get the page
+    assert page.error == (f"HTTP {status}" if status >= 400 and escalation is None else None)
+
+def test_truncated_pages_are_not_cached(site, tmp_path):
+    paragraph = "<p>Enough words in this paragraph to count as real content.</p>"
+    site.add("/big", "<html><body>" + paragraph * 500 + "</body></html>")
+    site.add("/small", "<html><body>" + paragraph + "</body></html>")
+    cache = web_scraper.PageCache(str(tmp_path))
+    pages = scrape([site.url("/big"), site.url("/small")], cache=cache, max_page_size=4096)
+    assert [page.truncated for page in pages] == [True, False]
+    assert pages[0].size == 4096 and "real content" in pages[0].text
+    assert cache.get(site.url("/big")) is None
+    assert cache.get(site.url("/small")) is not None
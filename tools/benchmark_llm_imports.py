@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+Import-time benchmark for tools/llm_api.py.
+
+Runs a fresh interpreter per scenario with ``python -X importtime`` and reports
+the cumulative import cost of llm_api itself and of each provider SDK that
+create_llm_client would pull in. Compare against the checked-in baseline with
+``--baseline`` to spot regressions.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+TOOLS_DIR = Path(__file__).resolve().parent
+DEFAULT_BASELINE = TOOLS_DIR / "llm_api_importtime.json"
+
+# One scenario per distinct SDK; the OpenAI-compatible providers share a module.
+SCENARIOS = {
+    "llm_api": "import llm_api",
+    "openai": "import llm_api; llm_api._provider_sdk('openai')",
+    "anthropic": "import llm_api; llm_api._provider_sdk('anthropic')",
+    "gemini": "import llm_api; llm_api._provider_sdk('gemini')",
+}
+
+def measure(statement: str) -> int:
+    """
+    Run ``statement`` in a fresh interpreter and return the total import time.
+
+    Returns:
+        int: Sum of the cumulative microseconds of all top-level imports
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=TOOLS_DIR,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Top-level imports are the ones without indentation in the name column.
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark import time of llm_api and its provider SDKs')
+    parser.add_argument('--runs', type=int, default=5, help='Runs per scenario; the median is reported (default: 5)')
+    parser.add_argument('--baseline', type=str, help=f'Compare against a baseline JSON file (e.g. {DEFAULT_BASELINE.name})')
+    parser.add_argument('--write-baseline', type=str, help='Write the measured medians to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative slowdown before failing (default: 0.25)')
+    args = parser.parse_args()
+
+    baseline = json.loads(Path(args.baseline).read_text())["scenarios"] if args.baseline else {}
+    medians = {}
+    regressions = []
+
+    print(f"{'scenario':<12} {'median ms':>10} {'baseline ms':>12} {'delta':>8}")
+    for name, statement in SCENARIOS.items():
+        try:
+            samples = [measure(statement) for _ in range(args.runs)]
+        except RuntimeError as e:
+            print(f"{name:<12} {'skipped':>10}  ({e})")
+            continue
+        medians[name] = statistics.median(samples)
+        row = f"{name:<12} {medians[name] / 1000:>10.1f}"
+        if name in baseline:
+            delta = medians[name] / baseline[name] - 1
+            row += f" {baseline[name] / 1000:>12.1f} {delta:>+8.0%}"
+            if delta > args.tolerance:
+                regressions.append(name)
+        print(row)
+
+    if args.write_baseline:
+        Path(args.write_baseline).write_text(json.dumps({
+            "python": sys.version.split()[0],
+            "unit": "microseconds (median cumulative import time)",
+            "scenarios": medians,
+        }, indent=2) + "\n")
+
+    if regressions:
+        print(f"Import-time regressions beyond {args.tolerance:.0%}: {', '.join(regressions)}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
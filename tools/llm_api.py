@@ -1,268 +1,2915 @@
 #!/usr/bin/env /workspace/tmp_windsurf/venv/bin/python3
 
-import google.generativeai as genai
-from openai import OpenAI, AzureOpenAI
-from anthropic import Anthropic
-import argparse
+import atexit
+import json
 import os
-from dotenv import load_dotenv
 from pathlib import Path
 import sys
 import base64
-from typing import Optional, Union, List
+import collections
+import contextlib
+import dataclasses
+import functools
+import io
+import itertools
+import math
+from dataclasses import asdict, dataclass, field
+from typing import AsyncIterator, Iterable, Iterator, Optional, Union, List
 import mimetypes
+import random
+import re
+import threading
+import time
+import zlib
+
+# Provider SDKs are imported on demand (see _provider_sdk) so that importing this
+# module, or querying a single provider, does not pay for every SDK's import time.
+# The same goes for the stdlib modules (asyncio, sqlite3, socketserver,
+# concurrent.futures, email.utils, hashlib) that only the batch, cache, daemon,
+# hedging and retry paths need.
+OPENAI_COMPATIBLE_PROVIDERS = ("openai", "azure", "deepseek", "siliconflow", "local")
+PROVIDERS = OPENAI_COMPATIBLE_PROVIDERS + ("anthropic", "gemini")
+
+DEFAULT_MODELS = {
+    "openai": "gpt-4o",
+    "azure": "gpt-4o-ms",
+    "deepseek": "deepseek-chat",
+    "siliconflow": "deepseek-ai/DeepSeek-R1",
+    "anthropic": "claude-3-7-sonnet-20250219",
+    "gemini": "gemini-2.0-flash-exp",
+    "local": "Qwen/Qwen2.5-32B-Instruct-AWQ",
+}
+
+_environment_loaded = False
+
+def load_environment(verbose: bool = False, force: bool = False) -> bool:
+    """
+    Load environment variables from .env files in order of precedence.
+
+    The files are only read once per process; later calls are no-ops unless
+    ``force`` is set. Diagnostics are written to stderr only when ``verbose``.
+
+    Returns:
+        bool: True if at least one .env file was loaded
+    """
+    global _environment_loaded
+    if _environment_loaded and not force:
+        return False
+    _environment_loaded = True
 
-def load_environment():
-    """Load environment variables from .env files in order of precedence"""
     # Order of precedence:
     # 1. System environment variables (already loaded)
     # 2. .env.local (user-specific overrides)
     # 3. .env (project defaults)
     # 4. .env.example (example configuration)
-    
     env_files = ['.env.local', '.env', '.env.example']
-    env_loaded = False
-    
-    print("Current working directory:", Path('.').absolute(), file=sys.stderr)
-    print("Looking for environment files:", env_files, file=sys.stderr)
-    
-    for env_file in env_files:
-        env_path = Path('.') / env_file
-        print(f"Checking {env_path.absolute()}", file=sys.stderr)
-        if env_path.exists():
-            print(f"Found {env_file}, loading variables...", file=sys.stderr)
-            load_dotenv(dotenv_path=env_path)
-            env_loaded = True
-            print(f"Loaded environment variables from {env_file}", file=sys.stderr)
+    env_paths = [Path('.') / env_file for env_file in env_files]
+    env_paths = [env_path for env_path in env_paths if env_path.exists()]
+
+    if verbose:
+        print("Current working directory:", Path('.').absolute(), file=sys.stderr)
+        print("Looking for environment files:", env_files, file=sys.stderr)
+
+    if not env_paths:
+        if verbose:
+            print("Warning: No .env files found. Using system environment variables only.", file=sys.stderr)
+        return False
+
+    from dotenv import load_dotenv
+
+    for env_path in env_paths:
+        load_dotenv(dotenv_path=env_path)
+        if verbose:
+            print(f"Loaded environment variables from {env_path.name}", file=sys.stderr)
             # Print loaded keys (but not values for security)
             with open(env_path) as f:
                 keys = [line.split('=')[0].strip() for line in f if '=' in line and not line.startswith('#')]
-                print(f"Keys loaded from {env_file}: {keys}", file=sys.stderr)
-    
-    if not env_loaded:
-        print("Warning: No .env files found. Using system environment variables only.", file=sys.stderr)
-        print("Available system environment variables:", list(os.environ.keys()), file=sys.stderr)
+                print(f"Keys loaded from {env_path.name}: {keys}", file=sys.stderr)
+    return True
+
+def _sha256(data: bytes = b""):
+    """hashlib.sha256, imported on first use since hashlib loads OpenSSL."""
+    import hashlib
+    return hashlib.sha256(data)
+
+def _provider_sdk(provider: str):
+    """Import and return the SDK module backing ``provider``."""
+    if provider in OPENAI_COMPATIBLE_PROVIDERS:
+        import openai
+        return openai
+    elif provider == "anthropic":
+        import anthropic
+        return anthropic
+    elif provider == "gemini":
+        import google.generativeai as genai
+        return genai
+    else:
+        raise ValueError(f"Unsupported provider: {provider}")
+
+# Longest image side each provider actually uses; anything larger is downscaled
+# server-side, so uploading it only costs bandwidth.
+PROVIDER_IMAGE_MAX_DIMENSION = {
+    "openai": 2048,
+    "azure": 2048,
+    "anthropic": 1568,
+    "gemini": 3072,
+}
+DEFAULT_IMAGE_MAX_DIMENSION = 2048
+IMAGE_FORMAT_MIME_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp", "png": "image/png"}
+
+@dataclass(frozen=True)
+class ImageOptions:
+    """
+    Pre-upload image processing.
+
+    Images larger than ``max_dimension`` on their longest side are downscaled,
+    and the result is re-encoded as ``format`` ("jpeg", "webp" or "png") at
+    ``quality``. With no format, resized images keep their original encoding.
+    """
+    max_dimension: Optional[int] = None
+    format: Optional[str] = None
+    quality: int = 85
 
-# Load environment variables at module import
-load_environment()
+    @classmethod
+    def for_provider(cls, provider: str, format: Optional[str] = "jpeg", quality: int = 85) -> "ImageOptions":
+        """Options that downscale to what ``provider`` uses and re-encode as ``format``."""
+        return cls(PROVIDER_IMAGE_MAX_DIMENSION.get(provider, DEFAULT_IMAGE_MAX_DIMENSION), format, quality)
 
-def encode_image_file(image_path: str) -> tuple[str, str]:
+@dataclass
+class ImagePayload:
+    """An image ready for upload, with the size savings of any pre-processing."""
+    content: bytes
+    mime_type: str
+    original_bytes: int
+    dimensions: Optional[tuple] = None
+
+    @functools.cached_property
+    def data(self) -> str:
+        """Base64-encoded content."""
+        return base64.b64encode(self.content).decode('utf-8')
+
+    @functools.cached_property
+    def sha256(self) -> str:
+        return _sha256(self.content).hexdigest()
+
+    @property
+    def encoded_bytes(self) -> int:
+        return len(self.content)
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.original_bytes - self.encoded_bytes
+
+def _file_key(path: str) -> tuple:
+    """(absolute path, size, mtime) identifying a file's current contents for memoization."""
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+def file_sha256(path: str) -> str:
+    """SHA-256 of a file's contents, memoized until the file changes."""
+    return _file_sha256(*_file_key(path))
+
+@functools.lru_cache(maxsize=256)
+def _file_sha256(path: str, size: int, mtime_ns: int) -> str:
+    digest = _sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def image_dhash(path: str) -> str:
+    """
+    256-bit difference hash of an image's appearance, memoized until the file changes.
+
+    Re-captured screenshots that render the same hash the same even when their
+    bytes differ; falls back to the content hash when Pillow is not installed.
+    """
+    return _image_dhash(*_file_key(path))
+
+@functools.lru_cache(maxsize=256)
+def _image_dhash(path: str, size: int, mtime_ns: int) -> str:
+    try:
+        from PIL import Image
+    except ImportError:
+        return _file_sha256(path, size, mtime_ns)
+    with Image.open(path) as image:
+        pixels = list(image.convert("L").resize((17, 16)).getdata())
+    bits = "".join("1" if pixels[row * 17 + col] > pixels[row * 17 + col + 1] else "0"
+                   for row in range(16) for col in range(16))
+    return f"{int(bits, 2):064x}"
+
+_pillow_warned = False
+
+def _recompress_image(content: bytes, mime_type: str, options: ImageOptions) -> tuple:
+    """Downscale and re-encode ``content``; returns (content, mime_type, dimensions)."""
+    global _pillow_warned
+    try:
+        from PIL import Image
+    except ImportError:
+        if not _pillow_warned:
+            print("Warning: Pillow is not installed; images are uploaded unprocessed.", file=sys.stderr)
+            _pillow_warned = True
+        return content, mime_type, None
+
+    image = Image.open(io.BytesIO(content))
+    resized = bool(options.max_dimension and max(image.size) > options.max_dimension)
+    if resized:
+        image.thumbnail((options.max_dimension, options.max_dimension), Image.LANCZOS)
+    target = options.format or (image.format or "png").lower()
+    if not resized and not options.format:
+        return content, mime_type, image.size
+
+    if target == "jpeg" and image.mode not in ("RGB", "L"):
+        # JPEG has no alpha channel; flatten onto white like a browser would
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        image = image.convert("RGBA")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    buffer = io.BytesIO()
+    image.save(buffer, format=target.upper(), quality=options.quality, optimize=True)
+    if not resized and buffer.tell() >= len(content):
+        return content, mime_type, image.size  # Re-encoding alone did not help
+    return buffer.getvalue(), IMAGE_FORMAT_MIME_TYPES.get(target, f"image/{target}"), image.size
+
+def prepare_image_payload(image_path: str, options: Optional[ImageOptions] = None) -> ImagePayload:
+    """
+    Read, optionally downscale/re-encode, and return an image ready for upload.
+
+    Results are memoized by (path, size, mtime, options), so asking several
+    questions about the same screenshot only processes it once.
+
+    Args:
+        image_path (str): Path to the image file
+        options (ImageOptions, optional): Pre-upload processing; None uploads the file as is
+
+    Returns:
+        ImagePayload: Content, MIME type and bytes saved by processing
+    """
+    return _prepare_image_payload(*_file_key(image_path), options)
+
+@functools.lru_cache(maxsize=16)
+def _prepare_image_payload(path: str, size: int, mtime_ns: int, options: Optional[ImageOptions]) -> ImagePayload:
+    mime_type, _ = mimetypes.guess_type(path)
+    if not mime_type:
+        mime_type = 'image/png'  # Default to PNG if type cannot be determined
+
+    with open(path, "rb") as image_file:
+        content = image_file.read()
+
+    dimensions = None
+    if options is not None and (options.max_dimension or options.format):
+        content, mime_type, dimensions = _recompress_image(content, mime_type, options)
+    return ImagePayload(content, mime_type, size, dimensions)
+
+def encode_image_file(image_path: str, options: Optional[ImageOptions] = None) -> tuple[str, str]:
     """
     Encode an image file to base64 and determine its MIME type.
     
     Args:
         image_path (str): Path to the image file
+        options (ImageOptions, optional): Downscale/re-encode before encoding
         
     Returns:
         tuple: (base64_encoded_string, mime_type)
     """
-    mime_type, _ = mimetypes.guess_type(image_path)
-    if not mime_type:
-        mime_type = 'image/png'  # Default to PNG if type cannot be determined
-        
-    with open(image_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-        
-    return encoded_string, mime_type
+    payload = prepare_image_payload(image_path, options)
+    return payload.data, payload.mime_type
 
-def create_llm_client(provider="openai"):
+# Default (base_url, api_version) per provider; None means the SDK default.
+PROVIDER_ENDPOINTS = {
+    "openai": (None, None),
+    "azure": ("https://msopenai.openai.azure.com", "2024-08-01-preview"),
+    "deepseek": ("https://api.deepseek.com/v1", None),
+    "siliconflow": ("https://api.siliconflow.cn/v1", None),
+    "anthropic": (None, None),
+    "gemini": (None, None),
+    "local": ("http://192.168.180.137:8006/v1", None),
+}
+
+def resolve_endpoint(provider: str, base_url: Optional[str] = None, api_version: Optional[str] = None) -> tuple:
+    """
+    Resolve the (base_url, api_version) a client for ``provider`` talks to.
+
+    The local endpoint can be moved with the LOCAL_LLM_BASE_URL environment variable.
+    """
+    if provider not in PROVIDER_ENDPOINTS:
+        raise ValueError(f"Unsupported provider: {provider}")
+    default_base_url, default_api_version = PROVIDER_ENDPOINTS[provider]
+    if provider == "local":
+        default_base_url = os.getenv('LOCAL_LLM_BASE_URL', default_base_url)
+    return base_url or default_base_url, api_version or default_api_version
+
+def create_llm_client(provider="openai", base_url: Optional[str] = None, api_version: Optional[str] = None, http_client=None,
+                      max_retries: Optional[int] = None):
+    """
+    Create a new client for ``provider``.
+
+    Args:
+        provider (str): The API provider to use
+        base_url (str, optional): Override the provider's default endpoint
+        api_version (str, optional): Override the API version (Azure only)
+        http_client (httpx.Client, optional): Transport to use for HTTP-based SDKs
+        max_retries (int, optional): Override the SDK's built-in retry count
+
+    Returns:
+        The SDK client (the configured ``google.generativeai`` module for Gemini)
+    """
+    load_environment()
+    sdk = _provider_sdk(provider)
+    base_url, api_version = resolve_endpoint(provider, base_url, api_version)
+    options = {"http_client": http_client}
+    if max_retries is not None:
+        options["max_retries"] = max_retries
     if provider == "openai":
         api_key = os.getenv('OPENAI_API_KEY')
         if not api_key:
             raise ValueError("OPENAI_API_KEY not found in environment variables")
-        return OpenAI(
-            api_key=api_key
+        return sdk.OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            **options
         )
     elif provider == "azure":
         api_key = os.getenv('AZURE_OPENAI_API_KEY')
         if not api_key:
             raise ValueError("AZURE_OPENAI_API_KEY not found in environment variables")
-        return AzureOpenAI(
+        return sdk.AzureOpenAI(
             api_key=api_key,
-            api_version="2024-08-01-preview",
-            azure_endpoint="https://msopenai.openai.azure.com"
+            api_version=api_version,
+            azure_endpoint=base_url,
+            **options
         )
     elif provider == "deepseek":
         api_key = os.getenv('DEEPSEEK_API_KEY')
         if not api_key:
             raise ValueError("DEEPSEEK_API_KEY not found in environment variables")
-        return OpenAI(
+        return sdk.OpenAI(
             api_key=api_key,
-            base_url="https://api.deepseek.com/v1",
+            base_url=base_url,
+            **options
         )
     elif provider == "siliconflow":
         api_key = os.getenv('SILICONFLOW_API_KEY')
         if not api_key:
             raise ValueError("SILICONFLOW_API_KEY not found in environment variables")
-        return OpenAI(
+        return sdk.OpenAI(
             api_key=api_key,
-            base_url="https://api.siliconflow.cn/v1"
+            base_url=base_url,
+            **options
         )
     elif provider == "anthropic":
         api_key = os.getenv('ANTHROPIC_API_KEY')
         if not api_key:
             raise ValueError("ANTHROPIC_API_KEY not found in environment variables")
-        return Anthropic(
-            api_key=api_key
+        return sdk.Anthropic(
+            api_key=api_key,
+            base_url=base_url,
+            **options
         )
     elif provider == "gemini":
         api_key = os.getenv('GOOGLE_API_KEY')
         if not api_key:
             raise ValueError("GOOGLE_API_KEY not found in environment variables")
-        genai.configure(api_key=api_key)
-        return genai
+        sdk.configure(api_key=api_key)
+        return sdk
     elif provider == "local":
-        return OpenAI(
-            base_url="http://192.168.180.137:8006/v1",
-            api_key="not-needed"
+        return sdk.OpenAI(
+            base_url=base_url,
+            api_key="not-needed",
+            **options
         )
+
+class ClientPool:
+    """
+    Process-wide pool of warm LLM clients keyed by (provider, base_url, api_version).
+
+    Each HTTP-based client gets its own keep-alive connection pool, so repeated
+    queries skip the TCP/TLS setup. Per-client counters track how often a client
+    was reused and how many connections and TLS handshakes it actually made.
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self, max_keepalive_connections: int = 20, keepalive_expiry: float = 120.0):
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, provider: str = "openai", base_url: Optional[str] = None, api_version: Optional[str] = None):
+        """Return the pooled client for this endpoint, creating it on first use."""
+        key = (provider, *resolve_endpoint(provider, base_url, api_version))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry["stats"]["reuses"] += 1
+                return entry["client"]
+        # Importing the SDK and building the client can take a while; do it
+        # outside the lock so other endpoints are not blocked behind it.
+        stats = {"reuses": 0, "requests": 0, "connections": 0, "tls_handshakes": 0}
+        http_client = self._build_http_client(provider, stats)
+        try:
+            # Retries are left to the ResiliencePolicy so there is a single backoff schedule
+            client = create_llm_client(provider, key[1], key[2], http_client=http_client, max_retries=0)
+        except Exception:
+            if http_client is not None:
+                http_client.close()
+            raise
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = {"client": client, "http_client": http_client, "stats": stats}
+                return client
+            entry["stats"]["reuses"] += 1
+        # Another thread won the race; keep its client and drop ours
+        if http_client is not None:
+            http_client.close()
+        return entry["client"]
+
+    def _build_http_client(self, provider: str, stats: dict):
+        if provider == "gemini":
+            return None  # The Gemini SDK manages its own transport
+        sdk = _provider_sdk(provider)
+        import httpx
+
+        def trace(event_name, info):
+            if event_name == "connection.connect_tcp.complete":
+                with self._lock:
+                    stats["connections"] += 1
+            elif event_name == "connection.start_tls.complete":
+                with self._lock:
+                    stats["tls_handshakes"] += 1
+
+        def on_request(request):
+            request.extensions["trace"] = trace
+            with self._lock:
+                stats["requests"] += 1
+            tracker = _current_tracker()
+            if tracker is not None:
+                tracker.requests += 1
+                try:
+                    tracker.request_bytes += len(request.content)
+                except httpx.RequestNotRead:
+                    pass
+
+        def on_response(response):
+            tracker = _current_tracker()
+            if tracker is not None and tracker.first_byte_at is None:
+                tracker.first_byte_at = time.monotonic()
+
+        return sdk.DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=None,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            event_hooks={"request": [on_request], "response": [on_response]},
+        )
+
+    def stats(self) -> dict:
+        """Return a snapshot of the per-client counters, keyed by 'provider|base_url|api_version'."""
+        with self._lock:
+            return {
+                "|".join(str(part or "") for part in key): dict(entry["stats"])
+                for key, entry in self._entries.items()
+            }
+
+    def close(self):
+        """Close every pooled connection and empty the pool; later calls build fresh clients."""
+        with self._lock:
+            entries, self._entries = self._entries, {}
+        for entry in entries.values():
+            if entry["http_client"] is not None:
+                entry["http_client"].close()
+
+_client_pool = ClientPool()
+atexit.register(_client_pool.close)
+
+def get_llm_client(provider="openai", base_url: Optional[str] = None, api_version: Optional[str] = None):
+    """Return a warm, shared client for ``provider`` from the process-wide pool."""
+    return _client_pool.get(provider, base_url, api_version)
+
+def client_pool_stats() -> dict:
+    """Return reuse, request, connection and TLS handshake counters per pooled client."""
+    return _client_pool.stats()
+
+def close_client_pool():
+    """Close all pooled clients. The pool stays usable and refills on demand."""
+    _client_pool.close()
+
+def default_model(provider: str) -> str:
+    """Return the model used for ``provider`` when the caller does not pick one."""
+    if provider == "azure":
+        return os.getenv('AZURE_OPENAI_MODEL_DEPLOYMENT', 'gpt-4o-ms')  # Get from env with fallback
+    if provider not in DEFAULT_MODELS:
+        raise ValueError(f"Unsupported provider: {provider}")
+    return DEFAULT_MODELS[provider]
+
+@dataclass
+class LLMRequest:
+    """
+    Everything that determines the response to one query.
+
+    ``prompt`` (and the image, if any) form the final user turn. ``history``
+    holds earlier turns as {"role": "user" | "assistant", "content": str}
+    dicts, oldest first, and ``system`` the system prompt. With
+    ``prompt_caching`` the system prompt and history are marked as a cacheable
+    prefix for providers that need explicit breakpoints (Anthropic).
+    """
+    prompt: str
+    provider: str = "openai"
+    model: Optional[str] = None
+    image_path: Optional[str] = None
+    temperature: Optional[float] = None
+    image_options: Optional[ImageOptions] = None
+    system: Optional[str] = None
+    history: tuple = ()
+    prompt_caching: bool = True
+
+    def __post_init__(self):
+        if self.model is None:
+            self.model = default_model(self.provider)
+        self.history = tuple(_history_message(message) for message in self.history or ())
+
+    @property
+    def input_text(self) -> str:
+        """All text sent to the model, for token estimates."""
+        return "\n".join([self.system or ""] + [message["content"] for message in self.history] + [self.prompt])
+
+    def image_payload(self) -> ImagePayload:
+        return prepare_image_payload(self.image_path, self.image_options)
+
+    def fingerprint(self) -> dict:
+        """The request's identity for caching: messages, sampling settings and image contents."""
+        fingerprint = {
+            "provider": self.provider,
+            "model": self.model,
+            "payload": self.prompt,
+            "temperature": float(effective_temperature(self.provider, self.temperature)),
+            "image_sha256": file_sha256(self.image_path) if self.image_path else None,
+            "image_options": asdict(self.image_options) if self.image_path and self.image_options else None,
+        }
+        # Only present when used, so single-prompt requests keep their existing cache keys
+        if self.system:
+            fingerprint["system"] = self.system
+        if self.history:
+            fingerprint["history"] = [[message["role"], message["content"]] for message in self.history]
+        return fingerprint
+
+def _history_message(message) -> dict:
+    """Validate one earlier conversation turn."""
+    if not isinstance(message, dict) or message.get("role") not in ("user", "assistant") \
+            or not isinstance(message.get("content"), str):
+        raise ValueError(f"History messages must be {{'role': 'user' | 'assistant', 'content': str}} dicts, got {message!r}")
+    return {"role": message["role"], "content": message["content"]}
+
+def split_messages(messages: Iterable[dict]) -> tuple:
+    """
+    Split an OpenAI-style message list into (system, history, prompt).
+
+    Leading "system" messages are joined into the system prompt and the last
+    message, which must come from the user, becomes the prompt.
+    """
+    messages = list(messages)
+    system = []
+    while messages and messages[0].get("role") == "system":
+        system.append(messages.pop(0)["content"])
+    if not messages or messages[-1].get("role") != "user":
+        raise ValueError("The last message must be a user message")
+    return "\n\n".join(system) or None, tuple(messages[:-1]), messages[-1]["content"]
+
+# Anthropic only caches prefixes that end in an explicit breakpoint.
+ANTHROPIC_CACHE_CONTROL = {"type": "ephemeral"}
+
+def _openai_request(request: LLMRequest) -> dict:
+    """
+    Build the chat.completions.create arguments for an OpenAI-compatible provider.
+
+    OpenAI and DeepSeek cache long prompt prefixes automatically, so the stable
+    parts (system prompt, then history) go first and the new turn last.
+    """
+    messages = [{"role": "user", "content": []}]
+    
+    # Add text content
+    messages[0]["content"].append({
+        "type": "text",
+        "text": request.prompt
+    })
+    
+    # Add image content if provided
+    if request.image_path:
+        if request.provider == "openai":
+            image = request.image_payload()
+            messages[0]["content"] = [
+                {"type": "text", "text": request.prompt},
+                {"type": "image_url", "image_url": {"url": f"data:{image.mime_type};base64,{image.data}"}}
+            ]
+
+    messages = [dict(message) for message in request.history] + messages
+    if request.system:
+        messages.insert(0, {"role": "system", "content": request.system})
+    
+    kwargs = {
+        "model": request.model,
+        "messages": messages,
+        "temperature": effective_temperature(request.provider, request.temperature),
+    }
+    
+    # Add o1-specific parameters
+    if request.model == "o1":
+        kwargs["response_format"] = {"type": "text"}
+        kwargs["reasoning_effort"] = "low"
+        del kwargs["temperature"]
+    return kwargs
+
+def _anthropic_request(request: LLMRequest) -> dict:
+    """Build the messages.create arguments for Anthropic."""
+    messages = [{"role": "user", "content": []}]
+    
+    # Add text content
+    messages[0]["content"].append({
+        "type": "text",
+        "text": request.prompt
+    })
+    
+    # Add image content if provided
+    if request.image_path:
+        image = request.image_payload()
+        messages[0]["content"].append({
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": image.mime_type,
+                "data": image.data
+            }
+        })
+    
+    history = [{"role": message["role"], "content": [{"type": "text", "text": message["content"]}]}
+               for message in request.history]
+    kwargs = {
+        "model": request.model,
+        "max_tokens": 1000,
+        "messages": history + messages,
+    }
+    if request.system:
+        kwargs["system"] = [{"type": "text", "text": request.system}]
+    if request.temperature is not None:
+        kwargs["temperature"] = request.temperature
+
+    # Breakpoints after the system prompt and after the last earlier turn let
+    # repeated calls read that prefix from Anthropic's prompt cache.
+    if request.prompt_caching:
+        if request.system:
+            kwargs["system"][-1]["cache_control"] = ANTHROPIC_CACHE_CONTROL
+        if history:
+            history[-1]["content"][-1]["cache_control"] = ANTHROPIC_CACHE_CONTROL
+    return kwargs
+
+@dataclass
+class LLMResponse:
+    """Response text plus normalised token usage (input, output and cached input tokens)."""
+    text: str
+    provider: str
+    model: str
+    usage: dict = field(default_factory=dict)
+    cached: bool = False
+    similarity: Optional[float] = None  # Set when served from the semantic cache
+
+def _usage(provider: str, response) -> dict:
+    """
+    Normalise a provider response's token accounting into one dict shape.
+
+    ``input_tokens`` always counts the whole prompt; ``cached_tokens`` is the
+    part read from the provider's prompt cache and ``cache_write_tokens`` the
+    part written to it (Anthropic only).
+    """
+    usage = {"input_tokens": 0, "output_tokens": 0, "cached_tokens": 0, "cache_write_tokens": 0}
+    if provider in OPENAI_COMPATIBLE_PROVIDERS and getattr(response, "usage", None):
+        usage["input_tokens"] = response.usage.prompt_tokens or 0
+        usage["output_tokens"] = response.usage.completion_tokens or 0
+        details = getattr(response.usage, "prompt_tokens_details", None)
+        # DeepSeek reports its context cache hits under its own name
+        usage["cached_tokens"] = (getattr(details, "cached_tokens", None)
+                                  or getattr(response.usage, "prompt_cache_hit_tokens", None) or 0)
+    elif provider == "anthropic" and getattr(response, "usage", None):
+        # Anthropic's input_tokens excludes the tokens read from or written to the cache
+        usage["cached_tokens"] = getattr(response.usage, "cache_read_input_tokens", None) or 0
+        usage["cache_write_tokens"] = getattr(response.usage, "cache_creation_input_tokens", None) or 0
+        usage["input_tokens"] = (response.usage.input_tokens or 0) + usage["cached_tokens"] + usage["cache_write_tokens"]
+        usage["output_tokens"] = response.usage.output_tokens or 0
+    elif provider == "gemini" and getattr(response, "usage_metadata", None):
+        usage["input_tokens"] = response.usage_metadata.prompt_token_count or 0
+        usage["output_tokens"] = response.usage_metadata.candidates_token_count or 0
+        usage["cached_tokens"] = response.usage_metadata.cached_content_token_count or 0
+    return usage
+
+# Gemini deletes uploaded files after 48 hours; stop reusing them a little earlier.
+GEMINI_FILE_TTL = 47 * 3600
+_gemini_files = {}
+_gemini_files_lock = threading.Lock()
+
+def _gemini_upload(client, request: LLMRequest):
+    """
+    Upload the request's image to Gemini's file store, reusing earlier uploads.
+
+    Uploaded file handles are cached by content hash until shortly before they
+    expire, so asking several questions about one image uploads it once.
+    """
+    image = request.image_payload()
+    now = time.time()
+    with _gemini_files_lock:
+        cached = _gemini_files.get(image.sha256)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+    file = client.upload_file(io.BytesIO(image.content), mime_type=image.mime_type)
+    expires_at = now + GEMINI_FILE_TTL
+    expiration_time = getattr(file, "expiration_time", None)
+    if expiration_time is not None:
+        expires_at = min(expires_at, expiration_time.timestamp() - 300)
+    with _gemini_files_lock:
+        _gemini_files[image.sha256] = (file, expires_at)
+    return file
+
+def _gemini_parts(client, request: LLMRequest) -> list:
+    parts = [request.prompt]
+    if request.image_path:
+        parts.insert(0, _gemini_upload(client, request))
+    if not request.history:
+        return parts
+    contents = [{"role": "model" if message["role"] == "assistant" else "user", "parts": [message["content"]]}
+                for message in request.history]
+    return contents + [{"role": "user", "parts": parts}]
+
+def _gemini_model(client, request: LLMRequest):
+    return client.GenerativeModel(request.model, system_instruction=request.system or None)
+
+def _gemini_generation_config(request: LLMRequest) -> Optional[dict]:
+    return {"temperature": request.temperature} if request.temperature is not None else None
+
+def _complete(request: LLMRequest, client) -> LLMResponse:
+    """Send one request and return the response with its token usage, raising on any error."""
+    provider = request.provider
+    if provider in OPENAI_COMPATIBLE_PROVIDERS:
+        response = client.chat.completions.create(**_openai_request(request))
+        text = response.choices[0].message.content
+        
+    elif provider == "anthropic":
+        response = client.messages.create(**_anthropic_request(request))
+        text = response.content[0].text
+        
+    elif provider == "gemini":
+        # A single generate_content call sends the prompt exactly once
+        model = _gemini_model(client, request)
+        response = model.generate_content(
+            _gemini_parts(client, request),
+            generation_config=_gemini_generation_config(request),
+        )
+        text = response.text
     else:
         raise ValueError(f"Unsupported provider: {provider}")
+    return LLMResponse(text, provider, request.model, _usage(provider, response))
+
+# Temperature each provider samples at when the caller does not set one.
+DEFAULT_TEMPERATURE = 0.7  # What query_llm sends to OpenAI-compatible providers
+SDK_DEFAULT_TEMPERATURE = 1.0  # Anthropic and Gemini API default
+
+def effective_temperature(provider: str, temperature: Optional[float] = None) -> float:
+    """Return the sampling temperature a request to ``provider`` will actually use."""
+    if temperature is not None:
+        return temperature
+    return DEFAULT_TEMPERATURE if provider in OPENAI_COMPATIBLE_PROVIDERS else SDK_DEFAULT_TEMPERATURE
+
+class ResponseCache:
+    """
+    Persistent, content-addressed cache of LLM responses backed by SQLite.
+
+    Entries are keyed on a hash of the provider, model, full message payload,
+    temperature and attached image contents. They expire after ``ttl`` seconds,
+    and the least recently used entries are evicted once the stored responses
+    exceed ``max_bytes``. SQLite's WAL mode and busy timeout make the cache safe
+    to share between threads and between processes.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, ttl: Optional[float] = 7 * 24 * 3600, max_bytes: int = 256 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir or os.getenv('LLM_API_CACHE_DIR') or Path.home() / ".cache" / "llm_api")
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.cache_dir / "responses.sqlite3"
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, provider TEXT, model TEXT, response TEXT NOT NULL,"
+                " size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+            db.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+            db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            # Running total of the stored response sizes, so puts never have to SUM the table
+            db.execute("INSERT OR IGNORE INTO counters (name, value) SELECT 'bytes', COALESCE(SUM(size), 0) FROM responses")
+
+    def _connect(self) -> "sqlite3.Connection":
+        db = getattr(self._local, "db", None)
+        if db is None:
+            import sqlite3
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Run a block as one write transaction.
+
+        The connection is in autocommit mode, so ``with db:`` would not open a
+        transaction; BEGIN IMMEDIATE takes the write lock up front, which makes
+        read-modify-write sequences atomic across threads and processes.
+        """
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    @staticmethod
+    def make_key(request: "LLMRequest") -> str:
+        """Hash everything that determines a response into a cache key."""
+        material = json.dumps(request.fingerprint(), sort_keys=True, ensure_ascii=False)
+        return _sha256(material.encode("utf-8")).hexdigest()
+
+    def _count(self, db, name: str, amount: int = 1):
+        db.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount),
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response for ``key``, or None on a miss or expired entry."""
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute("SELECT response, created_at, size FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._count(db, "bytes", -row[2])
+                row = None
+            if row is None:
+                self.misses += 1
+                self._count(db, "misses")
+                return None
+            db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            self._count(db, "hits")
+            return row[0]
+
+    def put(self, key: str, response: str, provider: Optional[str] = None, model: Optional[str] = None):
+        """Store ``response`` under ``key`` and evict old entries if the cache is over budget."""
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with self._transaction() as db:
+            previous = db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO responses (key, provider, model, response, size, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, provider, model, response, size, now, now),
+            )
+            self._count(db, "bytes", size - (previous[0] if previous else 0))
+            self._evict(db)
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones until under ``max_bytes``."""
+        with self._transaction() as db:
+            self._evict(db)
+
+    def _evict(self, db):
+        if self.ttl is not None:
+            cutoff = time.time() - self.ttl
+            expired = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses WHERE created_at < ?", (cutoff,)).fetchone()[0]
+            if expired:
+                db.execute("DELETE FROM responses WHERE created_at < ?", (cutoff,))
+                self._count(db, "bytes", -expired)
+        total = db.execute("SELECT value FROM counters WHERE name = 'bytes'").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Trim to 90% of the budget so eviction does not run on every put
+        excess = total - int(self.max_bytes * 0.9)
+        removed = 0
+        while removed < excess:
+            oldest = db.execute("SELECT key, size FROM responses ORDER BY accessed_at LIMIT 256").fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                if removed >= excess:
+                    break
+                db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                removed += size
+        self._count(db, "bytes", -removed)
+
+    def stats(self) -> dict:
+        """Return hit/miss counts for this instance and for the cache's whole lifetime."""
+        db = self._connect()
+        counters = dict(db.execute("SELECT name, value FROM counters").fetchall())
+        entries = db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "total_hits": counters.get("hits", 0),
+            "total_misses": counters.get("misses", 0),
+            "entries": entries,
+            "bytes": counters.get("bytes", 0),
+        }
+
+    def clear(self):
+        """Remove every entry and reset the counters."""
+        with self._transaction() as db:
+            db.execute("DELETE FROM responses")
+            db.execute("DELETE FROM counters")
+            db.execute("INSERT INTO counters (name, value) VALUES ('bytes', 0)")
+        self.hits = self.misses = 0
+
+_response_caches = {}
+_response_caches_lock = threading.Lock()
+
+def get_response_cache(cache_dir: Optional[str] = None) -> ResponseCache:
+    """Return the shared ResponseCache for ``cache_dir`` (the default directory if None)."""
+    key = os.path.abspath(os.path.expanduser(cache_dir)) if cache_dir is not None else None
+    with _response_caches_lock:
+        if key not in _response_caches:
+            _response_caches[key] = ResponseCache(key)
+        return _response_caches[key]
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("The semantic cache needs numpy: pip install numpy") from None
+    return numpy
+
+def hashed_ngram_embedding(text: str, dimensions: int = 256):
+    """
+    Cheap local text embedding for the semantic cache.
+
+    Words and their character trigrams are hashed into ``dimensions`` signed
+    buckets and the vector is L2-normalised. Case, punctuation, whitespace and
+    word order barely move it, so near-identical prompts land close together.
+
+    Returns:
+        numpy.ndarray: float32 vector of length ``dimensions``
+    """
+    np = _numpy()
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for word in re.findall(r"\w+", text.lower()):
+        features = [word] + [word[i:i + 3] for i in range(len(word) - 2)]
+        for feature in features:
+            digest = zlib.crc32(feature.encode("utf-8"))
+            vector[digest % dimensions] += 1.0 if digest & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class SemanticCache:
+    """
+    Opt-in near-duplicate response cache.
+
+    Prompts are embedded with ``embed`` (hashed_ngram_embedding by default) and
+    stored in a fixed-size float16 NumPy matrix memory-mapped from disk; the
+    responses and bookkeeping live in SQLite next to it. A lookup only
+    considers entries whose request matches exactly apart from the prompt
+    (provider, model, system prompt, history, temperature and image appearance)
+    and returns the most similar one if its cosine similarity reaches the
+    threshold. Entries expire after ``ttl`` seconds; once ``max_entries`` are
+    stored, the least recently used slot is reused.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, threshold: float = 0.95, max_entries: int = 10000,
+                 ttl: Optional[float] = 7 * 24 * 3600, embed=None):
+        np = _numpy()
+        self.cache_dir = Path(cache_dir or os.getenv('LLM_API_CACHE_DIR') or Path.home() / ".cache" / "llm_api")
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.cache_dir / "semantic.sqlite3"
+        self.vectors_path = self.cache_dir / "semantic_vectors.npy"
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.embed = embed or hashed_ngram_embedding
+        self.dimensions = len(self.embed("dimension probe"))
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        embedding = f"{getattr(self.embed, '__module__', '')}.{getattr(self.embed, '__qualname__', repr(self.embed))}"
+        # The last element versions the schema: indexes written before free_slots existed are rebuilt
+        layout = json.dumps([embedding, self.dimensions, max_entries, 2])
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " slot INTEGER PRIMARY KEY, scope TEXT NOT NULL, prompt TEXT NOT NULL, response TEXT NOT NULL,"
+                " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS entries_scope ON entries (scope)")
+            db.execute("CREATE INDEX IF NOT EXISTS entries_created_at ON entries (created_at)")
+            db.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+            db.execute("CREATE TABLE IF NOT EXISTS free_slots (slot INTEGER PRIMARY KEY)")
+            db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            row = db.execute("SELECT value FROM meta WHERE name = 'layout'").fetchone()
+            if row is None or row[0] != layout or not self.vectors_path.exists():
+                # A different embedding or capacity makes the stored vectors meaningless
+                self._reset_slots(db)
+                db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('layout', ?)", (layout,))
+                np.lib.format.open_memmap(self.vectors_path, mode="w+", dtype=np.float16,
+                                          shape=(max_entries, self.dimensions)).flush()
+        self.vectors = np.lib.format.open_memmap(self.vectors_path, mode="r+")
+
+    def _connect(self) -> "sqlite3.Connection":
+        db = getattr(self._local, "db", None)
+        if db is None:
+            import sqlite3
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Run a block as one write transaction (BEGIN IMMEDIATE; the connection is in autocommit mode)."""
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _reset_slots(self, db):
+        db.execute("DELETE FROM entries")
+        db.execute("DELETE FROM free_slots")
+        db.execute(
+            "WITH RECURSIVE slots(slot) AS (SELECT 0 UNION ALL SELECT slot + 1 FROM slots WHERE slot + 1 < ?)"
+            " INSERT INTO free_slots (slot) SELECT slot FROM slots",
+            (self.max_entries,),
+        )
+
+    @staticmethod
+    def make_scope(request: "LLMRequest") -> str:
+        """Hash everything except the prompt that determines a response."""
+        fingerprint = request.fingerprint()
+        del fingerprint["payload"]
+        if request.image_path:
+            fingerprint["image_sha256"] = image_dhash(request.image_path)
+        material = json.dumps(fingerprint, sort_keys=True, ensure_ascii=False)
+        return _sha256(material.encode("utf-8")).hexdigest()
+
+    def _count(self, db, name: str):
+        db.execute(
+            "INSERT INTO counters (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def get(self, request: "LLMRequest", threshold: Optional[float] = None) -> Optional[tuple]:
+        """
+        Find a cached response to a prompt similar to ``request.prompt``.
+
+        Returns:
+            Optional[tuple]: (response text, similarity), or None on a miss
+        """
+        np = _numpy()
+        threshold = self.threshold if threshold is None else threshold
+        query = np.asarray(self.embed(request.prompt), dtype=np.float32)
+        db = self._connect()
+        cutoff = time.time() - self.ttl if self.ttl is not None else 0.0
+        rows = db.execute("SELECT slot, response FROM entries WHERE scope = ? AND created_at >= ?",
+                          (self.make_scope(request), cutoff)).fetchall()
+        best = None
+        if rows:
+            with self._lock:
+                candidates = self.vectors[[slot for slot, _ in rows]].astype(np.float32)
+            similarities = candidates @ query
+            index = int(np.argmax(similarities))
+            if similarities[index] >= threshold:
+                best = rows[index][0], rows[index][1], min(float(similarities[index]), 1.0)
+        with self._transaction() as db:
+            if best is None:
+                self.misses += 1
+                self._count(db, "misses")
+                return None
+            db.execute("UPDATE entries SET accessed_at = ? WHERE slot = ?", (time.time(), best[0]))
+            self.hits += 1
+            self._count(db, "hits")
+        return best[1], best[2]
+
+    def put(self, request: "LLMRequest", response: str):
+        """Index ``response`` under the request's prompt, reusing an expired or least recently used slot when full."""
+        np = _numpy()
+        vector = np.asarray(self.embed(request.prompt), dtype=np.float16)
+        now = time.time()
+        # BEGIN IMMEDIATE serialises slot allocation across processes
+        with self._transaction() as db:
+            if self.ttl is not None:
+                cutoff = now - self.ttl
+                db.execute("INSERT OR IGNORE INTO free_slots (slot) SELECT slot FROM entries WHERE created_at < ?",
+                           (cutoff,))
+                db.execute("DELETE FROM entries WHERE created_at < ?", (cutoff,))
+            row = db.execute("SELECT slot FROM free_slots LIMIT 1").fetchone()
+            if row is not None:
+                slot = row[0]
+                db.execute("DELETE FROM free_slots WHERE slot = ?", (slot,))
+            else:
+                slot = db.execute("SELECT slot FROM entries ORDER BY accessed_at LIMIT 1").fetchone()[0]
+            with self._lock:
+                self.vectors[slot] = vector
+                self.vectors.flush()
+            db.execute(
+                "INSERT OR REPLACE INTO entries (slot, scope, prompt, response, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (slot, self.make_scope(request), request.prompt, response, now, now),
+            )
+
+    def stats(self) -> dict:
+        """Return hit/miss counts for this instance and for the index's whole lifetime."""
+        db = self._connect()
+        counters = dict(db.execute("SELECT name, value FROM counters").fetchall())
+        entries = db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        lookups = self.hits + self.misses
+        total_lookups = counters.get("hits", 0) + counters.get("misses", 0)
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "total_hits": counters.get("hits", 0),
+            "total_misses": counters.get("misses", 0),
+            "total_hit_rate": counters.get("hits", 0) / total_lookups if total_lookups else 0.0,
+            "entries": entries,
+            "capacity": self.max_entries,
+        }
+
+    def clear(self):
+        """Remove every entry and reset the counters."""
+        with self._transaction() as db:
+            self._reset_slots(db)
+            db.execute("DELETE FROM counters")
+        self.hits = self.misses = 0
+
+_semantic_caches = {}
+
+def get_semantic_cache(cache_dir: Optional[str] = None) -> SemanticCache:
+    """Return the shared SemanticCache for ``cache_dir`` (the default directory if None)."""
+    key = os.path.abspath(os.path.expanduser(cache_dir)) if cache_dir is not None else None
+    with _response_caches_lock:
+        if key not in _semantic_caches:
+            _semantic_caches[key] = SemanticCache(key)
+        return _semantic_caches[key]
+
+# USD per million tokens: (input, cached input, output). Matched by longest model-name prefix.
+MODEL_PRICING = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "o1-mini": (1.10, 0.55, 4.40),
+    "o1": (15.00, 7.50, 60.00),
+    "claude-3-5-haiku": (0.80, 0.08, 4.00),
+    "claude-3-7-sonnet": (3.00, 0.30, 15.00),
+    "claude-3-5-sonnet": (3.00, 0.30, 15.00),
+    "claude-3-opus": (15.00, 1.50, 75.00),
+    "gemini-2.0-flash": (0.10, 0.025, 0.40),
+    "gemini-1.5-pro": (1.25, 0.3125, 5.00),
+    "deepseek-chat": (0.27, 0.07, 1.10),
+    "deepseek-reasoner": (0.55, 0.14, 2.19),
+    "deepseek-ai/DeepSeek-R1": (0.55, 0.14, 2.19),
+}
+# Writing a prefix to Anthropic's prompt cache costs this much more than plain input.
+CACHE_WRITE_PRICE_MULTIPLIER = 1.25
+
+def estimate_cost(provider: str, model: str, usage: dict) -> Optional[float]:
+    """Estimate the USD cost of a call from its token usage; None if the model is not priced."""
+    if provider == "local":
+        return 0.0
+    prefixes = [prefix for prefix in MODEL_PRICING if model.startswith(prefix)]
+    if not prefixes:
+        return None
+    input_price, cached_price, output_price = MODEL_PRICING[max(prefixes, key=len)]
+    cached = usage.get("cached_tokens", 0)
+    written = usage.get("cache_write_tokens", 0)
+    uncached = max(usage.get("input_tokens", 0) - cached - written, 0)
+    return (uncached * input_price + cached * cached_price + written * input_price * CACHE_WRITE_PRICE_MULTIPLIER
+            + usage.get("output_tokens", 0) * output_price) / 1e6
+
+@dataclass
+class CallMetrics:
+    """Structured record of one query, emitted to every registered metrics sink."""
+    timestamp: float
+    provider: str
+    model: str
+    latency: float
+    time_to_first_byte: Optional[float] = None
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+    cache_write_tokens: int = 0
+    retries: int = 0
+    hedged: bool = False
+    payload_bytes: Optional[int] = None
+    cache_hit: bool = False
+    semantic_hit: bool = False
+    cost_usd: Optional[float] = None
+    streamed: bool = False
+    error: Optional[str] = None
+
+class _CallTracker:
+    """Per-call transport counters, filled in by the pooled clients' HTTP hooks."""
+    __slots__ = ("requests", "request_bytes", "first_byte_at", "hedged", "hedge_requests")
+
+    def __init__(self):
+        self.requests = 0
+        self.request_bytes = 0
+        self.first_byte_at = None
+        self.hedged = False
+        self.hedge_requests = 0  # Part of ``requests`` made by the hedge leg
+
+    @property
+    def retries(self) -> int:
+        """Repeated requests within each leg; the hedge's first request is not a retry."""
+        primary = self.requests - self.hedge_requests
+        return max(primary - 1, 0) + max(self.hedge_requests - 1, 0)
+
+    def merge(self, leg: "_CallTracker", hedge: bool = False):
+        """Fold the counters of one hedge leg, tracked on its own thread, into this call."""
+        self.requests += leg.requests
+        self.request_bytes += leg.request_bytes
+        if leg.first_byte_at is not None and (self.first_byte_at is None or leg.first_byte_at < self.first_byte_at):
+            self.first_byte_at = leg.first_byte_at
+        if hedge:
+            self.hedged = True
+            self.hedge_requests += leg.requests
+
+_call_context = threading.local()
+
+@contextlib.contextmanager
+def _track_call():
+    """Route HTTP hook observations made on this thread to a fresh _CallTracker."""
+    tracker = _CallTracker()
+    previous = getattr(_call_context, "tracker", None)
+    _call_context.tracker = tracker
+    try:
+        yield tracker
+    finally:
+        _call_context.tracker = previous
+
+def _current_tracker() -> Optional[_CallTracker]:
+    return getattr(_call_context, "tracker", None)
+
+class JsonlMetricsSink:
+    """Append each CallMetrics as one JSON line; safe for concurrent writers."""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def emit(self, metrics: CallMetrics):
+        line = json.dumps(asdict(metrics)) + "\n"
+        with self._lock:
+            # One write per record on an O_APPEND file keeps lines intact across processes
+            with open(self.path, "a") as f:
+                f.write(line)
+
+class PrometheusTextfileSink:
+    """
+    Aggregate calls into Prometheus metrics and rewrite ``path`` in the text
+    exposition format after every call (for node_exporter's textfile collector).
+    Counters cover this process's lifetime, so point long-running processes at it.
+    """
+
+    LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 30, 60, 120)
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def emit(self, metrics: CallMetrics):
+        labels = (metrics.provider, metrics.model)
+        with self._lock:
+            series = self._series.setdefault(labels, {
+                "requests": 0, "errors": 0, "cache_hits": 0, "semantic_hits": 0, "retries": 0, "hedged": 0, "cost": 0.0,
+                "input_tokens": 0, "output_tokens": 0, "cached_tokens": 0,
+                "latency_sum": 0.0, "buckets": [0] * len(self.LATENCY_BUCKETS),
+            })
+            series["requests"] += 1
+            series["errors"] += metrics.error is not None
+            series["cache_hits"] += metrics.cache_hit
+            series["semantic_hits"] += metrics.semantic_hit
+            series["retries"] += metrics.retries
+            series["hedged"] += metrics.hedged
+            series["cost"] += metrics.cost_usd or 0.0
+            for kind in ("input_tokens", "output_tokens", "cached_tokens"):
+                series[kind] += getattr(metrics, kind)
+            series["latency_sum"] += metrics.latency
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if metrics.latency <= bound:
+                    series["buckets"][i] += 1
+            text = self.render()
+        tmp_path = self.path.with_name(self.path.name + f".{os.getpid()}.tmp")
+        tmp_path.write_text(text)
+        os.replace(tmp_path, self.path)
+
+    def render(self) -> str:
+        """Return all series in the Prometheus text format."""
+        lines = [
+            "# HELP llm_requests_total LLM queries by provider and model.",
+            "# TYPE llm_requests_total counter",
+        ]
+        rows = sorted(self._series.items())
+        def label(provider, model, **extra):
+            pairs = {"provider": provider, "model": model, **extra}
+            return ",".join(f'{name}="{value}"' for name, value in pairs.items())
+        for (provider, model), series in rows:
+            lines.append(f"llm_requests_total{{{label(provider, model)}}} {series['requests']}")
+        for name, key, kind, help_text in (
+            ("llm_errors_total", "errors", "counter", "LLM queries that failed."),
+            ("llm_cache_hits_total", "cache_hits", "counter", "LLM queries served from the response cache."),
+            ("llm_semantic_cache_hits_total", "semantic_hits", "counter", "Cache hits answered by a near-identical prompt."),
+            ("llm_retries_total", "retries", "counter", "HTTP retries made while answering LLM queries."),
+            ("llm_hedged_total", "hedged", "counter", "LLM queries that sent a hedge request."),
+            ("llm_cost_usd_total", "cost", "counter", "Estimated spend in USD."),
+        ):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for (provider, model), series in rows:
+                lines.append(f"{name}{{{label(provider, model)}}} {series[key]}")
+        lines += ["# HELP llm_tokens_total Tokens processed by kind.", "# TYPE llm_tokens_total counter"]
+        for (provider, model), series in rows:
+            for kind in ("input", "output", "cached"):
+                lines.append(f"llm_tokens_total{{{label(provider, model, kind=kind)}}} {series[kind + '_tokens']}")
+        lines += ["# HELP llm_request_latency_seconds Wall latency of LLM queries.", "# TYPE llm_request_latency_seconds histogram"]
+        for (provider, model), series in rows:
+            for bound, count in zip(self.LATENCY_BUCKETS, series["buckets"]):
+                lines.append(f"llm_request_latency_seconds_bucket{{{label(provider, model, le=bound)}}} {count}")
+            lines.append(f"llm_request_latency_seconds_bucket{{{label(provider, model, le='+Inf')}}} {series['requests']}")
+            lines.append(f"llm_request_latency_seconds_sum{{{label(provider, model)}}} {series['latency_sum']}")
+            lines.append(f"llm_request_latency_seconds_count{{{label(provider, model)}}} {series['requests']}")
+        return "\n".join(lines) + "\n"
 
-def query_llm(prompt: str, client=None, model=None, provider="openai", image_path: Optional[str] = None) -> Optional[str]:
+_metrics_sinks = []
+
+def add_metrics_sink(sink):
+    """Register a sink; any object with an ``emit(CallMetrics)`` method works."""
+    _metrics_sinks.append(sink)
+    return sink
+
+def remove_metrics_sink(sink):
+    if sink in _metrics_sinks:
+        _metrics_sinks.remove(sink)
+
+def _emit_metrics(request: LLMRequest, started: float, tracker: Optional[_CallTracker], response: Optional[LLMResponse] = None,
+                  error: Optional[BaseException] = None, time_to_first_byte: Optional[float] = None, streamed: bool = False):
+    if not _metrics_sinks:
+        return
+    usage = response.usage if response is not None else {}
+    if time_to_first_byte is None and tracker is not None and tracker.first_byte_at is not None:
+        time_to_first_byte = tracker.first_byte_at - started
+    metrics = CallMetrics(
+        timestamp=time.time(),
+        provider=request.provider,
+        model=request.model,
+        latency=time.monotonic() - started,
+        time_to_first_byte=time_to_first_byte,
+        input_tokens=usage.get("input_tokens", 0),
+        output_tokens=usage.get("output_tokens", 0),
+        cached_tokens=usage.get("cached_tokens", 0),
+        cache_write_tokens=usage.get("cache_write_tokens", 0),
+        retries=tracker.retries if tracker is not None else 0,
+        hedged=tracker is not None and tracker.hedged,
+        payload_bytes=tracker.request_bytes if tracker is not None and tracker.requests else None,
+        cache_hit=bool(response is not None and response.cached),
+        semantic_hit=bool(response is not None and response.similarity is not None),
+        cost_usd=0.0 if response is not None and response.cached else estimate_cost(request.provider, request.model, usage),
+        streamed=streamed,
+        error=type(error).__name__ if error is not None else None,
+    )
+    for sink in list(_metrics_sinks):
+        try:
+            sink.emit(metrics)
+        except Exception as e:
+            print(f"Warning: metrics sink {type(sink).__name__} failed: {e}", file=sys.stderr)
+
+def _percentile(sorted_values: list, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(int(math.ceil(fraction * len(sorted_values))) - 1, 0)
+    return sorted_values[index]
+
+def summarize_metrics(paths: Iterable[str]) -> dict:
+    """
+    Summarise JSONL metrics files per (provider, model).
+
+    Returns:
+        dict: {(provider, model): {"calls", "errors", "cache_hits", "semantic_hits", "p50",
+        "p95", "p99", "input_tokens", "output_tokens", "cost_usd"}}
+    """
+    groups = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    groups.setdefault((record["provider"], record["model"]), []).append(record)
+
+    summary = {}
+    for key, records in sorted(groups.items()):
+        latencies = sorted(record["latency"] for record in records if not record.get("error"))
+        summary[key] = {
+            "calls": len(records),
+            "errors": sum(1 for record in records if record.get("error")),
+            "cache_hits": sum(1 for record in records if record.get("cache_hit")),
+            "semantic_hits": sum(1 for record in records if record.get("semantic_hit")),
+            "p50": _percentile(latencies, 0.50) if latencies else None,
+            "p95": _percentile(latencies, 0.95) if latencies else None,
+            "p99": _percentile(latencies, 0.99) if latencies else None,
+            "input_tokens": sum(record.get("input_tokens", 0) for record in records),
+            "output_tokens": sum(record.get("output_tokens", 0) for record in records),
+            "cost_usd": sum(record.get("cost_usd") or 0.0 for record in records),
+        }
+    return summary
+
+def format_metrics_summary(summary: dict) -> str:
+    """Render summarize_metrics output as a fixed-width table."""
+    def seconds(value):
+        return f"{value:.2f}s" if value is not None else "-"
+    lines = [f"{'provider':<12} {'model':<32} {'calls':>6} {'errors':>6} {'hits':>5} "
+             f"{'p50':>7} {'p95':>7} {'p99':>7} {'in tok':>9} {'out tok':>9} {'cost $':>9}"]
+    for (provider, model), row in summary.items():
+        lines.append(
+            f"{provider:<12} {model[:32]:<32} {row['calls']:>6} {row['errors']:>6} {row['cache_hits']:>5} "
+            f"{seconds(row['p50']):>7} {seconds(row['p95']):>7} {seconds(row['p99']):>7} "
+            f"{row['input_tokens']:>9} {row['output_tokens']:>9} {row['cost_usd']:>9.4f}"
+        )
+    return "\n".join(lines)
+
+# HTTP statuses worth retrying: timeouts, conflicts, rate limits, server errors and Anthropic's 529 "overloaded".
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+# Transport-level failures by class name, so classification does not import any SDK.
+RETRYABLE_ERROR_NAMES = {
+    "APIConnectionError", "APITimeoutError", "InternalServerError", "RateLimitError", "OverloadedError",
+    "ConnectError", "ReadError", "ReadTimeout", "ConnectTimeout", "WriteTimeout", "PoolTimeout",
+    "RemoteProtocolError", "TimeoutException", "TransportError",
+    "ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded", "TooManyRequests",
+    "TimeoutError", "ConnectionError",
+}
+
+class CircuitOpenError(RuntimeError):
+    """Raised without calling the provider while its circuit breaker is open."""
+
+def _error_status(error: BaseException) -> Optional[int]:
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is None and isinstance(getattr(error, "code", None), int):
+        status = error.code  # google.api_core exceptions
+    return status if isinstance(status, int) else None
+
+def is_retryable(error: BaseException) -> bool:
+    """Classify an exception from any provider SDK as retryable (True) or fatal (False)."""
+    if isinstance(error, CircuitOpenError):
+        return False
+    status = _error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """Seconds the server asked us to wait (Retry-After / retry-after-ms headers), if any."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            import email.utils
+            when = email.utils.parsedate_to_datetime(value)
+            return max(when.timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+@dataclass
+class RetryPolicy:
+    """Exponential backoff with full jitter; a server's Retry-After takes precedence."""
+    max_attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 30.0
+    jitter: bool = True
+    respect_retry_after: bool = True
+
+    def delay(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        """Seconds to wait before retry number ``attempt`` (1-based)."""
+        if self.respect_retry_after and error is not None:
+            requested = retry_after(error)
+            if requested is not None:
+                return min(requested, self.max_delay)
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, backoff) if self.jitter else backoff
+
+class CircuitBreaker:
+    """
+    Per-provider circuit breaker.
+
+    After ``failure_threshold`` consecutive retryable failures the circuit opens
+    and calls fail fast with CircuitOpenError. Once ``reset_timeout`` seconds
+    have passed a single trial call is let through (half-open); success closes
+    the circuit, a retryable failure re-opens it, and any other outcome frees
+    the trial slot for the next call.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self, name: str = "provider"):
+        with self._lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self._trial_in_flight):
+                raise CircuitOpenError(f"Circuit open for {name}; failing fast")
+            if state == "half-open":
+                self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+    def release_trial(self):
+        """End a call that says nothing about the provider's health (a 400, an interrupt)."""
+        with self._lock:
+            self._trial_in_flight = False
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(provider: str) -> CircuitBreaker:
+    """Return the process-wide circuit breaker for ``provider``."""
+    with _circuit_breakers_lock:
+        if provider not in _circuit_breakers:
+            _circuit_breakers[provider] = CircuitBreaker()
+        return _circuit_breakers[provider]
+
+class LatencyTracker:
+    """Rolling window of successful call latencies per (provider, model)."""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider: str, model: str, latency: float):
+        with self._lock:
+            self._samples.setdefault((provider, model), collections.deque(maxlen=self.window)).append(latency)
+
+    def percentile(self, provider: str, model: str, fraction: float, min_samples: int = 20) -> Optional[float]:
+        """The observed latency percentile, or None until ``min_samples`` calls have been seen."""
+        with self._lock:
+            samples = sorted(self._samples.get((provider, model), ()))
+        if len(samples) < min_samples:
+            return None
+        return _percentile(samples, fraction)
+
+_latency_tracker = LatencyTracker()
+
+@dataclass
+class ResiliencePolicy:
+    """
+    How query_llm survives slow or failing providers.
+
+    Attributes:
+        retry: Backoff policy for retryable errors on each provider
+        circuit_breaker: Fail fast on providers whose circuit is open
+        fallbacks: (provider, model) pairs tried in order once the primary gives
+            up; model None means the provider's default
+        hedge: Optional (provider, model) to send a duplicate request to when the
+            primary is slower than its observed p95; the first answer wins
+        hedge_after: Seconds to wait before hedging until enough latencies have
+            been observed for a p95
+    """
+    retry: RetryPolicy = field(default_factory=RetryPolicy)
+    circuit_breaker: bool = True
+    fallbacks: tuple = ()
+    hedge: Optional[tuple] = None
+    hedge_after: float = 10.0
+
+DEFAULT_RESILIENCE = ResiliencePolicy()
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+def _get_hedge_executor():
+    """The shared worker pool for hedged calls, created on first use."""
+    global _hedge_executor
+    with _hedge_executor_lock:
+        if _hedge_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm-hedge")
+        return _hedge_executor
+
+def _complete_with_retries(request: LLMRequest, client, policy: ResiliencePolicy) -> LLMResponse:
+    """Call one provider, retrying retryable errors and feeding its circuit breaker."""
+    breaker = get_circuit_breaker(request.provider) if policy.circuit_breaker else None
+    attempt = 0
+    while True:
+        attempt += 1
+        if breaker is not None:
+            breaker.before_call(request.provider)
+        started = time.monotonic()
+        try:
+            response = _complete(request, client or get_llm_client(request.provider))
+        except Exception as e:
+            retryable = is_retryable(e)
+            if breaker is not None:
+                if retryable:
+                    breaker.record_failure()
+                else:
+                    breaker.release_trial()
+            if not retryable or attempt >= policy.retry.max_attempts:
+                raise
+            delay = policy.retry.delay(attempt, e)
+            print(f"Retrying {request.provider} in {delay:.2f}s after {type(e).__name__}: {e}", file=sys.stderr)
+            time.sleep(delay)
+            continue
+        except BaseException:
+            if breaker is not None:
+                breaker.release_trial()
+            raise
+        if breaker is not None:
+            breaker.record_success()
+        _latency_tracker.record(request.provider, request.model, time.monotonic() - started)
+        return response
+
+def _complete_hedged(request: LLMRequest, client, policy: ResiliencePolicy) -> LLMResponse:
+    """Run the primary and, if it is slower than its p95, a hedge; return the first success."""
+    hedge_provider, hedge_model = policy.hedge
+    hedge_request = dataclasses.replace(request, provider=hedge_provider, model=hedge_model or default_model(hedge_provider))
+    threshold = _latency_tracker.percentile(request.provider, request.model, 0.95) or policy.hedge_after
+    tracker = _current_tracker()
+    # Each leg counts its own requests; sharing the caller's tracker would race
+    # and would report the hedge's request as a retry
+    legs = {}
+
+    def run(target, target_client, leg):
+        _call_context.tracker = leg
+        try:
+            return _complete_with_retries(target, target_client, policy)
+        finally:
+            _call_context.tracker = None
+
+    def launch(target, target_client):
+        leg = _CallTracker()
+        future = executor.submit(run, target, target_client, leg)
+        legs[future] = leg
+        return future
+
+    import concurrent.futures
+    executor = _get_hedge_executor()
+    primary = launch(request, client)
+    try:
+        done, _ = concurrent.futures.wait([primary], timeout=threshold)
+        if done:
+            return primary.result()
+        hedge = launch(hedge_request, None)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = error or future.exception()
+        raise error
+    finally:
+        if tracker is not None:
+            # The losing leg may still be running; its later requests are not part of this call
+            for future, leg in legs.items():
+                tracker.merge(leg, hedge=future is not primary)
+
+def _complete_resilient(request: LLMRequest, client=None, policy: Optional[ResiliencePolicy] = None) -> LLMResponse:
+    """
+    Complete ``request`` under ``policy``: retries with backoff, circuit breaking,
+    optional hedging and failover to the fallback providers in order.
+    """
+    policy = policy or DEFAULT_RESILIENCE
+    if policy.hedge:
+        attempt = lambda: _complete_hedged(request, client, policy)
+    else:
+        attempt = lambda: _complete_with_retries(request, client, policy)
+    try:
+        return attempt()
+    except Exception as e:
+        if not policy.fallbacks or not (is_retryable(e) or isinstance(e, CircuitOpenError)):
+            raise
+        error = e
+    for provider, model in policy.fallbacks:
+        fallback = dataclasses.replace(request, provider=provider, model=model or default_model(provider))
+        print(f"Falling back from {request.provider} to {provider} after {type(error).__name__}", file=sys.stderr)
+        try:
+            return _complete_with_retries(fallback, None, policy)
+        except Exception as e:
+            if not (is_retryable(e) or isinstance(e, CircuitOpenError)):
+                raise
+            error = e
+    raise error
+
+def _resolve_cache(cache, request: LLMRequest, force_cache: bool) -> Optional[ResponseCache]:
+    """Pick the cache to use for a request, or None when caching does not apply."""
+    if not cache:
+        return None
+    # Sampled responses are not reproducible, so only cache them when asked to
+    if effective_temperature(request.provider, request.temperature) > 0 and not force_cache:
+        return None
+    if isinstance(cache, ResponseCache):
+        return cache
+    # Opened only now, so requests that are never cached do not pay for opening the database
+    return get_response_cache(cache if isinstance(cache, str) else None)
+
+def _resolve_semantic_cache(semantic_cache, request: LLMRequest, force_cache: bool) -> Optional[SemanticCache]:
+    if not semantic_cache or (effective_temperature(request.provider, request.temperature) > 0 and not force_cache):
+        return None
+    return semantic_cache if isinstance(semantic_cache, SemanticCache) else get_semantic_cache()
+
+def _complete_cached(request: LLMRequest, client=None, cache=None, force_cache: bool = False,
+                     resilience: Optional[ResiliencePolicy] = None, semantic_cache=None,
+                     similarity_threshold: Optional[float] = None) -> LLMResponse:
+    """
+    Complete ``request`` under ``resilience``, consulting ``cache`` and then
+    ``semantic_cache`` first. A client is only created on a miss.
+    """
+    started = time.monotonic()
+    cache = _resolve_cache(cache, request, force_cache)
+    semantic_cache = _resolve_semantic_cache(semantic_cache, request, force_cache)
+    key = None
+    if cache is not None:
+        key = ResponseCache.make_key(request)
+        cached = cache.get(key)
+        if cached is not None:
+            response = LLMResponse(cached, request.provider, request.model, cached=True)
+            _emit_metrics(request, started, None, response)
+            return response
+    if semantic_cache is not None:
+        match = semantic_cache.get(request, similarity_threshold)
+        if match is not None:
+            response = LLMResponse(match[0], request.provider, request.model, cached=True, similarity=match[1])
+            _emit_metrics(request, started, None, response)
+            return response
+    with _track_call() as tracker:
+        try:
+            if client is None:
+                client = get_llm_client(request.provider)
+                started = time.monotonic()  # Building a client is not part of the call's latency
+            response = _complete_resilient(request, client, resilience)
+        except Exception as e:
+            _emit_metrics(request, started, tracker, error=e)
+            raise
+    _emit_metrics(request, started, tracker, response)
+    if cache is not None and response.text is not None:
+        cache.put(key, response.text, request.provider, request.model)
+    if semantic_cache is not None and response.text is not None:
+        semantic_cache.put(request, response.text)
+    return response
+
+def query_llm(prompt: str, client=None, model=None, provider="openai", image_path: Optional[str] = None,
+              temperature: Optional[float] = None, cache=None, force_cache: bool = False,
+              image_options: Optional[ImageOptions] = None,
+              resilience: Optional[ResiliencePolicy] = None, system: Optional[str] = None,
+              history: Optional[Iterable[dict]] = None, prompt_caching: bool = True,
+              semantic_cache=None, similarity_threshold: Optional[float] = None) -> Optional[str]:
     """
     Query an LLM with a prompt and optional image attachment.
     
     Args:
         prompt (str): The text prompt to send
-        client: The LLM client instance
+        client: The LLM client instance (defaults to a pooled client for ``provider``)
         model (str, optional): The model to use
         provider (str): The API provider to use
         image_path (str, optional): Path to an image file to attach
+        temperature (float, optional): Sampling temperature (default depends on provider)
+        cache (bool, str or ResponseCache, optional): Serve repeated requests from an
+            on-disk cache; True uses the shared default cache and a string the shared
+            cache in that directory. Skipped when the temperature is above zero unless
+            ``force_cache`` is set.
+        force_cache (bool): Cache even sampled (temperature > 0) responses
+        image_options (ImageOptions, optional): Downscale/re-encode the image before
+            upload; ImageOptions.for_provider(provider) picks the provider's maximum
+            dimension and JPEG
+        resilience (ResiliencePolicy, optional): Retry, circuit breaker, hedging and
+            failover settings (default: DEFAULT_RESILIENCE, three attempts with backoff)
+        system (str, optional): System prompt
+        history (list of dict, optional): Earlier turns, oldest first, as
+            {"role": "user" | "assistant", "content": str} dicts
+        prompt_caching (bool): Mark the system prompt and history as a cacheable
+            prefix on Anthropic (OpenAI and DeepSeek cache prefixes automatically)
+        semantic_cache (bool or SemanticCache, optional): Also answer from an earlier
+            response to a near-identical prompt; True uses the shared default index.
+            Same temperature rule as ``cache``.
+        similarity_threshold (float, optional): Minimum cosine similarity for a
+            semantic cache hit (default: the cache's threshold, 0.95)
         
     Returns:
         Optional[str]: The LLM's response or None if there was an error
     """
-    if client is None:
-        client = create_llm_client(provider)
-    
+    response = query_llm_response(prompt, client, model, provider, image_path, temperature, cache, force_cache,
+                                  image_options, resilience, system, history, prompt_caching, semantic_cache,
+                                  similarity_threshold)
+    return response.text if response else None
+
+def query_llm_response(prompt: str, client=None, model=None, provider="openai", image_path: Optional[str] = None,
+                       temperature: Optional[float] = None, cache=None, force_cache: bool = False,
+                       image_options: Optional[ImageOptions] = None,
+                       resilience: Optional[ResiliencePolicy] = None, system: Optional[str] = None,
+                       history: Optional[Iterable[dict]] = None, prompt_caching: bool = True,
+                       semantic_cache=None, similarity_threshold: Optional[float] = None) -> Optional[LLMResponse]:
+    """
+    Like query_llm, but return an LLMResponse carrying token usage as well as the text.
+
+    ``usage["cached_tokens"]`` reports how much of the prompt was read from the
+    provider's prompt cache. Usage is empty for responses served from the
+    response cache; ``similarity`` is set for semantic cache hits.
+    """
     try:
-        # Set default model
-        if model is None:
-            if provider == "openai":
-                model = "gpt-4o"
-            elif provider == "azure":
-                model = os.getenv('AZURE_OPENAI_MODEL_DEPLOYMENT', 'gpt-4o-ms')  # Get from env with fallback
-            elif provider == "deepseek":
-                model = "deepseek-chat"
-            elif provider == "siliconflow":
-                model = "deepseek-ai/DeepSeek-R1"
-            elif provider == "anthropic":
-                model = "claude-3-7-sonnet-20250219"
-            elif provider == "gemini":
-                model = "gemini-2.0-flash-exp"
-            elif provider == "local":
-                model = "Qwen/Qwen2.5-32B-Instruct-AWQ"
-        
-        if provider in ["openai", "local", "deepseek", "azure", "siliconflow"]:
-            messages = [{"role": "user", "content": []}]
-            
-            # Add text content
-            messages[0]["content"].append({
-                "type": "text",
-                "text": prompt
-            })
-            
-            # Add image content if provided
-            if image_path:
-                if provider == "openai":
-                    encoded_image, mime_type = encode_image_file(image_path)
-                    messages[0]["content"] = [
-                        {"type": "text", "text": prompt},
-                        {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded_image}"}}
-                    ]
-            
-            kwargs = {
-                "model": model,
-                "messages": messages,
-                "temperature": 0.7,
-            }
-            
-            # Add o1-specific parameters
-            if model == "o1":
-                kwargs["response_format"] = {"type": "text"}
-                kwargs["reasoning_effort"] = "low"
-                del kwargs["temperature"]
-            
-            response = client.chat.completions.create(**kwargs)
-            return response.choices[0].message.content
-            
-        elif provider == "anthropic":
-            messages = [{"role": "user", "content": []}]
-            
-            # Add text content
-            messages[0]["content"].append({
-                "type": "text",
-                "text": prompt
-            })
-            
-            # Add image content if provided
-            if image_path:
-                encoded_image, mime_type = encode_image_file(image_path)
-                messages[0]["content"].append({
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": mime_type,
-                        "data": encoded_image
-                    }
-                })
-            
-            response = client.messages.create(
-                model=model,
-                max_tokens=1000,
-                messages=messages
-            )
-            return response.content[0].text
-            
-        elif provider == "gemini":
-            model = client.GenerativeModel(model)
-            if image_path:
-                file = genai.upload_file(image_path, mime_type="image/png")
-                chat_session = model.start_chat(
-                    history=[{
-                        "role": "user",
-                        "parts": [file, prompt]
-                    }]
-                )
-            else:
-                chat_session = model.start_chat(
-                    history=[{
-                        "role": "user",
-                        "parts": [prompt]
-                    }]
-                )
-            response = chat_session.send_message(prompt)
-            return response.text
-            
+        request = LLMRequest(prompt, provider, model, image_path, temperature, image_options, system, history, prompt_caching)
+        return _complete_cached(request, client, cache=cache, force_cache=force_cache, resilience=resilience,
+                                semantic_cache=semantic_cache, similarity_threshold=similarity_threshold)
     except Exception as e:
         print(f"Error querying LLM: {e}", file=sys.stderr)
         return None
 
-def main():
+def query_llm_messages(messages: Iterable[dict], **kwargs) -> Optional[str]:
+    """
+    Query an LLM with an OpenAI-style message list.
+
+    Leading system messages become the system prompt, the final user message
+    the prompt and everything in between the history (see split_messages).
+    Other arguments are as for query_llm.
+    """
+    system, history, prompt = split_messages(messages)
+    return query_llm(prompt, system=system, history=history, **kwargs)
+
+@dataclass
+class StreamStats:
+    """Timing of a streamed response; filled in while query_llm_stream is consumed."""
+    started_at: float = 0.0
+    first_token_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    chunks: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+    cache_write_tokens: int = 0
+    characters: int = 0
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        """Seconds from sending the request to the first text delta."""
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        """Output tokens per second after the first token arrived."""
+        if self.first_token_at is None or self.finished_at is None:
+            return None
+        generation_time = self.finished_at - self.first_token_at
+        return self.output_tokens / generation_time if generation_time > 0 else None
+
+def _record_stream_usage(stats: StreamStats, usage: dict):
+    stats.input_tokens = usage["input_tokens"]
+    stats.output_tokens = usage["output_tokens"]
+    stats.cached_tokens = usage["cached_tokens"]
+    stats.cache_write_tokens = usage["cache_write_tokens"]
+
+def _stream_deltas(request: LLMRequest, client, stats: StreamStats) -> Iterator[str]:
+    """Yield raw text deltas for ``request``, recording reported output tokens in ``stats``."""
+    provider = request.provider
+    if provider in OPENAI_COMPATIBLE_PROVIDERS:
+        kwargs = _openai_request(request)
+        if provider in ("openai", "azure", "deepseek"):
+            kwargs["stream_options"] = {"include_usage": True}
+        for chunk in client.chat.completions.create(stream=True, **kwargs):
+            if chunk.usage is not None:
+                _record_stream_usage(stats, _usage(provider, chunk))
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    elif provider == "anthropic":
+        with client.messages.stream(**_anthropic_request(request)) as stream:
+            yield from stream.text_stream
+            _record_stream_usage(stats, _usage(provider, stream.get_final_message()))
+
+    elif provider == "gemini":
+        response = _gemini_model(client, request).generate_content(
+            _gemini_parts(client, request),
+            generation_config=_gemini_generation_config(request),
+            stream=True,
+        )
+        for chunk in response:
+            if chunk.usage_metadata and chunk.usage_metadata.candidates_token_count:
+                _record_stream_usage(stats, _usage(provider, chunk))
+            if chunk.text:
+                yield chunk.text
+    else:
+        raise ValueError(f"Unsupported provider: {provider}")
+
+def query_llm_stream(prompt: str, client=None, model=None, provider="openai", image_path: Optional[str] = None,
+                     temperature: Optional[float] = None, stats: Optional[StreamStats] = None,
+                     image_options: Optional[ImageOptions] = None, system: Optional[str] = None,
+                     history: Optional[Iterable[dict]] = None, prompt_caching: bool = True) -> Iterator[str]:
+    """
+    Query an LLM and yield the response text as it is generated.
+
+    Unlike query_llm, errors are raised to the caller. Streamed responses are
+    not cached.
+
+    Args:
+        prompt, client, model, provider, image_path, temperature, image_options,
+            system, history, prompt_caching: As for query_llm
+        stats (StreamStats, optional): Filled in with time-to-first-token and
+            tokens-per-second as the stream is consumed
+
+    Yields:
+        str: Text deltas in order
+    """
+    request = LLMRequest(prompt, provider, model, image_path, temperature, image_options, system, history, prompt_caching)
+    if stats is None:
+        stats = StreamStats()
+    if client is None:
+        client = get_llm_client(provider)
+    stats.started_at = time.monotonic()
+    deltas = _stream_deltas(request, client, stats)
+    error = None
+    try:
+        # The request goes out on the first step, so only that step is tracked
+        with _track_call() as tracker:
+            first = next(deltas, None)
+        for delta in itertools.chain([first] if first is not None else [], deltas):
+            if stats.first_token_at is None:
+                stats.first_token_at = time.monotonic()
+            stats.chunks += 1
+            stats.characters += len(delta)
+            yield delta
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        stats.finished_at = time.monotonic()
+        if not stats.output_tokens:
+            # Provider did not report usage; fall back to the character estimate
+            stats.output_tokens = stats.characters // 4
+        usage = {"input_tokens": stats.input_tokens, "output_tokens": stats.output_tokens,
+                 "cached_tokens": stats.cached_tokens, "cache_write_tokens": stats.cache_write_tokens}
+        _emit_metrics(
+            request, stats.started_at, tracker,
+            None if error else LLMResponse("", request.provider, request.model, usage),
+            error=error if not isinstance(error, GeneratorExit) else None,
+            time_to_first_byte=stats.time_to_first_token, streamed=True,
+        )
+
+async def aquery_llm_stream(prompt: str, **kwargs) -> AsyncIterator[str]:
+    """
+    Async variant of query_llm_stream; takes the same arguments.
+
+    The blocking SDK stream is advanced in a worker thread so the event loop
+    keeps running between deltas.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    deltas = query_llm_stream(prompt, **kwargs)
+    done = object()
+    try:
+        while True:
+            delta = await loop.run_in_executor(None, next, deltas, done)
+            if delta is done:
+                break
+            yield delta
+    finally:
+        await loop.run_in_executor(None, deltas.close)
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token) used for rate limiting."""
+    return len(text) // 4 + 1
+
+class RateLimiter:
+    """
+    Async token bucket enforcing requests-per-minute and tokens-per-minute limits.
+
+    Either limit may be None to leave it unbounded. Buckets start full, so a
+    batch may burst up to one minute's allowance before it is paced.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = requests_per_minute or 0.0
+        self._tokens = tokens_per_minute or 0.0
+        self._updated = time.monotonic()
+        import asyncio
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self._updated) / 60
+        self._updated = now
+        if self.requests_per_minute:
+            self._requests = min(self.requests_per_minute, self._requests + elapsed_minutes * self.requests_per_minute)
+        if self.tokens_per_minute:
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed_minutes * self.tokens_per_minute)
+
+    async def acquire(self, tokens: int = 0):
+        """Wait until one request carrying ``tokens`` tokens fits in both buckets."""
+        async with self._lock:
+            while True:
+                self._refill()
+                wait = 0.0
+                if self.requests_per_minute and self._requests < 1:
+                    wait = (1 - self._requests) * 60 / self.requests_per_minute
+                if self.tokens_per_minute:
+                    # A single oversized request may drain the bucket, but never waits forever
+                    needed = min(tokens, self.tokens_per_minute)
+                    if self._tokens < needed:
+                        wait = max(wait, (needed - self._tokens) * 60 / self.tokens_per_minute)
+                if wait <= 0:
+                    break
+                import asyncio
+                await asyncio.sleep(wait)
+            if self.requests_per_minute:
+                self._requests -= 1
+            if self.tokens_per_minute:
+                self._tokens -= tokens
+
+@dataclass
+class BatchResult:
+    """Outcome of one prompt in a batch; exactly one of ``response`` and ``error`` is set."""
+    index: int
+    id: Optional[str]
+    provider: str
+    model: str
+    response: Optional[str] = None
+    error: Optional[str] = None
+    error_type: Optional[str] = None
+    latency: float = 0.0
+    cached: bool = False
+    usage: dict = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+def _batch_item(index: int, item, provider: str, model: Optional[str], temperature: Optional[float] = None,
+                image_options: Optional[ImageOptions] = None, system: Optional[str] = None) -> dict:
+    """Normalise a batch entry (a prompt string or a dict) into a request dict."""
+    if isinstance(item, str):
+        item = {"prompt": item}
+    elif not isinstance(item, dict) or "prompt" not in item:
+        raise ValueError(f"Batch item {index} must be a prompt string or a dict with a 'prompt' key")
+    return {
+        "index": index,
+        "id": item.get("id"),
+        "request": LLMRequest(
+            item["prompt"],
+            item.get("provider", provider),
+            item.get("model") or model,
+            item.get("image_path", item.get("image")),
+            temperature,
+            image_options,
+            item.get("system", system),
+            item.get("history"),
+        ),
+    }
+
+async def iter_llm_batch(
+    prompts: Iterable,
+    provider: str = "openai",
+    model: Optional[str] = None,
+    max_concurrency: int = 8,
+    requests_per_minute: Optional[float] = None,
+    tokens_per_minute: Optional[float] = None,
+    rate_limits: Optional[dict] = None,
+    temperature: Optional[float] = None,
+    cache=None,
+    force_cache: bool = False,
+    image_options: Optional[ImageOptions] = None,
+    resilience: Optional[ResiliencePolicy] = None,
+    system: Optional[str] = None,
+    semantic_cache=None,
+    similarity_threshold: Optional[float] = None,
+) -> AsyncIterator[BatchResult]:
+    """
+    Run many prompts concurrently and yield each BatchResult as soon as it finishes.
+
+    Args:
+        prompts: Prompt strings, or dicts with 'prompt' and optional 'id', 'provider',
+            'model', 'image', 'system' and 'history' keys
+        provider (str): Provider for items that do not name one
+        model (str, optional): Model for items that do not name one
+        max_concurrency (int): Maximum number of requests in flight
+        requests_per_minute (float, optional): Per-provider request limit
+        tokens_per_minute (float, optional): Per-provider (estimated) input token limit
+        rate_limits (dict, optional): Per-provider overrides, e.g.
+            {"openai": {"requests_per_minute": 500, "tokens_per_minute": 30000}}
+        temperature, cache, force_cache, image_options, resilience,
+            semantic_cache, similarity_threshold: As for query_llm
+        system (str, optional): System prompt for items that do not set one; a shared
+            system prompt is cached by providers with prompt caching
+
+    Yields:
+        BatchResult: In completion order; use ``index`` to restore input order
+    """
+    items = [_batch_item(i, item, provider, model, temperature, image_options, system) for i, item in enumerate(prompts)]
+    if not items:
+        return
+    rate_limits = rate_limits or {}
+    limiters = {}
+    for item_provider in {item["request"].provider for item in items}:
+        limits = rate_limits.get(item_provider, {})
+        limiters[item_provider] = RateLimiter(
+            limits.get("requests_per_minute", requests_per_minute),
+            limits.get("tokens_per_minute", tokens_per_minute),
+        )
+
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    if semantic_cache is True:
+        semantic_cache = get_semantic_cache()
+
+    def run(item) -> LLMResponse:
+        return _complete_cached(item["request"], cache=cache, force_cache=force_cache, resilience=resilience,
+                                semantic_cache=semantic_cache, similarity_threshold=similarity_threshold)
+
+    async def worker(item, executor) -> BatchResult:
+        request = item["request"]
+        result = BatchResult(item["index"], item["id"], request.provider, request.model)
+        async with semaphore:
+            await limiters[request.provider].acquire(estimate_tokens(request.input_text))
+            start = time.monotonic()
+            try:
+                response = await loop.run_in_executor(executor, run, item)
+                result.response, result.cached, result.usage = response.text, response.cached, response.usage
+            except Exception as e:
+                result.error = str(e) or repr(e)
+                result.error_type = type(e).__name__
+            result.latency = time.monotonic() - start
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm-batch") as executor:
+        tasks = [asyncio.ensure_future(worker(item, executor)) for item in items]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield await finished
+        finally:
+            for task in tasks:
+                task.cancel()
+
+async def query_llm_batch(prompts: Iterable, **kwargs) -> List[BatchResult]:
+    """
+    Run many prompts concurrently and return their results in input order.
+
+    Accepts the same arguments as iter_llm_batch. Failed items carry ``error``
+    and ``error_type`` instead of a response.
+    """
+    results = [result async for result in iter_llm_batch(prompts, **kwargs)]
+    return sorted(results, key=lambda result: result.index)
+
+def query_llm_batch_sync(prompts: Iterable, **kwargs) -> List[BatchResult]:
+    """Synchronous wrapper for query_llm_batch."""
+    import asyncio
+    return asyncio.run(query_llm_batch(prompts, **kwargs))
+
+def read_prompts_file(path: str) -> List[dict]:
+    """Read a JSONL file of batch items (one JSON object or string per line)."""
+    items = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{line_number}: invalid JSON ({e})")
+    return items
+
+async def _stream_batch_to_stdout(items: List[dict], args, cache, image_options: Optional[ImageOptions],
+                                  resilience: ResiliencePolicy, semantic_cache: Optional[SemanticCache] = None) -> int:
+    failures = 0
+    async for result in iter_llm_batch(
+        items,
+        provider=args.provider,
+        model=args.model,
+        max_concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        temperature=args.temperature,
+        cache=cache,
+        force_cache=args.force_cache,
+        image_options=image_options,
+        resilience=resilience,
+        system=args.system,
+        semantic_cache=semantic_cache,
+        similarity_threshold=args.similarity,
+    ):
+        failures += not result.ok
+        print(json.dumps(result.to_dict(), ensure_ascii=False), flush=True)
+    return failures
+
+def _with_retries(call, policy: Optional[RetryPolicy] = None):
+    """Run ``call()``, retrying rate limits, timeouts and server errors with backoff."""
+    policy = policy or DEFAULT_RESILIENCE.retry
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return call()
+        except Exception as e:
+            if not is_retryable(e) or attempt >= policy.max_attempts:
+                raise
+            delay = policy.delay(attempt, e)
+            print(f"Retrying batch API call in {delay:.2f}s after {type(e).__name__}: {e}", file=sys.stderr)
+            time.sleep(delay)
+
+def _custom_id(index: int) -> str:
+    return f"item-{index}"
+
+class _OpenAIBatchAPI:
+    """OpenAI Batch API: a JSONL file of chat.completions requests in, output and error files out."""
+    max_requests = 50000
+
+    def submit(self, client, items: List[dict]) -> str:
+        lines = [json.dumps({"custom_id": _custom_id(item["index"]), "method": "POST", "url": "/v1/chat/completions",
+                             "body": _openai_request(item["request"])}) for item in items]
+        upload = client.files.create(file=("batch.jsonl", ("\n".join(lines) + "\n").encode()), purpose="batch")
+        batch = client.batches.create(input_file_id=upload.id, endpoint="/v1/chat/completions", completion_window="24h")
+        return batch.id
+
+    def poll(self, client, batch_id: str) -> tuple:
+        """Return (finished, status text)."""
+        batch = client.batches.retrieve(batch_id)
+        status = batch.status
+        if batch.request_counts and batch.request_counts.total:
+            counts = batch.request_counts
+            status += f" {counts.completed + counts.failed}/{counts.total}"
+        if batch.status == "failed" and batch.errors and batch.errors.data:
+            status += ": " + "; ".join(error.message or error.code or "" for error in batch.errors.data)
+        return batch.status in ("completed", "failed", "expired", "cancelled"), status
+
+    def results(self, client, batch_id: str, provider: str) -> Iterator[tuple]:
+        """Yield (custom_id, text, usage, error_type, error_message) per finished request."""
+        batch = client.batches.retrieve(batch_id)
+        completion_type = _provider_sdk(provider).types.chat.ChatCompletion
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                response = entry.get("response") or {}
+                if entry.get("error") or response.get("status_code") != 200:
+                    error = entry.get("error") or (response.get("body") or {}).get("error") or {}
+                    yield (entry["custom_id"], None, {}, error.get("type") or error.get("code") or "BatchItemError",
+                           error.get("message") or f"HTTP {response.get('status_code')}")
+                    continue
+                completion = completion_type.model_validate(response["body"])
+                yield entry["custom_id"], completion.choices[0].message.content, _usage(provider, completion), None, None
+
+class _AnthropicBatchAPI:
+    """Anthropic Message Batches API."""
+    max_requests = 100000
+
+    def submit(self, client, items: List[dict]) -> str:
+        requests = [{"custom_id": _custom_id(item["index"]), "params": _anthropic_request(item["request"])} for item in items]
+        return client.messages.batches.create(requests=requests).id
+
+    def poll(self, client, batch_id: str) -> tuple:
+        batch = client.messages.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        done = counts.succeeded + counts.errored + counts.canceled + counts.expired
+        return batch.processing_status == "ended", f"{batch.processing_status} {done}/{done + counts.processing}"
+
+    def results(self, client, batch_id: str, provider: str) -> Iterator[tuple]:
+        for entry in client.messages.batches.results(batch_id):
+            result = entry.result
+            if result.type == "succeeded":
+                yield entry.custom_id, result.message.content[0].text, _usage(provider, result.message), None, None
+            elif result.type == "errored":
+                error = result.error.error
+                yield entry.custom_id, None, {}, error.type, error.message
+            else:
+                yield entry.custom_id, None, {}, result.type, f"Request {result.type} before it was processed"
+
+def _batch_api(provider: str):
+    if provider in OPENAI_COMPATIBLE_PROVIDERS:
+        return _OpenAIBatchAPI()
+    if provider == "anthropic":
+        return _AnthropicBatchAPI()
+    raise ValueError(f"Batch jobs are not supported for {provider}")
+
+class BatchJob:
+    """
+    Requests for one provider run through its batch API, with the job state kept on disk.
+
+    The job id is a hash of the requests, so running the same input again
+    resumes the batches already submitted instead of paying for them twice.
+    Once every batch has ended, the results are saved next to the state file
+    and later runs return them without contacting the provider.
+    """
+
+    def __init__(self, items: List[dict], provider: str, job_dir: Optional[str] = None):
+        self.items = items
+        self.provider = provider
+        self.api = _batch_api(provider)
+        self.job_dir = Path(job_dir or Path(os.getenv('LLM_API_CACHE_DIR') or Path.home() / ".cache" / "llm_api") / "batch_jobs")
+        self.job_dir.mkdir(parents=True, exist_ok=True)
+        fingerprints = [item["request"].fingerprint() for item in items]
+        self.job_id = _sha256(json.dumps([provider, fingerprints], sort_keys=True).encode()).hexdigest()[:16]
+        self.state_path = self.job_dir / f"{self.job_id}.json"
+        self.results_path = self.job_dir / f"{self.job_id}.results.jsonl"
+        if self.state_path.exists():
+            self.state = json.loads(self.state_path.read_text())
+        else:
+            self.state = {"job_id": self.job_id, "provider": provider, "created_at": time.time(), "requests": len(items), "batches": []}
+
+    def _save(self):
+        temporary = self.state_path.with_suffix(".tmp")
+        temporary.write_text(json.dumps(self.state, indent=2))
+        os.replace(temporary, self.state_path)
+
+    def submit(self, client):
+        """Submit every chunk of requests that does not have a provider batch yet."""
+        submitted = sum(batch["size"] for batch in self.state["batches"])
+        while submitted < len(self.items):
+            chunk = self.items[submitted:submitted + self.api.max_requests]
+            batch_id = _with_retries(lambda: self.api.submit(client, chunk))
+            self.state["batches"].append({"id": batch_id, "start": submitted, "size": len(chunk), "finished": False, "status": "submitted"})
+            self._save()  # Saved per batch, so a crash never loses a submitted batch
+            print(f"Batch job {self.job_id}: submitted {self.provider} batch {batch_id} ({len(chunk)} requests)", file=sys.stderr)
+            submitted += len(chunk)
+
+    def wait(self, client, poll_interval: float = 5.0, max_poll_interval: float = 300.0, timeout: Optional[float] = None):
+        """Poll until every batch has ended, backing off from ``poll_interval`` to ``max_poll_interval``."""
+        started = time.monotonic()
+        delay = poll_interval
+        while True:
+            for batch in self.state["batches"]:
+                if batch["finished"]:
+                    continue
+                try:
+                    finished, status = self.api.poll(client, batch["id"])
+                except Exception as e:
+                    if not is_retryable(e):
+                        raise
+                    print(f"Batch job {self.job_id}: polling {batch['id']} failed ({type(e).__name__}: {e})", file=sys.stderr)
+                    continue
+                if status != batch["status"] or finished:
+                    batch["status"], batch["finished"] = status, finished
+                    self._save()
+                    print(f"Batch job {self.job_id}: {batch['id']} {status}", file=sys.stderr)
+            if all(batch["finished"] for batch in self.state["batches"]):
+                return
+            if timeout is not None and time.monotonic() - started + delay > timeout:
+                raise TimeoutError(f"Batch job {self.job_id} is still running; run it again to resume")
+            time.sleep(delay)
+            delay = min(delay * 1.5, max_poll_interval)
+
+    def collect(self, client) -> List[BatchResult]:
+        """Download the results of the ended batches, in input order."""
+        by_id = {_custom_id(item["index"]): item for item in self.items}
+        results = {}
+        for batch in self.state["batches"]:
+            entries = _with_retries(lambda: list(self.api.results(client, batch["id"], self.provider)))
+            for custom_id, text, usage, error_type, error in entries:
+                item = by_id.get(custom_id)
+                if item is None:
+                    continue
+                request = item["request"]
+                results[custom_id] = BatchResult(item["index"], item["id"], request.provider, request.model, text,
+                                                 error, error_type, usage=usage)
+            for item in self.items[batch["start"]:batch["start"] + batch["size"]]:
+                custom_id = _custom_id(item["index"])
+                if custom_id not in results:
+                    request = item["request"]
+                    results[custom_id] = BatchResult(item["index"], item["id"], request.provider, request.model,
+                                                     error=f"No result in batch {batch['id']} ({batch['status']})",
+                                                     error_type="BatchItemMissing")
+        ordered = [results[_custom_id(item["index"])] for item in self.items]
+        with open(self.results_path, "w") as f:
+            for result in ordered:
+                f.write(json.dumps(result.to_dict(), ensure_ascii=False) + "\n")
+        self.state["completed_at"] = time.time()
+        self._save()
+        return ordered
+
+    def saved_results(self) -> Optional[List[BatchResult]]:
+        """Results of an earlier run of this job, if it completed."""
+        if not self.state.get("completed_at") or not self.results_path.exists():
+            return None
+        with open(self.results_path) as f:
+            return [BatchResult(**json.loads(line)) for line in f if line.strip()]
+
+    def run(self, client=None, **wait_options) -> List[BatchResult]:
+        """Submit (or resume), wait for and collect the job; ``wait_options`` go to wait()."""
+        saved = self.saved_results()
+        if saved is not None:
+            return saved
+        client = client or get_llm_client(self.provider)
+        self.submit(client)
+        self.wait(client, **wait_options)
+        return self.collect(client)
+
+def run_batch_job(
+    prompts: Iterable,
+    provider: str = "openai",
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
+    image_options: Optional[ImageOptions] = None,
+    system: Optional[str] = None,
+    job_dir: Optional[str] = None,
+    poll_interval: float = 5.0,
+    max_poll_interval: float = 300.0,
+    timeout: Optional[float] = None,
+) -> List[BatchResult]:
+    """
+    Run prompts through the providers' asynchronous batch APIs (OpenAI Batch, Anthropic Message Batches).
+
+    Batch jobs can take up to 24 hours but cost half as much as synchronous
+    calls. Job state is kept under ``job_dir`` (default: batch_jobs in the
+    response cache directory); if the process is interrupted, calling again
+    with the same prompts resumes the submitted jobs.
+
+    Args:
+        prompts: As for iter_llm_batch; items naming different providers are split into one job per provider
+        provider, model, temperature, image_options, system: As for iter_llm_batch
+        job_dir (str, optional): Directory for job state and results
+        poll_interval (float): Seconds before the first status check; grows 1.5x per check
+        max_poll_interval (float): Longest wait between status checks
+        timeout (float, optional): Give up waiting after this many seconds (raises TimeoutError)
+
+    Returns:
+        List[BatchResult]: In input order; failed items carry ``error`` and ``error_type``
+    """
+    items = [_batch_item(i, item, provider, model, temperature, image_options, system) for i, item in enumerate(prompts)]
+    by_provider = {}
+    for item in items:
+        by_provider.setdefault(item["request"].provider, []).append(item)
+    jobs = [BatchJob(provider_items, job_provider, job_dir) for job_provider, provider_items in by_provider.items()]
+    results = []
+    for job in jobs:
+        results += job.run(poll_interval=poll_interval, max_poll_interval=max_poll_interval, timeout=timeout)
+    return sorted(results, key=lambda result: result.index)
+
+def default_socket_path() -> str:
+    """
+    Unix socket the daemon listens on: $LLM_API_SOCKET, or llm_api.sock in a
+    private per-user directory ($XDG_RUNTIME_DIR/llm_api, else llm_api-<uid> in
+    the temp directory), so other users can neither predict nor pre-create it.
+    """
+    # Keep in sync with tools/llm_client.py, which must not import this module.
+    if os.getenv("LLM_API_SOCKET"):
+        return os.environ["LLM_API_SOCKET"]
+    uid = os.getuid() if hasattr(os, "getuid") else os.getenv("USERNAME", "user")
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR")
+    directory = os.path.join(runtime_dir, "llm_api") if runtime_dir else os.path.join(os.getenv("TMPDIR", "/tmp"), f"llm_api-{uid}")
+    return os.path.join(directory, "llm_api.sock")
+
+def _private_directory(path: str):
+    """Create ``path`` as a 0700 directory, or check that an existing one is ours and private."""
+    import stat
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if not hasattr(os, "getuid"):
+        return
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise ValueError(f"{path} must be a directory owned by this user and closed to others (mode 0700)")
+
+# Options whose values are paths; the daemon resolves them against the client's working directory.
+CLI_PATH_OPTIONS = ("--image", "--prompts-file", "--system-file", "--job-dir", "--cache-dir", "--metrics-file", "--prometheus-file")
+
+def _resolve_cli_paths(argv: List[str], cwd: str) -> List[str]:
+    resolved = []
+    expect_path = False
+    for arg in argv:
+        name, sep, value = arg.partition("=")
+        if expect_path:
+            arg = os.path.join(cwd, os.path.expanduser(arg))
+        elif sep and name in CLI_PATH_OPTIONS:
+            arg = f"{name}={os.path.join(cwd, os.path.expanduser(value))}"
+        expect_path = arg in CLI_PATH_OPTIONS
+        resolved.append(arg)
+    return resolved
+
+class _RoutedStream(io.TextIOBase):
+    """
+    Replacement for sys.stdout/sys.stderr in the daemon.
+
+    Each handler thread routes its writes to its own client; every other thread
+    writes to the daemon's original stream.
+    """
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self._local = threading.local()
+
+    @property
+    def encoding(self):
+        return getattr(self.fallback, "encoding", "utf-8")
+
+    def _target(self):
+        return getattr(self._local, "target", None) or self.fallback
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    @contextlib.contextmanager
+    def route(self, target):
+        self._local.target = target
+        try:
+            yield
+        finally:
+            self._local.target = None
+
+class _DaemonChannel:
+    """Sends a client its stdout/stderr text and exit status as JSON lines."""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.lock = threading.Lock()
+
+    def send(self, **message):
+        data = (json.dumps(message) + "\n").encode()
+        with self.lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def writer(self, fd: int) -> "_ChannelWriter":
+        return _ChannelWriter(self, fd)
+
+class _ChannelWriter(io.TextIOBase):
+    def __init__(self, channel: _DaemonChannel, fd: int):
+        self.channel = channel
+        self.fd = fd
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        if text:
+            self.channel.send(fd=self.fd, data=text)
+        return len(text)
+
+def _exit_code(exit: SystemExit) -> int:
+    if exit.code is None or isinstance(exit.code, int):
+        return exit.code or 0
+    print(exit.code, file=sys.stderr)
+    return 1
+
+# The daemon classes are mixed into socketserver's in serve_daemon, so importing
+# this module does not import socketserver.
+class _DaemonHandler:
+    """Runs one CLI invocation: a JSON line {"argv": [...], "cwd": "..."} in, output and {"exit": n} out."""
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        channel = _DaemonChannel(self.wfile)
+        try:
+            request = json.loads(line)
+            argv = _resolve_cli_paths(list(request["argv"]), request.get("cwd") or os.getcwd())
+        except (ValueError, KeyError, TypeError) as e:
+            channel.send(fd=2, data=f"Invalid daemon request: {e}\n")
+            channel.send(exit=2)
+            return
+        if "--serve" in argv:
+            channel.send(fd=2, data="--serve cannot be forwarded to a running daemon\n")
+            channel.send(exit=2)
+            return
+
+        self.server.request_started()
+        code = 0
+        try:
+            with sys.stdout.route(channel.writer(1)), sys.stderr.route(channel.writer(2)):
+                try:
+                    main(argv)
+                except SystemExit as e:
+                    code = _exit_code(e)
+                except Exception as e:
+                    print(f"Error: {e}", file=sys.stderr)
+                    code = 1
+            channel.send(exit=code)
+        except OSError:
+            pass  # The client went away; nothing left to report to.
+        finally:
+            self.server.request_finished()
+
+class _DaemonServer:
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, handler_class):
+        super().__init__(socket_path, handler_class)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.last_activity = time.monotonic()
+
+    def request_started(self):
+        with self.lock:
+            self.active += 1
+
+    def request_finished(self):
+        with self.lock:
+            self.active -= 1
+            self.last_activity = time.monotonic()
+
+    def idle_for(self) -> float:
+        with self.lock:
+            return 0.0 if self.active else time.monotonic() - self.last_activity
+
+def _daemon_running(socket_path: str) -> bool:
+    import socket
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
+
+def serve_daemon(socket_path: Optional[str] = None, warm_providers: Iterable[str] = (), idle_timeout: Optional[float] = None,
+                 verbose_env: bool = False):
+    """
+    Serve llm_api command lines over a Unix socket until interrupted.
+
+    The daemon keeps the loaded .env, imported SDKs, pooled HTTP clients and
+    response caches alive between calls; tools/llm_client.py forwards its
+    arguments here. Requests run concurrently, one thread each. The daemon's
+    own environment is used, not the client's.
+
+    Args:
+        socket_path: Socket to listen on (default: default_socket_path())
+        warm_providers: Providers whose SDK and client are set up before the first request
+        idle_timeout: Exit after this many seconds without requests (None: run until stopped)
+        verbose_env: Report which .env files and keys were loaded
+    """
+    import socket
+    if not hasattr(socket, "AF_UNIX"):
+        raise ValueError("The llm_api daemon needs Unix domain sockets")
+    if socket_path is None:
+        socket_path = default_socket_path()
+        if not os.getenv("LLM_API_SOCKET"):
+            _private_directory(os.path.dirname(socket_path))
+    if os.path.exists(socket_path):
+        if _daemon_running(socket_path):
+            raise ValueError(f"An llm_api daemon is already listening on {socket_path}")
+        os.unlink(socket_path)  # Left behind by a daemon that did not shut down cleanly
+
+    load_environment(verbose=verbose_env)
+    for provider in dict.fromkeys(warm_providers):
+        try:
+            get_llm_client(provider)
+        except Exception as e:
+            print(f"Warning: could not warm up {provider}: {e}", file=sys.stderr)
+
+    import socketserver
+    handler_class = type("DaemonHandler", (_DaemonHandler, socketserver.StreamRequestHandler), {})
+    server_class = type("DaemonServer", (_DaemonServer, socketserver.ThreadingMixIn, socketserver.UnixStreamServer), {})
+    # Bind under a restrictive umask: chmod after bind would leave the socket open to others in between
+    previous_umask = os.umask(0o077)
+    try:
+        server = server_class(socket_path, handler_class)
+    finally:
+        os.umask(previous_umask)
+    original_streams = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = _RoutedStream(sys.stdout), _RoutedStream(sys.stderr)
+    if idle_timeout:
+        def watch_idle():
+            while server.idle_for() < idle_timeout:
+                time.sleep(min(idle_timeout, 1.0))
+            server.shutdown()
+        threading.Thread(target=watch_idle, daemon=True).start()
+    if threading.current_thread() is threading.main_thread():
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    print(f"llm_api daemon listening on {socket_path}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        sys.stdout, sys.stderr = original_streams
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_path)
+
+_cli_sinks = {}
+_cli_sinks_lock = threading.Lock()
+
+def _cli_metrics_sink(sink_type, path: str):
+    """Register one sink per file, so repeated main() calls in the daemon do not duplicate metrics."""
+    key = (sink_type, os.path.abspath(path))
+    with _cli_sinks_lock:
+        if key not in _cli_sinks:
+            _cli_sinks[key] = add_metrics_sink(sink_type(path))
+        return _cli_sinks[key]
+
+def _provider_spec(spec: str) -> tuple:
+    """Parse a 'provider[:model]' command-line value."""
+    provider, _, model = spec.partition(":")
+    if provider not in PROVIDERS:
+        import argparse
+        raise argparse.ArgumentTypeError(f"Unsupported provider: {provider}")
+    return provider, model or None
+
+def main(argv: Optional[List[str]] = None):
+    import argparse
     parser = argparse.ArgumentParser(description='Query an LLM with a prompt')
-    parser.add_argument('--prompt', type=str, help='The prompt to send to the LLM', required=True)
-    parser.add_argument('--provider', choices=['openai','anthropic','gemini','local','deepseek','azure','siliconflow'], default='openai', help='The API provider to use')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--prompt', type=str, help='The prompt to send to the LLM')
+    source.add_argument('--prompts-file', type=str, help='JSONL file of prompts to run as a batch; results are streamed to stdout as JSONL')
+    source.add_argument('--stats', action='store_true', help='Print p50/p95/p99 latency, tokens and cost per provider and model from the metrics file')
+    source.add_argument('--serve', action='store_true', help='Run as a daemon that keeps clients and caches warm for tools/llm_client.py')
+    parser.add_argument('--provider', choices=PROVIDERS, default='openai', help='The API provider to use')
     parser.add_argument('--model', type=str, help='The model to use (default depends on provider)')
+    parser.add_argument('--system', type=str, help='System prompt; cached by providers that support prompt caching')
+    parser.add_argument('--system-file', type=str, help='Read the system prompt from this file')
     parser.add_argument('--image', type=str, help='Path to an image file to attach to the prompt')
-    args = parser.parse_args()
+    parser.add_argument('--optimize-image', action='store_true', help="Downscale the image to the provider's maximum size and re-encode it before upload")
+    parser.add_argument('--image-max-dimension', type=int, help='Downscale the image so its longest side is at most this many pixels')
+    parser.add_argument('--image-format', choices=sorted(IMAGE_FORMAT_MIME_TYPES), help='Re-encode the image in this format before upload')
+    parser.add_argument('--image-quality', type=int, default=85, help='JPEG/WebP quality for re-encoded images (default: 85)')
+    parser.add_argument('--stream', action='store_true', help='Print the response as it is generated (timing summary on stderr)')
+    parser.add_argument('--concurrency', type=int, default=8, help='Maximum requests in flight in batch mode (default: 8)')
+    parser.add_argument('--batch-job', action='store_true',
+                        help="Run --prompts-file through the provider's batch API (half price, up to 24h); rerun to resume")
+    parser.add_argument('--job-dir', type=str, help='Where --batch-job keeps job state and results (default: batch_jobs in the cache directory)')
+    parser.add_argument('--poll-interval', type=float, default=5.0, help='Seconds before the first --batch-job status check (default: 5)')
+    parser.add_argument('--rpm', type=float, help='Requests-per-minute limit per provider in batch mode')
+    parser.add_argument('--tpm', type=float, help='Estimated tokens-per-minute limit per provider in batch mode')
+    parser.add_argument('--temperature', type=float, help='Sampling temperature (default depends on provider)')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the on-disk response cache')
+    parser.add_argument('--cache-dir', type=str, help='Response cache directory (default: $LLM_API_CACHE_DIR or ~/.cache/llm_api)')
+    parser.add_argument('--force-cache', action='store_true', help='Cache responses even when the temperature is above zero')
+    parser.add_argument('--semantic-cache', action='store_true', help='Also reuse responses to near-identical earlier prompts')
+    parser.add_argument('--similarity', type=float, help='Minimum cosine similarity for a --semantic-cache hit (default: 0.95)')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RESILIENCE.retry.max_attempts - 1,
+                        help='Retries per provider for rate limits, timeouts and server errors (default: 2)')
+    parser.add_argument('--fallback', action='append', default=[], metavar='PROVIDER[:MODEL]',
+                        help='Provider to fail over to when the primary keeps failing; repeatable')
+    parser.add_argument('--hedge', metavar='PROVIDER[:MODEL]',
+                        help='Send a duplicate request here when the primary is slower than its p95')
+    parser.add_argument('--hedge-after', type=float, default=DEFAULT_RESILIENCE.hedge_after,
+                        help='Seconds before hedging until a p95 has been observed (default: 10)')
+    parser.add_argument('--metrics-file', type=str, default=os.getenv('LLM_API_METRICS_FILE'),
+                        help='Append per-call metrics as JSONL to this file (default: $LLM_API_METRICS_FILE)')
+    parser.add_argument('--prometheus-file', type=str, help='Write aggregated metrics in Prometheus text format to this file')
+    parser.add_argument('--socket', type=str, help='Unix socket for --serve (default: $LLM_API_SOCKET or llm_api.sock in a private per-user directory)')
+    parser.add_argument('--idle-timeout', type=float, help='With --serve, exit after this many idle seconds')
+    parser.add_argument('--verbose-env', action='store_true', help='Report which .env files and keys were loaded')
+    args = parser.parse_args(argv)
+
+    if args.stats:
+        if not args.metrics_file or not os.path.exists(args.metrics_file):
+            parser.error("--stats needs an existing --metrics-file (or $LLM_API_METRICS_FILE)")
+        print(format_metrics_summary(summarize_metrics([args.metrics_file])))
+        return
+
+    if args.serve:
+        warm = [args.provider] + [provider for provider, _ in map(_provider_spec, args.fallback)]
+        if args.hedge:
+            warm.append(_provider_spec(args.hedge)[0])
+        try:
+            serve_daemon(args.socket, warm, args.idle_timeout, verbose_env=args.verbose_env)
+        except ValueError as e:
+            parser.error(str(e))
+        return
+
+    if args.system_file:
+        if args.system:
+            parser.error("--system and --system-file cannot be combined")
+        with open(args.system_file) as f:
+            args.system = f.read()
+
+    load_environment(verbose=args.verbose_env)
+    resilience = ResiliencePolicy(
+        retry=RetryPolicy(max_attempts=args.retries + 1),
+        fallbacks=tuple(_provider_spec(spec) for spec in args.fallback),
+        hedge=_provider_spec(args.hedge) if args.hedge else None,
+        hedge_after=args.hedge_after,
+    )
+    if args.metrics_file:
+        _cli_metrics_sink(JsonlMetricsSink, args.metrics_file)
+    if args.prometheus_file:
+        _cli_metrics_sink(PrometheusTextfileSink, args.prometheus_file)
+    cache = None if args.no_cache else args.cache_dir or True
+    semantic_cache = get_semantic_cache(args.cache_dir) if args.semantic_cache and not args.no_cache else None
+    image_options = None
+    if args.optimize_image or args.image_max_dimension or args.image_format:
+        defaults = ImageOptions.for_provider(args.provider)
+        image_options = ImageOptions(
+            args.image_max_dimension or defaults.max_dimension,
+            args.image_format or defaults.format,
+            args.image_quality,
+        )
+    if args.image and image_options:
+        image = prepare_image_payload(args.image, image_options)
+        print(f"Image: {image.original_bytes} -> {image.encoded_bytes} bytes "
+              f"({image.bytes_saved} saved, {image.mime_type})", file=sys.stderr)
+
+    if args.batch_job:
+        if not args.prompts_file:
+            parser.error("--batch-job needs --prompts-file")
+        try:
+            results = run_batch_job(read_prompts_file(args.prompts_file), provider=args.provider, model=args.model,
+                                    temperature=args.temperature, image_options=image_options, system=args.system,
+                                    job_dir=args.job_dir, poll_interval=args.poll_interval)
+        except Exception as e:
+            print(f"Batch job failed: {e}", file=sys.stderr)
+            sys.exit(1)
+        for result in results:
+            print(json.dumps(result.to_dict(), ensure_ascii=False))
+        sys.exit(0 if all(result.ok for result in results) else 1)
+
+    if args.prompts_file:
+        import asyncio
+        failures = asyncio.run(_stream_batch_to_stdout(read_prompts_file(args.prompts_file), args, cache, image_options, resilience,
+                                                       semantic_cache))
+        sys.exit(1 if failures else 0)
 
     if not args.model:
-        if args.provider == 'openai':
-            args.model = "gpt-4o" 
-        elif args.provider == "deepseek":
-            args.model = "deepseek-chat"
-        elif args.provider == "siliconflow":
-            args.model = "deepseek-ai/DeepSeek-R1"
-        elif args.provider == 'anthropic':
-            args.model = "claude-3-7-sonnet-20250219"
-        elif args.provider == 'gemini':
-            args.model = "gemini-2.0-flash-exp"
-        elif args.provider == 'azure':
-            args.model = os.getenv('AZURE_OPENAI_MODEL_DEPLOYMENT', 'gpt-4o-ms')  # Get from env with fallback
-
-    client = create_llm_client(args.provider)
-    response = query_llm(args.prompt, client, model=args.model, provider=args.provider, image_path=args.image)
+        args.model = default_model(args.provider)
+
+    if args.stream:
+        stats = StreamStats()
+        try:
+            for delta in query_llm_stream(args.prompt, model=args.model, provider=args.provider, image_path=args.image,
+                                          temperature=args.temperature, stats=stats, image_options=image_options,
+                                          system=args.system):
+                print(delta, end="", flush=True)
+            print()
+        except Exception as e:
+            print(f"Error querying LLM: {e}", file=sys.stderr)
+            print("Failed to get response from LLM")
+            sys.exit(1)
+        if stats.time_to_first_token is not None:
+            tokens_per_second = f"{stats.tokens_per_second:.1f}" if stats.tokens_per_second else "n/a"
+            print(f"time to first token: {stats.time_to_first_token:.3f}s, "
+                  f"{stats.output_tokens} tokens, {tokens_per_second} tokens/s, "
+                  f"{stats.cached_tokens} prompt tokens from cache", file=sys.stderr)
+        return
+
+    response = query_llm(args.prompt, model=args.model, provider=args.provider, image_path=args.image,
+                         temperature=args.temperature, cache=cache, force_cache=args.force_cache,
+                         image_options=image_options, resilience=resilience, system=args.system,
+                         semantic_cache=semantic_cache, similarity_threshold=args.similarity)
     if response:
         print(response)
     else:
@@ -0,0 +1,108 @@
+#!/usr/bin/env /workspace/tmp_windsurf/venv/bin/python3
+
+"""
+Thin command-line client for the llm_api daemon.
+
+Takes exactly the same flags as tools/llm_api.py. When a daemon started with
+``tools/llm_api.py --serve`` is listening, the arguments are forwarded over its
+Unix socket, so the call skips SDK imports, .env parsing and TLS setup:
+
+    venv/bin/python3 tools/llm_api.py --serve --provider anthropic &
+    venv/bin/python3 tools/llm_client.py --prompt "What is the capital of France?" --provider anthropic
+
+Without a daemon the request runs in this process, just like llm_api.py. Only
+the standard library is imported before that decision is made.
+"""
+
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+
+def default_socket_path() -> str:
+    """
+    Unix socket the daemon listens on: $LLM_API_SOCKET, or llm_api.sock in a
+    private per-user directory ($XDG_RUNTIME_DIR/llm_api, else llm_api-<uid> in
+    the temp directory).
+    """
+    # Keep in sync with llm_api.default_socket_path.
+    if os.getenv("LLM_API_SOCKET"):
+        return os.environ["LLM_API_SOCKET"]
+    uid = os.getuid() if hasattr(os, "getuid") else os.getenv("USERNAME", "user")
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR")
+    directory = os.path.join(runtime_dir, "llm_api") if runtime_dir else os.path.join(os.getenv("TMPDIR", "/tmp"), f"llm_api-{uid}")
+    return os.path.join(directory, "llm_api.sock")
+
+def _owned_by_user(socket_path: str) -> bool:
+    """True if ``socket_path`` is a socket created by this user, so no one else can be listening on it."""
+    try:
+        info = os.stat(socket_path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid()
+
+def _peer_uid(sock: socket.socket):
+    """The uid of the process on the other end of ``sock``, or None where SO_PEERCRED is unsupported."""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    return struct.unpack("3i", credentials)[1]
+
+def run_via_daemon(argv: list, socket_path: str = None):
+    """
+    Forward a command line to the daemon and relay its output.
+
+    The arguments and working directory are only sent to a daemon run by this
+    user: the socket must be owned by us and, where the platform reports it,
+    so must the process listening on it.
+
+    Returns:
+        Optional[int]: The command's exit status, or None if no daemon is reachable
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    socket_path = socket_path or default_socket_path()
+    if not os.path.exists(socket_path):
+        return None
+    if not _owned_by_user(socket_path):
+        print(f"Warning: ignoring {socket_path}: it is not a socket owned by this user", file=sys.stderr)
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        peer_uid = _peer_uid(sock)
+    except OSError:
+        sock.close()
+        return None
+    if peer_uid is not None and peer_uid != os.getuid():
+        sock.close()
+        print(f"Warning: ignoring {socket_path}: the daemon on it runs as another user", file=sys.stderr)
+        return None
+
+    with sock:
+        sock.sendall((json.dumps({"argv": argv, "cwd": os.getcwd()}) + "\n").encode())
+        streams = {1: sys.stdout, 2: sys.stderr}
+        for line in sock.makefile("rb"):
+            message = json.loads(line)
+            if "exit" in message:
+                return message["exit"]
+            stream = streams[message["fd"]]
+            stream.write(message["data"])
+            stream.flush()
+    print("llm_api daemon closed the connection before the command finished", file=sys.stderr)
+    return 1
+
+def main():
+    argv = sys.argv[1:]
+    code = run_via_daemon(argv)
+    if code is None:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import llm_api
+        llm_api.main(argv)
+        return
+    sys.exit(code)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the OpenAI-compatible and Anthropic chat APIs.
+
+Answers every request by echoing the last user message. It can inject rate
+limits, server errors and slow responses, so retries, circuit breaking,
+hedging, failover and batch load can be exercised offline:
+
+    venv/bin/python3 tools/llm_stub_server.py --port 8006 --error-rate 0.2 --error-status 429 --retry-after 1
+    LOCAL_LLM_BASE_URL=http://127.0.0.1:8006/v1 venv/bin/python3 tools/llm_api.py --prompt "hi" --provider local
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8006 ANTHROPIC_API_KEY=stub venv/bin/python3 tools/llm_api.py --prompt "hi" --provider anthropic
+
+Fault injection can be changed while the server runs by POSTing a JSON object
+with any of the FaultConfig fields to /stub/config; GET /stub/stats returns
+request counters.
+
+The OpenAI Batch (/v1/files, /v1/batches) and Anthropic Message Batches
+(/v1/messages/batches) endpoints are implemented too. Batches finish after
+``batch_latency`` seconds, and error_rate/fail_first apply to each item.
+"""
+
+import argparse
+import email.parser
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass, fields
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+@dataclass
+class FaultConfig:
+    """What the stub does to each request."""
+    latency: float = 0.0  # Seconds added to every response
+    slow_rate: float = 0.0  # Fraction of requests that are slow
+    slow_latency: float = 5.0  # Seconds added to slow requests
+    error_rate: float = 0.0  # Fraction of requests answered with an error
+    error_status: tuple = (500,)  # Statuses to pick from for injected errors
+    fail_first: int = 0  # Fail this many requests before applying error_rate
+    retry_after: Optional[float] = None  # Retry-After header sent with 429/503 errors
+    stream_chunk_delay: float = 0.02  # Seconds between streamed chunks
+    batch_latency: float = 1.0  # Seconds before a submitted batch job completes
+
+class StubState:
+    def __init__(self, config: FaultConfig):
+        self.config = config
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "errors": 0, "slow": 0}
+        self.prompt_prefixes = set()
+        self.ids = itertools.count(1)
+        self.files = {}  # OpenAI file id -> bytes
+        self.batches = {}  # Batch id -> batch object (OpenAI) or message batch (Anthropic)
+        self.batch_results = {}  # Anthropic batch id -> JSONL bytes
+
+    def next_fault(self) -> tuple:
+        """Decide (error_status or None, extra_latency) for the next request."""
+        with self.lock:
+            self.counters["requests"] += 1
+            config = self.config
+            status = None
+            if self.counters["requests"] <= config.fail_first or random.random() < config.error_rate:
+                status = random.choice(config.error_status)
+                self.counters["errors"] += 1
+            latency = config.latency
+            if random.random() < config.slow_rate:
+                latency += config.slow_latency
+                self.counters["slow"] += 1
+            return status, latency
+
+    def cached_prefix_tokens(self, prefix) -> int:
+        """Simulate prompt caching: a prefix seen before is reported as cached."""
+        if not prefix:
+            return 0
+        key = json.dumps(prefix, sort_keys=True)
+        with self.lock:
+            seen = key in self.prompt_prefixes
+            self.prompt_prefixes.add(key)
+        return len(key) // 4 if seen else 0
+
+    def item_error(self) -> Optional[int]:
+        """Error status for one batch item, applying fail_first and error_rate."""
+        with self.lock:
+            self.counters["requests"] += 1
+            if self.counters["requests"] <= self.config.fail_first or random.random() < self.config.error_rate:
+                self.counters["errors"] += 1
+                return random.choice(self.config.error_status)
+            return None
+
+    def update(self, values: dict):
+        with self.lock:
+            known = {f.name for f in fields(FaultConfig)}
+            for name, value in values.items():
+                if name not in known:
+                    raise ValueError(f"Unknown stub setting: {name}")
+                setattr(self.config, name, tuple(value) if name == "error_status" else value)
+
+def _timestamp(seconds: float) -> str:
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat().replace("+00:00", "Z")
+
+def _parse_multipart(content_type: str, body: bytes) -> dict:
+    """Return {field name: bytes} for a multipart/form-data body."""
+    message = email.parser.BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    return {part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+            for part in message.get_payload()}
+
+def _last_user_text(messages: list) -> str:
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            content = message.get("content")
+            if isinstance(content, str):
+                return content
+            return " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+    return ""
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: StubState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: dict, headers: Optional[dict] = None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _stream_events(self, events):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for event_name, payload in events:
+            prefix = f"event: {event_name}\n".encode() if event_name else b""
+            data = payload if isinstance(payload, str) else json.dumps(payload)
+            self._send_chunk(prefix + f"data: {data}\n\n".encode())
+            time.sleep(self.state.config.stream_chunk_delay)
+        self._send_chunk(b"")
+
+    def _send_bytes(self, data: bytes, content_type: str = "application/jsonl"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        parts = path.strip("/").split("/")
+        if path == "/stub/stats":
+            with self.state.lock:
+                return self._send_json(200, {**self.state.counters, "config": asdict(self.state.config)})
+        if path.startswith("/v1/files/") and path.endswith("/content") and parts[2] in self.state.files:
+            return self._send_bytes(self.state.files[parts[2]])
+        if path.startswith("/v1/batches/") and parts[-1] in self.state.batches:
+            return self._send_json(200, self._refresh_batch(parts[-1]))
+        if path.startswith("/v1/messages/batches/"):
+            if parts[-1] == "results" and parts[-2] in self.state.batch_results:
+                return self._send_bytes(self.state.batch_results[parts[-2]])
+            if parts[-1] in self.state.batches:
+                return self._send_json(200, self._refresh_batch(parts[-1]))
+        self._send_json(404, {"error": {"type": "not_found_error", "message": f"No route for GET {self.path}"}})
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        if path == "/v1/files":
+            return self._upload_file()
+        body = self._read_json()
+        if path == "/stub/config":
+            try:
+                self.state.update(body)
+            except ValueError as e:
+                return self._send_json(400, {"error": {"message": str(e)}})
+            return self._send_json(200, asdict(self.state.config))
+        if path == "/v1/batches":
+            return self._create_openai_batch(body)
+        if path == "/v1/messages/batches":
+            return self._create_anthropic_batch(body)
+
+        status, latency = self.state.next_fault()
+        if latency:
+            time.sleep(latency)
+        if status is not None:
+            headers = {}
+            if status in (429, 503) and self.state.config.retry_after is not None:
+                headers["Retry-After"] = str(self.state.config.retry_after)
+            return self._send_json(status, {"error": {"type": "stub_error", "message": f"Injected {status}"}}, headers)
+
+        if path.endswith("/chat/completions"):
+            self._chat_completion(body)
+        elif path.endswith("/messages"):
+            self._anthropic_message(body)
+        else:
+            self._send_json(404, {"error": {"message": f"No route for POST {self.path}"}})
+
+    def _upload_file(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = _parse_multipart(self.headers.get("Content-Type", ""), self.rfile.read(length))
+        file_id = f"file-stub{next(self.state.ids)}"
+        self.state.files[file_id] = form["file"]
+        self._send_json(200, {"id": file_id, "object": "file", "bytes": len(form["file"]), "created_at": int(time.time()),
+                              "filename": "batch.jsonl", "purpose": (form.get("purpose") or b"batch").decode(),
+                              "status": "processed"})
+
+    def _create_openai_batch(self, body: dict):
+        if body.get("input_file_id") not in self.state.files:
+            return self._send_json(400, {"error": {"type": "invalid_request_error", "message": "Unknown input_file_id"}})
+        batch_id = f"batch_stub{next(self.state.ids)}"
+        self.state.batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": body.get("endpoint"), "input_file_id": body["input_file_id"],
+            "completion_window": body.get("completion_window", "24h"), "status": "in_progress",
+            "created_at": int(time.time()), "output_file_id": None, "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        self._send_json(200, self.state.batches[batch_id])
+
+    def _create_anthropic_batch(self, body: dict):
+        batch_id = f"msgbatch_stub{next(self.state.ids)}"
+        now = time.time()
+        self.state.batches[batch_id] = {
+            "id": batch_id, "type": "message_batch", "processing_status": "in_progress",
+            "request_counts": {"processing": len(body.get("requests", [])), "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0},
+            "created_at": _timestamp(now), "expires_at": _timestamp(now + 24 * 3600), "ended_at": None,
+            "archived_at": None, "cancel_initiated_at": None, "results_url": None, "requests": body.get("requests", []),
+        }
+        self._send_json(200, {key: value for key, value in self.state.batches[batch_id].items() if key != "requests"})
+
+    def _refresh_batch(self, batch_id: str) -> dict:
+        """Return the batch, running its items once batch_latency has passed since creation."""
+        with self.state.lock:
+            batch = self.state.batches[batch_id]
+            created = batch["created_at"]
+            if isinstance(created, str):
+                created = datetime.fromisoformat(created.replace("Z", "+00:00")).timestamp()
+            finished = batch.get("status") == "completed" or batch.get("processing_status") == "ended"
+            due = not finished and time.time() - created >= self.state.config.batch_latency
+        if due:
+            if batch.get("object") == "batch":
+                self._finish_openai_batch(batch)
+            else:
+                self._finish_anthropic_batch(batch)
+        return {key: value for key, value in batch.items() if key != "requests"}
+
+    def _finish_openai_batch(self, batch: dict):
+        output, errors = [], []
+        for line in self.state.files[batch["input_file_id"]].decode().splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            status = self.state.item_error()
+            if status is None:
+                response = {"status_code": 200, "request_id": "req_stub", "body": self._chat_completion_body(request["body"])}
+                output.append({"id": "batch_req_stub", "custom_id": request["custom_id"], "response": response, "error": None})
+            else:
+                response = {"status_code": status, "request_id": "req_stub",
+                            "body": {"error": {"type": "stub_error", "message": f"Injected {status}"}}}
+                errors.append({"id": "batch_req_stub", "custom_id": request["custom_id"], "response": response, "error": None})
+        for name, lines in (("output_file_id", output), ("error_file_id", errors)):
+            if lines:
+                file_id = f"file-stub{next(self.state.ids)}"
+                self.state.files[file_id] = "".join(json.dumps(line) + "\n" for line in lines).encode()
+                batch[name] = file_id
+        batch["request_counts"] = {"total": len(output) + len(errors), "completed": len(output), "failed": len(errors)}
+        batch["completed_at"] = int(time.time())
+        batch["status"] = "completed"
+
+    def _finish_anthropic_batch(self, batch: dict):
+        results = []
+        counts = {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0}
+        for request in batch["requests"]:
+            status = self.state.item_error()
+            if status is None:
+                result = {"type": "succeeded", "message": self._anthropic_message_body(request["params"])}
+                counts["succeeded"] += 1
+            else:
+                result = {"type": "errored", "error": {"type": "error", "error": {"type": "api_error", "message": f"Injected {status}"}}}
+                counts["errored"] += 1
+            results.append({"custom_id": request["custom_id"], "result": result})
+        host, port = self.server.server_address[:2]
+        self.state.batch_results[batch["id"]] = "".join(json.dumps(line) + "\n" for line in results).encode()
+        batch.update(request_counts=counts, processing_status="ended", ended_at=_timestamp(time.time()),
+                     results_url=f"http://{host}:{port}/v1/messages/batches/{batch['id']}/results")
+
+    def _chat_completion(self, body: dict):
+        completion = self._chat_completion_body(body)
+        if not body.get("stream"):
+            return self._send_json(200, completion)
+        text, usage = completion["choices"][0]["message"]["content"], completion["usage"]
+        base = {key: completion[key] for key in ("id", "created", "model")}
+        events = []
+        for word in text.split(" "):
+            events.append((None, {**base, "object": "chat.completion.chunk",
+                                  "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}))
+        if body.get("stream_options", {}).get("include_usage"):
+            events.append((None, {**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}))
+        events.append((None, "[DONE]"))
+        self._stream_events(events)
+
+    def _chat_completion_body(self, body: dict) -> dict:
+        text = "echo: " + _last_user_text(body.get("messages", []))
+        usage = {"prompt_tokens": len(json.dumps(body.get("messages"))) // 4, "completion_tokens": len(text) // 4}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        # Every message before the new turn is the automatically cached prefix
+        cached = self.state.cached_prefix_tokens(body.get("messages", [])[:-1])
+        usage["prompt_tokens_details"] = {"cached_tokens": min(cached, usage["prompt_tokens"])}
+        return {
+            "id": "chatcmpl-stub", "created": int(time.time()), "model": body.get("model", "stub"),
+            "object": "chat.completion",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    def _anthropic_message(self, body: dict):
+        message = self._anthropic_message_body(body)
+        if not body.get("stream"):
+            return self._send_json(200, message)
+        text, usage = message["content"][0]["text"], message["usage"]
+        events = [("message_start", {"type": "message_start", "message": {**message, "content": [], "usage": {**usage, "output_tokens": 0}}}),
+                  ("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})]
+        for word in text.split(" "):
+            events.append(("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                   "delta": {"type": "text_delta", "text": word + " "}}))
+        events += [("content_block_stop", {"type": "content_block_stop", "index": 0}),
+                   ("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                      "usage": {"output_tokens": usage["output_tokens"]}}),
+                   ("message_stop", {"type": "message_stop"})]
+        self._stream_events(events)
+
+    def _anthropic_message_body(self, body: dict) -> dict:
+        text = "echo: " + _last_user_text(body.get("messages", []))
+        usage = {"input_tokens": len(json.dumps(body.get("messages"))) // 4, "output_tokens": len(text) // 4}
+        # Only the system prompt, when marked with a cache_control breakpoint, is cached
+        system = body.get("system")
+        if isinstance(system, list) and system and "cache_control" in system[-1]:
+            cached = self.state.cached_prefix_tokens(system)
+            usage["cache_read_input_tokens"] = cached
+            usage["cache_creation_input_tokens"] = 0 if cached else len(json.dumps(system)) // 4
+        return {
+            "id": "msg_stub", "type": "message", "role": "assistant", "model": body.get("model", "stub"),
+            "content": [{"type": "text", "text": text}], "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": usage,
+        }
+
+def start_stub_server(host: str = "127.0.0.1", port: int = 0, config: Optional[FaultConfig] = None) -> ThreadingHTTPServer:
+    """
+    Start the stub in a background thread and return the server.
+
+    Port 0 picks a free port; read it back from ``server.server_address``.
+    Call ``server.shutdown()`` to stop it.
+    """
+    handler = type("BoundStubHandler", (StubHandler,), {"state": StubState(config or FaultConfig())})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local OpenAI/Anthropic-compatible stub LLM server with fault injection')
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8006, help='Port to listen on (default: 8006)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='Fraction of requests that are slow')
+    parser.add_argument('--slow-latency', type=float, default=5.0, help='Extra seconds for slow requests (default: 5)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with an error')
+    parser.add_argument('--error-status', type=int, action='append', help='Status code for injected errors; repeatable (default: 500)')
+    parser.add_argument('--fail-first', type=int, default=0, help='Fail this many requests before applying --error-rate')
+    parser.add_argument('--retry-after', type=float, help='Retry-After seconds sent with injected 429/503 errors')
+    parser.add_argument('--batch-latency', type=float, default=1.0, help='Seconds before submitted batch jobs complete (default: 1)')
+    args = parser.parse_args()
+
+    config = FaultConfig(
+        latency=args.latency,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency,
+        error_rate=args.error_rate,
+        error_status=tuple(args.error_status or (500,)),
+        fail_first=args.fail_first,
+        retry_after=args.retry_after,
+        batch_latency=args.batch_latency,
+    )
+    server = start_stub_server(args.host, args.port, config)
+    print(f"Stub LLM server listening on http://{args.host}:{server.server_address[1]}", file=sys.stderr)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
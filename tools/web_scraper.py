@@ -2,14 +2,37 @@
 
 import asyncio
 import argparse
+import atexit
+import base64
+import bisect
+import codecs
+import contextlib
+import functools
+import gzip
+import hashlib
+import heapq
+import importlib.util
+import json
+import shutil
+import signal
+import sqlite3
+import subprocess
 import sys
 import os
-from typing import List, Optional
-from playwright.async_api import async_playwright
+import re
+import tempfile
+import threading
+import urllib.request
+import urllib.robotparser
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
 import html5lib
-from multiprocessing import Pool
 import time
-from urllib.parse import urlparse
+from urllib.parse import parse_qsl, urldefrag, urlencode, urljoin, urlparse, urlsplit, urlunsplit
 import logging
 
 # Configure logging
@@ -19,15 +42,672 @@ logging.basicConfig(
     stream=sys.stderr
 )
 logger = logging.getLogger(__name__)
+# httpx logs every request at INFO; the scraper reports per-URL outcomes itself
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
-async def fetch_page(url: str, context) -> Optional[str]:
-    """Asynchronously fetch a webpage's content."""
+@dataclass
+class PageResult:
+    """Outcome of scraping one URL."""
+    url: str
+    text: str = ""
+    index: Optional[int] = None  # Position in the input URL list
+    html: Optional[str] = None
+    tier: Optional[str] = None  # "http" or "browser": which fetcher served the page
+    status: Optional[int] = None
+    escalation: Optional[str] = None  # Why the plain HTTP result was not used, if it wasn't
+    error: Optional[str] = None
+    elapsed: float = 0.0
+    timings: Optional[Dict[str, float]] = None  # Seconds per phase, see fetch_page and PageFetcher.fetch
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    cache: Optional[str] = None  # "hit" or "revalidated" when served from the PageCache
+    final_url: Optional[str] = None  # After redirects, when known
+    depth: int = 0  # Link distance from the seed URLs in crawl mode
+    links: Optional[List[str]] = None  # Absolute URLs the page links to, in crawl mode or with links=True
+    size: Optional[int] = None  # Bytes of HTML, as received over HTTP or serialized by the browser
+    reduction: Optional[float] = None  # Fraction of the text dropped by main-content extraction
+    truncated: bool = False  # The HTML was cut off at the maximum page size
+    fingerprint: Optional[int] = None  # SimHash of the text, when a Deduplicator is in use
+    duplicate_of: Optional[str] = None  # URL of an earlier page this one nearly duplicates (its text is dropped)
+    similarity: Optional[float] = None  # Fingerprint similarity to ``duplicate_of``
+    repeated_lines: int = 0  # Lines dropped because earlier pages already had them
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+USER_AGENT = ("Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+              "Chrome/124.0 Safari/537.36")
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml")
+# Bodies are cut off after this many bytes, and pages declaring more are not rendered in the browser
+DEFAULT_MAX_PAGE_SIZE = 10 * 1024 * 1024
+# Pages with less visible text than this that still load scripts are treated as JS-rendered shells.
+MIN_STATIC_TEXT = 200
+
+_SCRIPT_OR_STYLE = re.compile(r"<(script|style|noscript|template)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+_SCRIPT_TAG = re.compile(r"<script\b", re.IGNORECASE)
+_TAG = re.compile(r"<[^>]+>")
+_EMPTY_APP_ROOT = re.compile(
+    r"<(div|main|body)\b[^>]*\bid=[\"']?(root|app|__next|__nuxt|svelte|ember-app)\b[^>]*>\s*</\1>", re.IGNORECASE)
+_NEEDS_JAVASCRIPT = re.compile(r"<noscript\b[^>]*>[^<]*(enable|requires?|turn on)\s+javascript", re.IGNORECASE)
+_BOT_CHALLENGE = re.compile(r"cf-chl|challenge-platform|just a moment\.\.\.|captcha", re.IGNORECASE)
+
+def needs_browser(html: str, status: int = 200) -> Optional[str]:
+    """
+    Decide whether a page fetched over plain HTTP has to be rendered in a browser.
+
+    Returns:
+        Optional[str]: The reason to escalate, or None if the static HTML is usable
+    """
+    if status in (403, 429, 503) and _BOT_CHALLENGE.search(html):
+        return "bot-challenge"
+    if _EMPTY_APP_ROOT.search(html):
+        return "empty-app-root"
+    if _NEEDS_JAVASCRIPT.search(html):
+        return "noscript-warning"
+    visible = " ".join(_TAG.sub(" ", _SCRIPT_OR_STYLE.sub(" ", html)).split())
+    if len(visible) < MIN_STATIC_TEXT and _SCRIPT_TAG.search(html):
+        return "js-shell"
+    return None
+
+# Bytes searched for a <meta charset> or http-equiv Content-Type declaration
+ENCODING_SNIFF_BYTES = 4096
+_META_CHARSET = re.compile(rb"<meta\b[^>]*?charset\s*=\s*[\"']?\s*([a-z0-9_.:-]+)", re.IGNORECASE)
+_BOMS = ((codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"))
+
+def detect_encoding(body: bytes, declared: Optional[str] = None) -> Optional[str]:
+    """
+    Work out how an HTML body is encoded: from its byte order mark, else the
+    charset ``declared`` in the Content-Type header, else a <meta> declaration
+    in its first ENCODING_SNIFF_BYTES, else by checking that it is valid UTF-8,
+    else by charset_normalizer's detection when that is installed.
+
+    Returns:
+        Optional[str]: A codec name, or None if the encoding cannot be told
+    """
+    for bom, encoding in _BOMS:
+        if body.startswith(bom):
+            return encoding
+    match = _META_CHARSET.search(body[:ENCODING_SNIFF_BYTES])
+    for candidate, source in ((declared, "header"), (match and match.group(1).decode("ascii"), "meta")):
+        if not candidate:
+            continue
+        try:
+            encoding = codecs.lookup(candidate).name
+        except LookupError:  # Unknown charset name
+            continue
+        # A <meta> tag readable as ASCII cannot really be UTF-16; browsers read such pages as UTF-8
+        return "utf-8" if source == "meta" and encoding.startswith("utf-16") else encoding
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(body)  # Not final: a cut-off last character is fine
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    if importlib.util.find_spec("charset_normalizer"):
+        from charset_normalizer import from_bytes
+        best = from_bytes(body[:64 * 1024]).best()
+        if best is not None:
+            return best.encoding
+    return None
+
+def _host_matches(url: str, hosts: Iterable[str]) -> bool:
+    host = (urlparse(url).hostname or "").lower()
+    return any(host == pattern or host.endswith("." + pattern) for pattern in hosts)
+
+def create_http_client(max_connections: int = 20):
+    """
+    Pooled async HTTP client for the fast tier.
+
+    Uses keep-alive connections, HTTP/2 when the h2 package is installed and
+    advertises Brotli when a Brotli decoder is installed (gzip otherwise).
+    """
+    import httpx
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+    encodings = ["gzip", "deflate"]
+    try:
+        import brotli  # noqa: F401
+        encodings.append("br")
+    except ImportError:
+        try:
+            import brotlicffi  # noqa: F401
+            encodings.append("br")
+        except ImportError:
+            pass
+    return httpx.AsyncClient(
+        http2=http2,
+        follow_redirects=True,
+        timeout=httpx.Timeout(20.0, connect=10.0),
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        headers={
+            "User-Agent": USER_AGENT,
+            "Accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.8",
+            "Accept-Encoding": ", ".join(encodings),
+            "Accept-Language": "en-US,en;q=0.8",
+        },
+    )
+
+def unsupported_content(content_type: str) -> Optional[str]:
+    """Why a response with this Content-Type (parameters stripped, lower case) is not scraped, or None."""
+    if content_type and content_type not in HTML_CONTENT_TYPES and not content_type.startswith("text/"):
+        return f"Unsupported content type: {content_type}"
+    return None
+
+async def fetch_page_http(url: str, client, validators: Optional[Dict[str, str]] = None,
+                          max_size: Optional[int] = DEFAULT_MAX_PAGE_SIZE) -> PageResult:
+    """
+    Fetch a page with a plain HTTP GET; ``escalation`` is set if it needs a browser instead.
+
+    With ``validators`` ("etag" and/or "last_modified" of a cached copy) the
+    request is conditional, and an unchanged page comes back as status 304
+    without HTML.
+
+    The body is streamed: unsupported content types, and bodies without a
+    Content-Type that turn out to be binary, are skipped before it is read,
+    and reading stops after ``max_size`` bytes with ``truncated`` set. A
+    truncated page is never escalated to the browser, which would load all of it.
+    The body is decoded as detect_encoding() decides; a page whose encoding
+    cannot be told is escalated rather than decoded as UTF-8.
+    """
+    result = PageResult(url, tier="http")
+    headers = {}
+    if validators and validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators and validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    try:
+        logger.info(f"Fetching {url} over HTTP")
+        async with client.stream("GET", url, headers=headers) as response:
+            result.status = response.status_code
+            result.final_url = str(response.url)
+            result.etag = response.headers.get("etag")
+            result.last_modified = response.headers.get("last-modified")
+            if response.status_code == 304:
+                return result
+            content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+            result.error = unsupported_content(content_type)
+            if result.error:
+                return result
+            chunks = []
+            size = 0
+            async for chunk in response.aiter_bytes():
+                if not size and not content_type and b"\0" in chunk[:1024]:
+                    result.error = "Binary content"
+                    return result
+                if max_size and size + len(chunk) > max_size:
+                    chunks.append(chunk[:max_size - size])
+                    size = max_size
+                    result.truncated = True
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+        result.escalation = "http-error"
+        return result
+    body = b"".join(chunks)
+    encoding = detect_encoding(body, response.charset_encoding)
+    result.html = body.decode(encoding or "utf-8", errors="replace")
+    result.size = size
+    if result.truncated:
+        logger.warning(f"{url} is larger than {max_size} bytes; using the first {max_size}")
+    elif encoding is None:
+        result.escalation = "unknown-encoding"  # The browser's own detection beats garbled text
+    else:
+        result.escalation = needs_browser(result.html, response.status_code)
+    if result.escalation is None and response.status_code >= 400:
+        result.error = f"HTTP {response.status_code}"
+    return result
+
+# Playwright resource types that text extraction never needs
+DEFAULT_BLOCKED_RESOURCES = ("image", "media", "font")
+# Ads, analytics and trackers (subdomains included)
+DEFAULT_BLOCKED_DOMAINS = (
+    "doubleclick.net", "googlesyndication.com", "googleadservices.com", "google-analytics.com",
+    "googletagmanager.com", "googletagservices.com", "adservice.google.com", "amazon-adsystem.com",
+    "facebook.net", "hotjar.com", "scorecardresearch.com", "quantserve.com", "taboola.com",
+    "outbrain.com", "criteo.com", "adnxs.com", "segment.io", "mixpanel.com", "nr-data.net", "clarity.ms",
+)
+# Readiness strategies that are plain Playwright load states
+LOAD_STATES = ("networkidle", "load", "domcontentloaded")
+
+# Resolves once the DOM has gone ``quiet`` ms without a mutation, or after ``limit`` ms regardless
+_DOM_QUIET_JS = """([quiet, limit]) => new Promise(resolve => {
+    let timer;
+    const observer = new MutationObserver(() => { clearTimeout(timer); timer = setTimeout(done, quiet); });
+    const deadline = setTimeout(done, limit);
+    function done() { observer.disconnect(); clearTimeout(timer); clearTimeout(deadline); resolve(); }
+    observer.observe(document, {subtree: true, childList: true, characterData: true, attributes: true});
+    timer = setTimeout(done, quiet);
+})"""
+
+@dataclass
+class BrowserOptions:
+    """
+    How the browser tier gets its browser and loads a page.
+
+    ``ready`` decides when the page counts as rendered: one of LOAD_STATES,
+    ``"selector:<css>"`` (an element matching the selector is attached) or
+    ``"quiet:<ms>"`` (no DOM mutations for that many milliseconds).
+    """
+    block_resources: Tuple[str, ...] = DEFAULT_BLOCKED_RESOURCES
+    block_domains: Tuple[str, ...] = DEFAULT_BLOCKED_DOMAINS
+    ready: str = "networkidle"
+    timeout: float = 30.0  # Seconds allowed for navigation and, separately, for the readiness wait
+    # Browser service to connect to over CDP (default: browser_service_endpoint()); "" always launches Chromium
+    cdp_url: Optional[str] = None
+    recycle_after: int = 50  # Pages served by a browser context before it is replaced with a fresh one
+
+    def __post_init__(self):
+        self.block_resources = tuple(self.block_resources)
+        self.block_domains = tuple(domain.lower() for domain in self.block_domains)
+        kind, arg = self.ready_strategy
+        if kind not in LOAD_STATES + ("selector", "quiet") or (kind in LOAD_STATES and arg):
+            raise ValueError(f"Unknown readiness strategy: {self.ready}")
+        if kind == "selector" and not arg:
+            raise ValueError("The selector readiness strategy needs a CSS selector, e.g. selector:article")
+        if kind == "quiet" and not arg.isdigit():
+            raise ValueError("The quiet readiness strategy needs milliseconds, e.g. quiet:500")
+        if self.recycle_after < 1:
+            raise ValueError("recycle_after must be at least 1")
+
+    @property
+    def ready_strategy(self) -> Tuple[str, str]:
+        kind, _, arg = self.ready.partition(":")
+        return kind, arg
+
+    def blocks(self, request) -> bool:
+        """Whether a Playwright request should be aborted."""
+        return request.resource_type in self.block_resources or _host_matches(request.url, self.block_domains)
+
+class BrowserFetcher:
+    """
+    Headless Chromium, started on first use, with one context per concurrent fetch.
+
+    Connects over CDP to the browser service (see BrowserService) when one is
+    running, which saves launching Chromium; otherwise launches it in-process.
+    Each context is replaced after serving ``options.recycle_after`` pages.
+    """
+
+    def __init__(self, max_concurrent: int = 5, options: Optional[BrowserOptions] = None,
+                 max_page_size: Optional[int] = DEFAULT_MAX_PAGE_SIZE):
+        self.max_concurrent = max_concurrent
+        self.options = options or BrowserOptions()
+        self.max_page_size = max_page_size
+        self.remote = False  # Whether the browser belongs to the browser service
+        self._playwright = None
+        self._browser = None
+        self._contexts = None
+        self._start_error = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        cdp_url = browser_service_endpoint() if self.options.cdp_url is None else self.options.cdp_url
+        if cdp_url:
+            try:
+                self._browser = await self._playwright.chromium.connect_over_cdp(cdp_url, timeout=5000)
+                self.remote = True
+                logger.info(f"Using the browser service at {cdp_url}")
+                return
+            except Exception as e:
+                logger.warning(f"Browser service at {cdp_url} unavailable, launching Chromium: {e}")
+        self._browser = await self._playwright.chromium.launch()
+
+    async def _start(self):
+        async with self._lock:
+            if self._start_error is not None:
+                raise self._start_error  # Do not relaunch a browser that already failed for every URL
+            if self._contexts is None:
+                try:
+                    from playwright.async_api import async_playwright
+                    self._playwright = await async_playwright().start()
+                    await self._connect()
+                except Exception as e:
+                    self._start_error = e
+                    raise
+                self._contexts = asyncio.Queue()
+                for _ in range(self.max_concurrent):
+                    self._contexts.put_nowait((await self._browser.new_context(), 0))
+
+    async def fetch(self, url: str) -> PageResult:
+        await self._start()
+        context, served = await self._contexts.get()
+        try:
+            started = time.monotonic()
+            timings = {}
+            outcome = {}
+            html = await fetch_page(url, context, self.options, timings, self.max_page_size, outcome)
+            result = PageResult(url, html=html, tier="browser", status=outcome.get("status"),
+                                final_url=outcome.get("final_url"), elapsed=time.monotonic() - started,
+                                timings=timings, size=len(html.encode("utf-8")) if html is not None else None,
+                                truncated=outcome.get("truncated", False))
+            if html is None:
+                result.error = outcome.get("skipped", "Browser fetch failed")
+            return result
+        finally:
+            served += 1
+            if served >= self.options.recycle_after:
+                # Drop the context's accumulated caches, storage and leaked documents. The old context is
+                # closed only once its replacement exists, so the pool never holds a closed context.
+                try:
+                    fresh = await self._browser.new_context()
+                except Exception as e:
+                    logger.warning(f"Could not recycle a browser context, reusing it: {e}")
+                else:
+                    old, context, served = context, fresh, 0
+                    try:
+                        await old.close()
+                    except Exception as e:
+                        logger.warning(f"Could not close a recycled browser context: {e}")
+            self._contexts.put_nowait((context, served))
+
+    async def close(self):
+        if self._contexts is not None:
+            while not self._contexts.empty():
+                await self._contexts.get_nowait()[0].close()
+            await self._browser.close()  # Only disconnects from a browser service
+            await self._playwright.stop()
+            self._contexts = None
+
+def browser_service_state_path() -> str:
+    """
+    File where a running browser service records its CDP endpoint, in a private
+    per-user directory ($XDG_RUNTIME_DIR/web_scraper, else web_scraper-<uid> in
+    the temp directory).
+    """
+    uid = os.getuid() if hasattr(os, "getuid") else os.getenv("USERNAME", "user")
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR")
+    directory = (os.path.join(runtime_dir, "web_scraper") if runtime_dir
+                 else os.path.join(os.getenv("TMPDIR", "/tmp"), f"web_scraper-{uid}"))
+    return os.path.join(directory, "browser.json")
+
+def _private_to_user(path: str) -> bool:
+    """Whether ``path`` is owned by this user and closed to everyone else."""
+    if not hasattr(os, "getuid"):
+        return True
+    info = os.lstat(path)
+    return info.st_uid == os.getuid() and not info.st_mode & 0o077
+
+def _read_browser_service_state() -> Optional[dict]:
+    """The running service's state, or None; a file another user could have written is ignored."""
+    path = browser_service_state_path()
+    try:
+        if not (_private_to_user(os.path.dirname(path)) and _private_to_user(path)):
+            logger.warning(f"Ignoring {path}: it must be owned by this user and not accessible to others")
+            return None
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def browser_service_endpoint() -> Optional[str]:
+    """CDP endpoint of the browser service: $WEB_SCRAPER_CDP_URL, else the running service's, else None."""
+    if os.getenv("WEB_SCRAPER_CDP_URL"):
+        return os.environ["WEB_SCRAPER_CDP_URL"]
+    state = _read_browser_service_state()
+    return state.get("endpoint") if isinstance(state, dict) else None
+
+def _cdp_get(endpoint: str, path: str, timeout: float = 2.0):
+    with urllib.request.urlopen(endpoint + path, timeout=timeout) as response:
+        return json.load(response)
+
+def _process_tree_rss(pid: int) -> Optional[int]:
+    """Resident memory in bytes of a process and all its descendants, or None where /proc is unavailable."""
+    try:
+        parents = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        # The command name may contain spaces; the parent pid follows its closing parenthesis
+                        parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+    except OSError:
+        return None
+    tree, frontier = {pid}, [pid]
+    while frontier:
+        parent = frontier.pop()
+        children = [child for child, ppid in parents.items() if ppid == parent and child not in tree]
+        tree.update(children)
+        frontier.extend(children)
+    rss = 0
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    for member in tree:
+        try:
+            with open(f"/proc/{member}/statm") as f:
+                rss += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            continue
+    return rss
+
+class BrowserService:
+    """
+    Long-lived headless Chromium that scraper runs attach to over CDP.
+
+    Every run otherwise pays for launching and tearing down Chromium. The
+    service publishes its endpoint in browser_service_state_path(), checks
+    every ``check_interval`` seconds that Chromium still answers (relaunching
+    it after a crash) and restarts it once its process tree uses more than
+    ``max_memory_mb`` while no pages are open.
+    """
+
+    def __init__(self, port: int = 0, max_memory_mb: int = 2048, check_interval: float = 5.0,
+                 executable: Optional[str] = None):
+        self.port = port
+        self.max_memory_mb = max_memory_mb
+        self.check_interval = check_interval
+        self.executable = executable
+        self.endpoint = None
+        self._process = None
+        self._profile_dir = None
+        self._stopping = False
+
+    def _executable(self) -> str:
+        if self.executable is None:
+            from playwright.sync_api import sync_playwright
+            with sync_playwright() as playwright:
+                self.executable = playwright.chromium.executable_path
+        return self.executable
+
+    def start(self):
+        self._profile_dir = tempfile.mkdtemp(prefix="web_scraper-browser-")
+        # With port 0 Chromium binds a random free port on every launch and reports it in
+        # DevToolsActivePort inside the (private) profile; the endpoint is only published in
+        # the state file, which other users cannot read
+        self._process = subprocess.Popen(
+            [self._executable(), "--headless", "--no-sandbox", "--no-first-run", "--no-default-browser-check",
+             "--disable-background-networking", "--disable-dev-shm-usage", "--mute-audio",
+             "--remote-debugging-address=127.0.0.1", f"--remote-debugging-port={self.port}",
+             f"--user-data-dir={self._profile_dir}", "about:blank"],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.endpoint = None
+        deadline = time.monotonic() + 30
+        while not self.healthy():
+            if self._process.poll() is not None or time.monotonic() > deadline:
+                self.stop()
+                raise RuntimeError(f"Chromium did not start (exit code {self._process.returncode})")
+            time.sleep(0.1)
+            if self.endpoint is None:
+                self.endpoint = self._active_endpoint()
+        state_path = browser_service_state_path()
+        directory = os.path.dirname(state_path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        if not _private_to_user(directory):
+            self.stop()
+            raise RuntimeError(f"{directory} must be owned by this user and not accessible to others (mode 0700)")
+        tmp_path = f"{state_path}.{os.getpid()}.tmp"
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump({"endpoint": self.endpoint, "pid": os.getpid(), "browser_pid": self._process.pid}, f)
+        os.replace(tmp_path, state_path)
+        logger.info(f"Browser service listening on {self.endpoint} (Chromium pid {self._process.pid})")
+
+    def _active_endpoint(self) -> Optional[str]:
+        """The endpoint Chromium reports in DevToolsActivePort once it is listening, else None."""
+        try:
+            with open(os.path.join(self._profile_dir, "DevToolsActivePort")) as f:
+                port = int(f.readline())
+        except (OSError, ValueError):
+            return None
+        return f"http://127.0.0.1:{port}"
+
+    def stop(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+        if self._profile_dir is not None:
+            shutil.rmtree(self._profile_dir, ignore_errors=True)
+            self._profile_dir = None
+
+    def restart(self, reason: str):
+        logger.warning(f"Restarting the browser service's Chromium: {reason}")
+        self.stop()
+        self.start()
+
+    def healthy(self) -> bool:
+        if self.endpoint is None or self._process is None or self._process.poll() is not None:
+            return False
+        try:
+            _cdp_get(self.endpoint, "/json/version")
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def busy(self) -> bool:
+        """Whether any client has a page open (the service's own blank tab does not count)."""
+        try:
+            targets = _cdp_get(self.endpoint, "/json/list")
+        except (OSError, ValueError):
+            return True
+        return any(target.get("type") == "page" and target.get("url") != "about:blank" for target in targets)
+
+    def serve(self):
+        """Run until SIGTERM or Ctrl-C."""
+        def request_stop(signum, frame):
+            self._stopping = True
+        signal.signal(signal.SIGTERM, request_stop)
+        self.start()
+        next_check = time.monotonic() + self.check_interval
+        try:
+            while not self._stopping:
+                time.sleep(0.5)
+                if self._stopping or time.monotonic() < next_check:
+                    continue
+                next_check = time.monotonic() + self.check_interval
+                try:
+                    if not self.healthy():
+                        self.restart("health check failed")
+                        continue
+                    rss = _process_tree_rss(self._process.pid)
+                    if rss is not None and rss > self.max_memory_mb * 2 ** 20 and not self.busy():
+                        self.restart(f"using {rss / 2 ** 20:.0f} MB")
+                except RuntimeError as e:
+                    logger.error(f"{e}; retrying in {self.check_interval:g}s")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            state = _read_browser_service_state()
+            if isinstance(state, dict) and state.get("pid") == os.getpid():
+                os.remove(browser_service_state_path())
+            self.stop()
+            logger.info("Browser service stopped")
+
+# page.content(), but cut to at most the given number of characters (0: no limit) inside the browser,
+# so an oversized DOM never reaches Python whole; also returns the full length
+_PAGE_CONTENT_JS = """max => {
+    let html = document.doctype ? new XMLSerializer().serializeToString(document.doctype) : "";
+    if (document.documentElement) html += document.documentElement.outerHTML;
+    return [max && html.length > max ? html.slice(0, max) : html, html.length];
+}"""
+
+async def fetch_page(url: str, context, options: Optional[BrowserOptions] = None,
+                     timings: Optional[Dict[str, float]] = None, max_size: Optional[int] = DEFAULT_MAX_PAGE_SIZE,
+                     outcome: Optional[Dict[str, object]] = None) -> Optional[str]:
+    """
+    Asynchronously fetch a webpage's content.
+
+    The response's Content-Type and Content-Length are checked as soon as it
+    arrives, before the page is rendered: unsupported content and documents
+    declaring more than ``max_size`` bytes are skipped. A rendered document
+    longer than ``max_size`` characters is cut off.
+
+    Args:
+        url: Page to load
+        context: Playwright browser context
+        options: Blocklists and readiness strategy (default: BrowserOptions())
+        timings: If given, filled with the seconds spent in each phase
+                 ("navigate", "ready", "content") and the number of requests blocked ("blocked")
+        max_size: Page size limit (None or 0: no limit)
+        outcome: If given, "status" is set to the HTTP status of the main response,
+                 "final_url" to the page's URL after redirects, "skipped" to the reason
+                 a page was not loaded and "truncated" to True when its HTML was cut off
+    """
+    from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+    options = options or BrowserOptions()
+    timings = {} if timings is None else timings
+    timings["blocked"] = 0
+    kind, arg = options.ready_strategy
+    timeout_ms = options.timeout * 1000
     page = await context.new_page()
     try:
         logger.info(f"Fetching {url}")
-        await page.goto(url)
-        await page.wait_for_load_state('networkidle')
-        content = await page.content()
+        if options.block_resources or options.block_domains:
+            async def handle(route):
+                if options.blocks(route.request):
+                    timings["blocked"] += 1
+                    await route.abort()
+                else:
+                    await route.continue_()
+            await page.route("**/*", handle)
+
+        started = time.monotonic()
+        response = await page.goto(url, wait_until="commit", timeout=timeout_ms)
+        if outcome is not None:
+            outcome["final_url"] = page.url
+        if response is not None:
+            if outcome is not None:
+                outcome["status"] = response.status
+            content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+            length = response.headers.get("content-length", "")
+            reason = unsupported_content(content_type)
+            if reason is None and max_size and length.isdigit() and int(length) > max_size:
+                reason = f"Too large to render: {int(length)} bytes"
+            if reason:
+                logger.warning(f"Skipping {url}: {reason}")
+                if outcome is not None:
+                    outcome["skipped"] = reason
+                return None
+        await page.wait_for_load_state("load" if kind == "networkidle" else kind if kind in LOAD_STATES
+                                       else "domcontentloaded", timeout=timeout_ms)
+        navigated = time.monotonic()
+        timings["navigate"] = navigated - started
+        try:
+            if kind == "networkidle":
+                await page.wait_for_load_state("networkidle", timeout=timeout_ms)
+            elif kind == "selector":
+                await page.wait_for_selector(arg, state="attached", timeout=timeout_ms)
+            elif kind == "quiet":
+                await page.evaluate(_DOM_QUIET_JS, [int(arg), timeout_ms])
+        except PlaywrightTimeoutError:
+            # Long-polling pages never go idle; what has rendered so far is still worth extracting
+            logger.warning(f"{url} was not ready ({options.ready}) after {options.timeout:g}s; using the page as is")
+        ready = time.monotonic()
+        timings["ready"] = ready - navigated
+        content, length = await page.evaluate(_PAGE_CONTENT_JS, max_size or 0)
+        timings["content"] = time.monotonic() - ready
+        if outcome is not None:
+            outcome["final_url"] = page.url  # Scripts may have navigated since the response arrived
+        if max_size and length > max_size:
+            logger.warning(f"{url} is larger than {max_size} characters; using the first {max_size}")
+            if outcome is not None:
+                outcome["truncated"] = True
         logger.info(f"Successfully fetched {url}")
         return content
     except Exception as e:
@@ -36,123 +716,1695 @@ async def fetch_page(url: str, context) -> Optional[str]:
     finally:
         await page.close()
 
-def parse_html(html_content: Optional[str]) -> str:
-    """Parse HTML content and extract text with hyperlinks in markdown format."""
-    if not html_content:
-        return ""
-    
-    try:
+XHTML_NAMESPACE = "{http://www.w3.org/1999/xhtml}"
+# Output lines containing any of these (case-insensitively) are dropped as script/style noise.
+NOISE_PATTERNS = ('var ', 'function()', '.js', '.css', 'google-analytics', 'disqus', '{', '}')
+_NOISE = re.compile("|".join(re.escape(pattern) for pattern in NOISE_PATTERNS))
+
+# selectolax (lexbor) and html5lib both build the HTML5-spec tree, so they extract identical text (bar
+# lexbor's repair of deeply misnested formatting elements, which can shift indentation).
+# lxml's tree is brought close to it (implied <tbody>, content after </body>; see _html5_body), but
+# lxml still repairs misnested markup differently and drops anything after </html>.
+PARSERS = ("selectolax", "lxml", "html5lib")
+DEFAULT_PARSER = "selectolax" if importlib.util.find_spec("selectolax") else "html5lib"
+# Larger documents are extracted incrementally with lxml (when installed) instead of as a whole tree
+INCREMENTAL_PARSE_SIZE = 2 * 1024 * 1024
+INCREMENTAL_PARSE = importlib.util.find_spec("lxml") is not None
+
+# Elements that start a new block of text for main-content extraction
+BLOCK_TAGS = frozenset((
+    "address", "article", "aside", "blockquote", "body", "caption", "dd", "details", "dialog", "div", "dl", "dt",
+    "fieldset", "figcaption", "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "li",
+    "main", "nav", "ol", "p", "pre", "section", "summary", "table", "td", "th", "tr", "ul",
+))
+HEADING_TAGS = frozenset(("h1", "h2", "h3", "h4", "h5", "h6"))
+# Blocks inside these elements, or inside elements whose class, id or role match _BOILERPLATE, are never main content
+BOILERPLATE_TAGS = frozenset(("nav", "footer", "aside", "header", "form", "dialog", "menu"))
+_BOILERPLATE = re.compile(
+    r"\b(nav|navbar|navigation|menu|footer|sidebar|breadcrumbs?|cookies?|consent|gdpr|banner|share|sharing|social|"
+    r"related|comments?|advert\w*|ads?|promo\w*|newsletter|subscribe|signup|popup|modal|toc|"
+    r"contentinfo|complementary)\b", re.IGNORECASE)
+# Per aggressiveness level: (maximum link density of a content block, words that make a block content on its own)
+MAIN_CONTENT_LEVELS = {1: (0.5, 0), 2: (0.33, 15), 3: (0.2, 30)}
+# Chinese and Japanese are written without spaces; two of these characters count as a word
+_UNSPACED_CHARS = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f]")
+
+class _Block:
+    """Text statistics of one block-level element, gathered by extract_lines for main-content extraction."""
+    __slots__ = ("tag", "boilerplate", "main", "chars", "link_chars", "words", "lines")
+
+    def __init__(self, tag: str, boilerplate: bool, main: bool):
+        self.tag = tag
+        self.boilerplate = boilerplate
+        self.main = main  # Inside <main>, <article> or role="main"
+        self.chars = self.link_chars = self.words = 0
+        self.lines = []  # Indices of the block's lines in the extract_lines output
+
+def _has_text(text: Optional[str]) -> bool:
+    return bool(text) and not text.isspace()
+
+class _ElementTree:
+    """Extraction view of an ElementTree-style tree (html5lib or lxml)."""
+
+    def __init__(self, root, namespace: str = ""):
+        self.root = self._node(root) if root is not None else None
+        self.anchor, self.script, self.style = (namespace + tag for tag in ("a", "script", "style"))
+
+    @staticmethod
+    def _node(elem) -> tuple:
+        return elem, elem.tag, elem.text, elem.tail
+
+    def children(self, elem) -> Iterable[tuple]:
+        return map(self._node, elem)
+
+    def attributes(self, elem) -> Iterable[tuple]:
+        return elem.items()
+
+    def texts(self, elem) -> Iterable[str]:
+        return elem.itertext()
+
+    def hrefs(self) -> Iterable[str]:
+        return (elem.get("href") for elem in self.root[0].iter(self.anchor) if elem.get("href"))
+
+class _LexborTree:
+    """
+    Extraction view of a selectolax/lexbor tree.
+
+    Lexbor keeps text in separate nodes; they are folded into ElementTree-style
+    ``text`` (leading text of an element) and ``tail`` (text after it).
+    Comments and processing instructions carry their content as text, as in html5lib.
+    """
+    anchor, script, style = "a", "script", "style"
+
+    def __init__(self, root):
+        self.root = self._node(root)
+
+    @staticmethod
+    def _text_run(node) -> tuple:
+        """Concatenated text of ``node`` and its following text siblings; returns (text, next non-text node)."""
+        parts = []
+        while node is not None and node.tag == "-text":
+            parts.append(node.text_content)
+            node = node.next
+        return "".join(parts), node
+
+    def _node(self, node) -> tuple:
+        tag = node.tag
+        if tag == "-comment":
+            text = node.comment_content
+        elif tag is None:  # Processing instruction, a bogus comment to html5lib
+            text = node.html[1:-1]
+        else:
+            text = self._text_run(node.child)[0]
+        return node, tag, text, self._text_run(node.next)[0]
+
+    def children(self, node) -> Iterable[tuple]:
+        child = self._text_run(node.child)[1]
+        while child is not None:
+            yield self._node(child)
+            child = self._text_run(child.next)[1]
+
+    def attributes(self, node) -> Iterable[tuple]:
+        return node.attributes.items()
+
+    def texts(self, node) -> Iterable[str]:
+        return (node.text(deep=True),)
+
+    def hrefs(self) -> Iterable[str]:
+        return (node.attributes["href"] for node in self.root[0].css("a[href]") if node.attributes["href"])
+
+# Rows and cells that an HTML5 parser wraps in an implied <tbody> (and <tr>) when they sit directly in a <table>
+TABLE_ROW_TAGS = frozenset(("tr", "td", "th"))
+TABLE_SECTION_TAGS = frozenset(("caption", "colgroup", "col", "thead", "tbody", "tfoot"))
+# Sections whose cells HTML5 wraps in a <tr> when the markup leaves it out
+TABLE_ROW_GROUP_TAGS = frozenset(("thead", "tbody", "tfoot"))
+# Other elements a <table> may hold; anything else is moved in front of the table ("foster-parented")
+TABLE_ALLOWED_TAGS = frozenset(("script", "style", "template", "form"))
+
+def _foster_parented(elem) -> bool:
+    """Whether HTML5 would move ``elem``, a misplaced child of a <table>, in front of the table."""
+    parent = elem.getparent()
+    tag = elem.tag
+    return parent is not None and parent.tag == "table" and isinstance(tag, str) \
+        and tag not in TABLE_ROW_TAGS and tag not in TABLE_SECTION_TAGS and tag not in TABLE_ALLOWED_TAGS \
+        and not (tag == "input" and (elem.get("type") or "").lower() == "hidden")
+
+def _html5_body(body):
+    """
+    Reshape an lxml <body> the way the HTML5 tree-building rules would have built it.
+
+    Rows and cells directly inside a <table>, and cells directly inside its
+    sections, get the <tbody> and <tr> HTML5 implies, other content misplaced in a table is moved in front of it, and
+    content that lxml leaves after </body> is moved into the body (comments
+    right after </body> stay outside, as in HTML5).
+    """
+    from lxml import etree
+
+    def foster_text(table, text: str):
+        previous = table.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or "") + text
+        else:
+            parent = table.getparent()
+            parent.text = (parent.text or "") + text
+
+    for table in list(body.iter("table")):
+        if _has_text(table.text):
+            text, table.text = table.text, None
+            foster_text(table, text)
+        section = row = None
+        for child in list(table):
+            tag = child.tag
+            if tag in TABLE_ROW_TAGS:
+                if section is None:
+                    section = etree.Element("tbody")
+                    child.addprevious(section)
+                if tag == "tr":
+                    row = None
+                    section.append(child)
+                else:
+                    if row is None:
+                        row = etree.SubElement(section, "tr")
+                    row.append(child)
+            elif tag in TABLE_SECTION_TAGS:
+                section = row = None
+                if tag in TABLE_ROW_GROUP_TAGS:
+                    cells = None
+                    for cell in list(child):
+                        if cell.tag == "td" or cell.tag == "th":
+                            if cells is None:
+                                cells = etree.Element("tr")
+                                cell.addprevious(cells)
+                            cells.append(cell)
+                        elif cell.tag == "tr":
+                            cells = None
+                        elif cells is not None:
+                            cells.append(cell)
+            elif _foster_parented(child):
+                table.addprevious(child)
+                continue
+            elif section is not None:
+                (row if row is not None else section).append(child)
+            if _has_text(child.tail):
+                text, child.tail = child.tail, None
+                foster_text(table, text)
+
+    def append_text(text: Optional[str]):
+        if text:
+            if len(body):
+                body[-1].tail = (body[-1].tail or "") + text
+            else:
+                body.text = (body.text or "") + text
+
+    reopened = _has_text(body.tail)
+    tail, body.tail = body.tail, None
+    append_text(tail)
+    for sibling in list(body.itersiblings()):
+        if not reopened and not isinstance(sibling.tag, str):
+            if _has_text(sibling.tail):
+                reopened = True
+                tail, sibling.tail = sibling.tail, None
+                append_text(tail)
+            continue
+        reopened = True
+        body.append(sibling)
+
+def _parse_tree(html_content: str, parser: str):
+    """Parse a document and return the extraction view of its body (or the whole document without one)."""
+    if parser == "selectolax":
+        from selectolax.lexbor import LexborHTMLParser
+        document = LexborHTMLParser(html_content)
+        return _LexborTree(document.body or document.root)
+    if parser == "lxml":
+        import lxml.html
+        from lxml import etree
+        # Parsing bytes sidesteps lxml's refusal of str input with an XML encoding declaration
+        try:
+            root = lxml.html.document_fromstring(html_content.encode("utf-8"),
+                                                 parser=lxml.html.HTMLParser(encoding="utf-8"))
+        except etree.ParserError:  # Nothing but comments or a doctype: no text either way
+            return _ElementTree(etree.Element("body"))
+        body = root.find(".//body")
+        if body is None:
+            return _ElementTree(root)
+        _html5_body(body)
+        return _ElementTree(body)
+    if parser == "html5lib":
         document = html5lib.parse(html_content)
-        result = []
-        seen_texts = set()  # To avoid duplicates
-        
-        def should_skip_element(elem) -> bool:
-            """Check if the element should be skipped."""
-            # Skip script and style tags
-            if elem.tag in ['{http://www.w3.org/1999/xhtml}script', 
-                          '{http://www.w3.org/1999/xhtml}style']:
-                return True
-            # Skip empty elements or elements with only whitespace
-            if not any(text.strip() for text in elem.itertext()):
-                return True
-            return False
-        
-        def process_element(elem, depth=0):
-            """Process an element and its children recursively."""
-            if should_skip_element(elem):
-                return
-            
-            # Handle text content
-            if hasattr(elem, 'text') and elem.text:
-                text = elem.text.strip()
-                if text and text not in seen_texts:
-                    # Check if this is an anchor tag
-                    if elem.tag == '{http://www.w3.org/1999/xhtml}a':
-                        href = None
-                        for attr, value in elem.items():
-                            if attr.endswith('href'):
-                                href = value
-                                break
+        body = document.find(f".//{XHTML_NAMESPACE}body")
+        return _ElementTree(body if body is not None else document, XHTML_NAMESPACE)
+    raise ValueError(f"Unknown HTML parser: {parser}")
+
+class _LineExtractor:
+    """
+    Line emission shared by extract_lines and extract_lines_incremental.
+
+    Both drive the same depth-first walk: ``enter`` when an element's own
+    text is complete, ``leave`` when its subtree and tail are. A frame is
+    ``[tail, depth, children, subtree has text, block, in a link]``.
+    """
+
+    def __init__(self, tree, blocks: Optional[List[_Block]] = None):
+        self.tree = tree
+        self.blocks = blocks
+        self.lines = []
+        self.seen = set()
+
+    def emit(self, text: str, depth: int, block: Optional[_Block], link: bool, line: Optional[str] = None):
+        if block is not None:
+            block.lines.append(len(self.lines))
+            block.chars += len(text)
+            block.words += len(text.split()) + len(_UNSPACED_CHARS.findall(text)) // 2
+            if link:
+                block.link_chars += len(text)
+        self.lines.append("  " * depth + (line or text))
+        self.seen.add(text)
+
+    def open_block(self, elem, tag, parent: Optional[list]) -> Tuple[Optional[_Block], bool]:
+        """The block an element's text belongs to and whether that text is link text."""
+        block, link = (parent[4], parent[5]) if parent is not None else (None, False)
+        link = link or tag == self.tree.anchor
+        if not isinstance(tag, str) or tag.startswith("-"):  # Comments and processing instructions are never content
+            block = _Block("", True, False)
+            self.blocks.append(block)
+            return block, link
+        name = tag.rpartition("}")[2]
+        if name in BLOCK_TAGS or block is None:
+            marks = " ".join(value for attr, value in self.tree.attributes(elem)
+                             if attr in ("class", "id", "role") and value)
+            main = (block is not None and block.main) or name in ("main", "article") or "main" in marks.split()
+            # An article's own <header> holds its title
+            boilerplate = (block is not None and block.boilerplate) \
+                or name in BOILERPLATE_TAGS and not (name == "header" and main) \
+                or bool(marks) and _BOILERPLATE.search(marks) is not None
+            block = _Block(name, boilerplate, main)
+            self.blocks.append(block)
+        return block, link
+
+    def enter(self, node: tuple, depth: int, parent: Optional[list]) -> Optional[list]:
+        """Emit an element's own text; return its frame, or None if it is skipped."""
+        tree = self.tree
+        elem, tag, text, tail = node
+        if tag == tree.script or tag == tree.style:
+            # Skipped along with its tail, but its text still counts for the parent
+            if parent is not None and not parent[3]:
+                parent[3] = _has_text(tail) or any(map(_has_text, tree.texts(elem)))
+            return None
+        block, link = self.open_block(elem, tag, parent) if self.blocks is not None else (None, False)
+        frame = [tail, depth, tree.children(elem), False, block, link]
+        if text:
+            text = text.strip()
+            if text:
+                frame[3] = True
+                if text not in self.seen:
+                    if tag == tree.anchor:
+                        href = next((value for attr, value in tree.attributes(elem) if attr.endswith('href')), None)
                         if href and not href.startswith(('#', 'javascript:')):
-                            # Format as markdown link
-                            link_text = f"[{text}]({href})"
-                            result.append("  " * depth + link_text)
-                            seen_texts.add(text)
+                            self.emit(text, depth, block, True, f"[{text}]({href})")
                     else:
-                        result.append("  " * depth + text)
-                        seen_texts.add(text)
-            
-            # Process children
-            for child in elem:
-                process_element(child, depth + 1)
-            
-            # Handle tail text
-            if hasattr(elem, 'tail') and elem.tail:
-                tail = elem.tail.strip()
-                if tail and tail not in seen_texts:
-                    result.append("  " * depth + tail)
-                    seen_texts.add(tail)
-        
-        # Start processing from the body tag
-        body = document.find('.//{http://www.w3.org/1999/xhtml}body')
-        if body is not None:
-            process_element(body)
+                        self.emit(text, depth, block, link)
+        return frame
+
+    def leave(self, frame: list, parent: Optional[list]):
+        """Finish an element once its subtree and tail are known: emit the tail if the subtree had text."""
+        tail = frame[0]
+        if parent is not None and (frame[3] or _has_text(tail)):
+            parent[3] = True
+        if frame[3] and tail:
+            text = tail.strip()
+            if text and text not in self.seen:
+                owner = parent or frame
+                self.emit(text, frame[1], owner[4], owner[5])
+
+def extract_lines(tree, blocks: Optional[List[_Block]] = None) -> List[str]:
+    """
+    Extract indented text lines, with links as markdown, from a parsed page.
+
+    One iterative depth-first pass. Elements whose subtree holds no text are
+    skipped together with their tail, as are scripts and styles; whether a
+    subtree holds text is accumulated as the walk returns from it rather than
+    rescanned per element. Each distinct text is emitted once.
+
+    Args:
+        tree: Extraction view from _parse_tree
+        blocks: If given, filled with a _Block per block-level element, in
+                document order, for select_main_content
+    """
+    extractor = _LineExtractor(tree, blocks)
+    root_frame = extractor.enter(tree.root, 0, None)
+    stack = [root_frame] if root_frame is not None else []
+    while stack:
+        frame = stack[-1]
+        child = next(frame[2], None)
+        if child is not None:
+            child_frame = extractor.enter(child, frame[1] + 1, frame)
+            if child_frame is not None:
+                stack.append(child_frame)
+            continue
+        stack.pop()
+        extractor.leave(frame, stack[-1] if stack else None)
+    return extractor.lines
+
+def extract_lines_incremental(chunks: Iterable[str], blocks: Optional[List[_Block]] = None,
+                              hrefs: Optional[List[str]] = None) -> List[str]:
+    """
+    extract_lines for a document fed in chunks to lxml's HTMLPullParser, without keeping its tree.
+
+    Elements are entered and left from the parser's events as soon as their
+    text, and then their tail, can no longer change, and are removed from
+    the tree right after, so memory holds the open ancestors of the current
+    element rather than the whole document. Implied table sections,
+    misplaced table content and content after </body> are handled as
+    _html5_body does, except that a misplaced element (or text) in a table
+    cannot be moved in front of rows already emitted: its lines keep their
+    place in the document, which is the one case where they differ from
+    extract_lines on an lxml tree. Like that tree, they leave out anything
+    after </html>.
+
+    Args:
+        chunks: The document's HTML in pieces
+        blocks: As for extract_lines
+        hrefs: If given, filled with the href of every link, for extract_links
+    """
+    from lxml import etree
+    extractor = _LineExtractor(_ElementTree(None), blocks)
+    script, style = extractor.tree.script, extractor.tree.style
+    parser = etree.HTMLPullParser(events=("start", "end", "comment", "pi"))
+    stack = []  # Frames of the entered, still open elements, <body> first
+    implied = []  # (frame, tag) of the <tbody> and <tr> frames HTML5 would imply, innermost last
+    fostered = {}  # id(frame) of an element HTML5 moves out of its table -> the table's parent frame
+    opened = None  # Element started whose text may still grow
+    closed = None  # (element, frame) ended whose tail may still grow; frame None for scripts and styles
+    body = None
+    after_body = False  # Past </body>: later content still belongs to the body, as in HTML5
+    reopened = False  # Past </body> and something other than comments and whitespace has followed
+    finished = False  # Past </html>: lxml starts a new document there, which its tree parser drops
+
+    def node(elem, tail: Optional[str] = None) -> tuple:
+        return elem, elem.tag, elem.text, tail if tail is not None else elem.tail
+
+    def enter(elem, tail: Optional[str] = None) -> Optional[list]:
+        """Enter ``elem`` below the innermost open element, or beside its table if HTML5 would move it there."""
+        if len(stack) > 1 and _foster_parented(elem):
+            table = len(stack) - 1  # Below the implied sections still open in the table
+            for frame, _ in reversed(implied):
+                if frame is not stack[table]:
+                    break
+                table -= 1
+            frame = extractor.enter(node(elem, tail), stack[table][1], stack[table - 1])
+            if frame is not None:
+                fostered[id(frame)] = stack[table - 1]
+            return frame
+        return extractor.enter(node(elem, tail), stack[-1][1] + 1 if stack else 0, stack[-1] if stack else None)
+
+    def release(elem):
+        parent = elem.getparent()
+        elem.clear()
+        if parent is not None:
+            parent.remove(elem)
+
+    def settle():
+        """Handle the pending element, if any, now that the parser has moved past it."""
+        nonlocal opened, closed
+        if closed is not None:
+            elem, frame = closed
+            closed = None
+            parent = stack[-1] if stack else None
+            tail = elem.tail
+            if after_body and body.tail and elem.getparent() is body:
+                # Text after </body> continues the body's last child, as in _html5_body
+                tail, body.tail = (tail or "") + body.tail, None
+            if frame is None:
+                enter(elem, tail)
+            else:
+                frame[0] = tail
+                extractor.leave(frame, fostered.pop(id(frame), parent))
+            release(elem)
+        if opened is not None:
+            frame = enter(opened)
+            opened = None
+            if frame is not None:
+                stack.append(frame)
+
+    def open_implied(tag: str):
+        frame = extractor.enter(node(etree.Element(tag)), stack[-1][1] + 1, stack[-1])
+        stack.append(frame)
+        implied.append((frame, tag))
+
+    def close_implied(tags: Iterable[str] = ("tbody", "tr")):
+        while implied and implied[-1][0] is stack[-1] and implied[-1][1] in tags:
+            implied.pop()
+            frame = stack.pop()
+            extractor.leave(frame, stack[-1])
+
+    def imply_table_section(elem):
+        """Open or close the <tbody> and <tr> HTML5 implies around a child of a <table> or of its sections."""
+        parent = elem.getparent()
+        if parent is None:
+            return
+        tag = elem.tag
+        if parent.tag in TABLE_ROW_GROUP_TAGS:
+            if tag == "tr":
+                close_implied(("tr",))
+            elif (tag == "td" or tag == "th") and not (implied and implied[-1][0] is stack[-1]):
+                open_implied("tr")
+            return
+        if parent.tag != "table":
+            return
+        if tag in TABLE_ROW_TAGS:
+            if tag == "tr":
+                close_implied(("tr",))
+            if not (implied and implied[-1][0] is stack[-1]):
+                open_implied("tbody")
+            if tag != "tr" and implied[-1][1] == "tbody":
+                open_implied("tr")
+        elif tag in TABLE_SECTION_TAGS:
+            close_implied()
+
+    def handle(event: str, elem):
+        nonlocal opened, closed, body, after_body, reopened, finished
+        if finished:
+            return
+        if body is None:
+            if event == "start" and elem.tag == "body":
+                body = elem
+            elif event == "end" and elem.tag == "head":
+                elem.clear()
+                return
+            else:
+                return
+        if event == "end" and (elem is body or elem.tag == "html"):
+            after_body = True  # The body stays open for whatever follows
+            finished = elem.tag == "html"
+            return
+        if after_body and not reopened:
+            if event in ("comment", "pi") and not _has_text(body.tail):
+                return  # Stays outside the body, as in HTML5
+            reopened = True
+        if event == "end" and opened is elem:  # No children: its text is complete, its tail is not
+            opened = None
+            closed = (elem, None if elem.tag == script or elem.tag == style else enter(elem))
+        elif event == "end":
+            settle()
+            if elem.tag == "table":
+                close_implied()
+            elif elem.tag in TABLE_ROW_GROUP_TAGS:
+                close_implied(("tr",))
+            closed = (elem, stack.pop())
         else:
-            # Fallback to processing the entire document
-            process_element(document)
-        
+            settle()
+            if event == "start":
+                imply_table_section(elem)
+                opened = elem
+                if hrefs is not None and elem.tag == "a" and elem.get("href"):
+                    hrefs.append(elem.get("href"))
+            else:  # Comments and processing instructions arrive complete
+                closed = (elem, enter(elem))
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            handle(event, elem)
+    parser.close()
+    for event, elem in parser.read_events():
+        handle(event, elem)
+    settle()
+    while stack:
+        frame = stack.pop()
+        extractor.leave(frame, stack[-1] if stack else None)
+    return extractor.lines
+
+def select_main_content(blocks: List[_Block], level: int = 2) -> List[int]:
+    """
+    Pick the lines of a page's main content from the blocks extract_lines gathered.
+
+    Blocks inside navigation, headers, footers, sidebars, forms, cookie and
+    share banners, and blocks that are mostly link text, are boilerplate.
+    From level 2 on, a block also needs enough words to count as content on
+    its own; shorter blocks and headings are kept only next to content
+    (level 2: either neighbour, level 3: both, headings: the block after
+    them). Level 3 also drops everything outside <main> or <article> when
+    those hold content.
+
+    Args:
+        blocks: Blocks from extract_lines, in document order
+        level: Aggressiveness, 1 to 3 (see MAIN_CONTENT_LEVELS)
+
+    Returns:
+        List[int]: Indices of the kept lines, in order. Pages without a block
+        long enough for ``level`` get level 1; pages that are all boilerplate
+        are kept whole
+    """
+    if level not in MAIN_CONTENT_LEVELS:
+        raise ValueError(f"Main-content level must be one of {sorted(MAIN_CONTENT_LEVELS)}, got {level}")
+    max_link_density, min_words = MAIN_CONTENT_LEVELS[level]
+    blocks = [block for block in blocks if block.chars]
+    # "good" and "bad" are final; "short" and "heading" are decided by their neighbours
+    classes = []
+    for block in blocks:
+        if block.boilerplate or block.link_chars > max_link_density * block.chars:
+            classes.append("bad")
+        elif block.tag in HEADING_TAGS and min_words:
+            classes.append("heading")
+        else:
+            classes.append("good" if block.words >= min_words else "short")
+    if level == 3 and any(cls == "good" and block.main for cls, block in zip(classes, blocks)):
+        classes = [cls if block.main else "bad" for cls, block in zip(classes, blocks)]
+    if "good" not in classes:
+        if level > 1:  # Too little text for the word threshold, e.g. a short page
+            return select_main_content(blocks, 1)
+        return sorted(line for block in blocks for line in block.lines)
+
+    def neighbour(index: int, step: int) -> Optional[str]:
+        index += step
+        while 0 <= index < len(classes):
+            if classes[index] in ("good", "bad"):
+                return classes[index]
+            index += step
+        return None
+
+    kept = []
+    for index, (cls, block) in enumerate(zip(classes, blocks)):
+        if cls == "heading":
+            keep = neighbour(index, 1) == "good"
+        elif cls == "short":
+            before, after = neighbour(index, -1), neighbour(index, 1)
+            keep = before == after == "good" if level == 3 else "good" in (before, after)
+        else:
+            keep = cls == "good"
+        if keep:
+            kept.extend(block.lines)
+    return sorted(kept)
+
+def extract_links(tree, base_url: str) -> List[str]:
+    """Absolute http(s) URLs of a parsed page's links, without fragments, in document order and de-duplicated."""
+    return absolute_links(tree.hrefs(), base_url)
+
+def absolute_links(hrefs: Iterable[str], base_url: str) -> List[str]:
+    """Resolve link targets as extract_links does."""
+    links = {}
+    for href in hrefs:
+        url = urldefrag(urljoin(base_url, href.strip()))[0]
+        if url.startswith(("http://", "https://")):
+            links.setdefault(url, None)
+    return list(links)
+
+def parse_html(html_content: Optional[str], parser: Optional[str] = None, main_content: int = 0) -> str:
+    """
+    Parse HTML content and extract text with hyperlinks in markdown format.
+
+    Args:
+        html_content: The page's HTML
+        parser: One of PARSERS (default: selectolax when installed, else html5lib;
+                see parse_page for large documents)
+        main_content: Keep only the main content, at this aggressiveness level
+                      (1-3, see select_main_content); 0 keeps all text
+    """
+    return parse_page(html_content, None, parser, main_content)[0]
+
+def parse_page(html_content: Optional[str], base_url: Optional[str] = None,
+               parser: Optional[str] = None, main_content: int = 0) -> Tuple[str, List[str], Optional[float]]:
+    """
+    Parse a page once for both its text (as parse_html) and, given ``base_url``, its links (as extract_links).
+
+    Without an explicit ``parser``, documents over INCREMENTAL_PARSE_SIZE
+    characters are extracted with extract_lines_incremental (lxml), so no
+    full tree of them is ever built.
+
+    Returns:
+        Tuple[str, List[str], Optional[float]]: The text, the absolute link
+        URLs (empty without ``base_url``) and, with ``main_content``, the
+        fraction of the page's text that main-content extraction removed
+    """
+    if main_content and main_content not in MAIN_CONTENT_LEVELS:
+        raise ValueError(f"Main-content level must be one of {sorted(MAIN_CONTENT_LEVELS)}, got {main_content}")
+    if not html_content or html_content.isspace():
+        return "", [], 0.0 if main_content else None
+    
+    try:
+        blocks = [] if main_content else None
+        if parser is None and INCREMENTAL_PARSE and len(html_content) > INCREMENTAL_PARSE_SIZE:
+            hrefs = [] if base_url else None
+            chunks = (html_content[start:start + 65536] for start in range(0, len(html_content), 65536))
+            lines = extract_lines_incremental(chunks, blocks, hrefs)
+            links = absolute_links(hrefs, base_url) if base_url else []
+        else:
+            tree = _parse_tree(html_content, parser or DEFAULT_PARSER)
+            lines = extract_lines(tree, blocks)
+            links = extract_links(tree, base_url) if base_url else []
         # Filter out common unwanted patterns
-        filtered_result = []
-        for line in result:
-            # Skip lines that are likely to be noise
-            if any(pattern in line.lower() for pattern in [
-                'var ', 
-                'function()', 
-                '.js',
-                '.css',
-                'google-analytics',
-                'disqus',
-                '{',
-                '}'
-            ]):
-                continue
-            filtered_result.append(line)
-        
-        return '\n'.join(filtered_result)
+        noisy = {index for index, line in enumerate(lines) if _NOISE.search(line.lower())}
+        text = '\n'.join(line for index, line in enumerate(lines) if index not in noisy)
+        reduction = None
+        if main_content:
+            full_length = len(text)
+            text = '\n'.join(lines[index] for index in select_main_content(blocks, main_content)
+                              if index not in noisy)
+            reduction = 1 - len(text) / full_length if full_length else 0.0
+        return text, links, reduction
     except Exception as e:
         logger.error(f"Error parsing HTML: {str(e)}")
-        return ""
+        return "", [], None
 
-async def process_urls(urls: List[str], max_concurrent: int = 5) -> List[str]:
-    """Process multiple URLs concurrently."""
-    async with async_playwright() as p:
-        browser = await p.chromium.launch()
+# Query parameters that only track the visitor and never change the page
+TRACKING_PARAMS = ("fbclid", "gclid", "dclid", "msclkid", "mc_cid", "mc_eid", "yclid", "_ga", "_hsenc", "_hsmi")
+
+_CANONICAL_URL = re.compile(r"https?://[a-z0-9.-]+/[^?#\s]*\Z")
+
+def normalize_url(url: str) -> str:
+    """
+    Canonical form of a URL for cache keys and de-duplication.
+
+    Lower-cases the scheme and host, drops default ports, fragments, utm_* and
+    other tracking parameters, sorts the query and gives an empty path a "/".
+    """
+    # Most crawled links are already canonical; skip the split/join for them.
+    if _CANONICAL_URL.match(url):
+        return url
+    try:
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or "").lower()
+        port = parts.port
+    except ValueError:
+        return url
+    if ":" in host:
+        host = f"[{host}]"
+    netloc = host if port is None or (scheme, port) in (("http", 80), ("https", 443)) else f"{host}:{port}"
+    query = sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if not name.lower().startswith("utm_") and name.lower() not in TRACKING_PARAMS)
+    return urlunsplit((scheme, netloc, parts.path or "/", urlencode(query), ""))
+
+class PageCache:
+    """
+    Persistent cache of fetched pages backed by SQLite, keyed by normalized URL.
+
+    Each entry keeps the extracted text (with the parser that produced it),
+    the HTTP validators (ETag, Last-Modified) and a reference to the raw body.
+    Bodies are stored zlib-compressed, once per content hash, so identical
+    pages share storage. Entries not validated for ``ttl`` seconds expire, and
+    the least recently used ones are evicted once bodies and texts exceed
+    ``max_bytes``. SQLite's WAL mode and busy timeout make the cache safe to
+    share between threads and between processes.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, ttl: Optional[float] = 30 * 24 * 3600,
+                 max_bytes: int = 512 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir or os.getenv('WEB_SCRAPER_CACHE_DIR') or Path.home() / ".cache" / "web_scraper")
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.cache_dir / "pages.sqlite3"
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                " url TEXT PRIMARY KEY, body_hash TEXT NOT NULL, text TEXT NOT NULL, parser TEXT,"
+                " tier TEXT, status INTEGER, etag TEXT, last_modified TEXT, text_size INTEGER NOT NULL,"
+                " fetched_at REAL NOT NULL, validated_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at)")
+            db.execute("CREATE INDEX IF NOT EXISTS pages_validated_at ON pages (validated_at)")
+            db.execute("CREATE INDEX IF NOT EXISTS pages_body_hash ON pages (body_hash)")
+            db.execute("CREATE TABLE IF NOT EXISTS bodies (hash TEXT PRIMARY KEY, body BLOB NOT NULL, size INTEGER NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            # Running total of the stored body and text sizes, so puts never have to SUM the tables
+            db.execute(
+                "INSERT OR IGNORE INTO counters (name, value) SELECT 'bytes',"
+                " (SELECT COALESCE(SUM(size), 0) FROM bodies) + (SELECT COALESCE(SUM(text_size), 0) FROM pages)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Run a block as one write transaction (BEGIN IMMEDIATE; the connection is in autocommit mode)."""
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _count(self, db, name: str, amount: int = 1):
+        db.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount),
+        )
+
+    @staticmethod
+    def _release_body(db, body_hash: str) -> int:
+        """Delete a body no page refers to any more; return the bytes freed."""
+        if db.execute("SELECT 1 FROM pages WHERE body_hash = ? LIMIT 1", (body_hash,)).fetchone() is not None:
+            return 0
+        row = db.execute("SELECT size FROM bodies WHERE hash = ?", (body_hash,)).fetchone()
+        if row is None:
+            return 0
+        db.execute("DELETE FROM bodies WHERE hash = ?", (body_hash,))
+        return row[0]
+
+    def _delete_page(self, db, url: str, body_hash: str, text_size: int) -> int:
+        """Delete an entry, and its body if no other entry shares it; return the bytes freed."""
+        db.execute("DELETE FROM pages WHERE url = ?", (url,))
+        return text_size + self._release_body(db, body_hash)
+
+    def get(self, url: str, parser: Optional[str] = None) -> Optional[Tuple[PageResult, float]]:
+        """
+        Look up a page.
+
+        Returns:
+            Optional[Tuple[PageResult, float]]: The cached page with ``html``
+            set (and ``text`` too if it was extracted with ``parser``) and the
+            time it was last fetched or revalidated; None on a miss or expired entry
+        """
+        key = normalize_url(url)
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT pages.text, parser, tier, status, etag, last_modified, validated_at, body, body_hash, text_size"
+                " FROM pages JOIN bodies ON bodies.hash = pages.body_hash WHERE url = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[6] > self.ttl:
+                self._count(db, "bytes", -self._delete_page(db, key, row[8], row[9]))
+                row = None
+            if row is None:
+                self.misses += 1
+                self._count(db, "misses")
+                return None
+            db.execute("UPDATE pages SET accessed_at = ? WHERE url = ?", (now, key))
+            self.hits += 1
+            self._count(db, "hits")
+        text, stored_parser, tier, status, etag, last_modified, validated_at, body = row[:8]
+        body = zlib.decompress(body)
+        page = PageResult(url, text=text if stored_parser == (parser or DEFAULT_PARSER) else "",
+                          html=body.decode("utf-8"), tier=tier, status=status,
+                          etag=etag, last_modified=last_modified, size=len(body))
+        return page, validated_at
+
+    def put(self, page: PageResult, parser: Optional[str] = None):
+        """Store a fetched and parsed page and evict old entries if the cache is over budget."""
+        body = page.html.encode("utf-8")
+        body_hash = hashlib.sha256(body).hexdigest()
+        key = normalize_url(page.url)
+        text_size = len(page.text.encode("utf-8"))
+        now = time.time()
+        with self._transaction() as db:
+            added = text_size
+            if db.execute("SELECT 1 FROM bodies WHERE hash = ?", (body_hash,)).fetchone() is None:
+                compressed = zlib.compress(body, 6)
+                db.execute("INSERT INTO bodies (hash, body, size) VALUES (?, ?, ?)",
+                           (body_hash, compressed, len(compressed)))
+                added += len(compressed)
+            previous = db.execute("SELECT body_hash, text_size FROM pages WHERE url = ?", (key,)).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO pages (url, body_hash, text, parser, tier, status, etag, last_modified,"
+                " text_size, fetched_at, validated_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, body_hash, page.text, parser or DEFAULT_PARSER, page.tier, page.status,
+                 page.etag, page.last_modified, text_size, now, now, now),
+            )
+            if previous is not None:
+                # Only the replaced entry's old body can have lost its last reference
+                added -= previous[1] + (self._release_body(db, previous[0]) if previous[0] != body_hash else 0)
+            self._count(db, "bytes", added)
+            self._evict(db)
+
+    def revalidated(self, url: str, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        """Record that the server confirmed the cached copy is current (HTTP 304)."""
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE pages SET validated_at = ?, etag = COALESCE(?, etag),"
+                " last_modified = COALESCE(?, last_modified) WHERE url = ?",
+                (time.time(), etag, last_modified, normalize_url(url)),
+            )
+            self._count(db, "revalidated")
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones until under ``max_bytes``."""
+        with self._transaction() as db:
+            self._evict(db)
+
+    def _evict(self, db):
+        freed = 0
+        if self.ttl is not None:
+            expired = db.execute("SELECT url, body_hash, text_size FROM pages WHERE validated_at < ?",
+                                 (time.time() - self.ttl,)).fetchall()
+            for url, body_hash, text_size in expired:
+                freed += self._delete_page(db, url, body_hash, text_size)
+        total = db.execute("SELECT value FROM counters WHERE name = 'bytes'").fetchone()[0] - freed
+        if total > self.max_bytes:
+            # Trim to 90% of the budget so eviction does not run on every put
+            target = freed + total - int(self.max_bytes * 0.9)
+            while freed < target:
+                oldest = db.execute("SELECT url, body_hash, text_size FROM pages ORDER BY accessed_at LIMIT 256").fetchall()
+                if not oldest:
+                    break
+                for url, body_hash, text_size in oldest:
+                    if freed >= target:
+                        break
+                    freed += self._delete_page(db, url, body_hash, text_size)
+        if freed:
+            self._count(db, "bytes", -freed)
+
+    def stats(self) -> dict:
+        """Return hit/miss counts for this instance and for the cache's whole lifetime."""
+        db = self._connect()
+        counters = dict(db.execute("SELECT name, value FROM counters").fetchall())
+        entries = db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+        bodies = db.execute("SELECT COUNT(*) FROM bodies").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "total_hits": counters.get("hits", 0),
+            "total_misses": counters.get("misses", 0),
+            "total_revalidated": counters.get("revalidated", 0),
+            "entries": entries,
+            "bodies": bodies,
+            "bytes": counters.get("bytes", 0),
+        }
+
+    def clear(self):
+        """Remove every entry and reset the counters."""
+        with self._transaction() as db:
+            db.execute("DELETE FROM pages")
+            db.execute("DELETE FROM bodies")
+            db.execute("DELETE FROM counters")
+            db.execute("INSERT INTO counters (name, value) VALUES ('bytes', 0)")
+        self.hits = self.misses = 0
+
+async def fetch_cached(fetcher: "PageFetcher", cache: PageCache, url: str, parser: Optional[str] = None,
+                       max_age: float = 0.0, offline: bool = False, refresh: bool = False) -> PageResult:
+    """
+    Fetch a URL through the page cache.
+
+    A cached copy younger than ``max_age`` seconds is used as is. An older one
+    is revalidated with a conditional request and reused if the server answers
+    304; otherwise the page is fetched normally. The caller stores fresh pages
+    with PageCache.put once they are parsed.
+
+    Args:
+        fetcher: The run's PageFetcher
+        cache: Page cache to read
+        url: URL to fetch
+        parser: Parser (or other extraction key given to PageCache.put) whose cached text can be reused
+                (default: DEFAULT_PARSER)
+        max_age: Seconds a cached copy is used without asking the server
+        offline: Use any cached copy, however old, and never touch the network
+        refresh: Ignore cached copies
+    """
+    started = time.monotonic()
+    cached = None if refresh else await asyncio.to_thread(cache.get, url, parser)
+    if cached is not None:
+        page, validated_at = cached
+        if offline or time.time() - validated_at <= max_age:
+            page.cache = "hit"
+            page.elapsed = time.monotonic() - started
+            page.timings = {"cache": page.elapsed}
+            return page
+    if offline:
+        return PageResult(url, error="Not in the page cache (offline)")
+    validators = {"etag": page.etag, "last_modified": page.last_modified} if cached is not None else None
+    result = await fetcher.fetch(url, validators)
+    if cached is None or result.status != 304:
+        return result
+    await asyncio.to_thread(cache.revalidated, url, result.etag, result.last_modified)
+    page.cache = "revalidated"
+    page.elapsed = time.monotonic() - started
+    page.timings = result.timings
+    return page
+
+class PageFetcher:
+    """
+    Tiered fetcher shared by every URL of a run; use as an async context manager.
+
+    With ``tier="auto"`` each URL is first fetched with a pooled HTTP client;
+    the headless browser is only started for pages that look JS-rendered (see
+    needs_browser), that failed over HTTP, or whose host is in
+    ``browser_hosts`` (subdomains included). ``tier="http"`` or ``"browser"``
+    uses one fetcher for everything. ``browser_options`` controls how the
+    browser loads pages (see BrowserOptions), and ``max_page_size`` bounds
+    every page in both tiers (see fetch_page_http and fetch_page).
+    """
+
+    def __init__(self, max_concurrent: int = 5, tier: str = "auto", browser_hosts: Iterable[str] = (),
+                 http_concurrency: int = 20, browser_options: Optional["BrowserOptions"] = None,
+                 max_page_size: Optional[int] = DEFAULT_MAX_PAGE_SIZE):
+        if tier not in ("auto", "http", "browser"):
+            raise ValueError(f"Unknown fetch tier: {tier}")
+        self.tier = tier
+        self.browser_hosts = [host.lower() for host in browser_hosts]
+        self.max_page_size = max_page_size
+        self.browser = BrowserFetcher(max_concurrent, browser_options, max_page_size)
+        self.http_slots = asyncio.Semaphore(http_concurrency)
+        self.client = create_http_client(http_concurrency) if tier != "browser" else None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+        await self.browser.close()
+
+    async def fetch(self, url: str, validators: Optional[Dict[str, str]] = None) -> PageResult:
+        """
+        Fetch one URL through the tiers.
+
+        ``validators`` make the HTTP request conditional (see fetch_page_http);
+        a 304 result means the cached copy, whichever tier produced it, is current.
+        """
+        started = time.monotonic()
+        escalation = "forced" if self.tier == "browser" or _host_matches(url, self.browser_hosts) else None
+        http_result = None
+        if escalation is None:
+            async with self.http_slots:
+                result = http_result = await fetch_page_http(url, self.client, validators, self.max_page_size)
+            result.timings = {"http": time.monotonic() - started}
+            if result.escalation is None or self.tier == "http":
+                result.elapsed = time.monotonic() - started
+                if result.escalation and result.error is None and self.tier == "http":
+                    logger.warning(f"{url} looks like it needs a browser ({result.escalation})")
+                return result
+            escalation = result.escalation
+            logger.info(f"Escalating {url} to the browser ({escalation})")
+        try:
+            result = await self.browser.fetch(url)
+        except Exception as e:
+            logger.error(f"Browser unavailable for {url}: {e}")
+            if http_result is not None and http_result.html:
+                # A possibly incomplete static page beats no page
+                result = http_result
+            else:
+                result = PageResult(url, tier="browser", error=f"Browser unavailable: {e}")
+        if http_result is not None and result is not http_result:
+            result.timings = {**http_result.timings, **(result.timings or {})}
+            # The static response's validators tell whether a rendered copy is still current
+            result.etag, result.last_modified = http_result.etag, http_result.last_modified
+            result.final_url = result.final_url or http_result.final_url
+            # Without a main response from the browser (or without a browser) the HTTP status still describes the page
+            if result.status is None:
+                result.status = http_result.status
+        result.escalation = escalation
+        result.elapsed = time.monotonic() - started
+        return result
+
+def host_key(url: str) -> str:
+    """The scheduling unit for per-host limits: lower-cased host and port."""
+    return urlsplit(url).netloc.lower()
+
+class FetchScheduler:
+    """
+    Hands queued URLs to a fixed set of fetch workers.
+
+    Each host has its own priority queue. A worker is given the
+    lowest-priority-value item among hosts that are under their connection
+    cap (``per_host``) and whose last request started at least their
+    spacing (``delay`` seconds, or the robots.txt crawl delay) ago. A slow or
+    rate-limited host therefore holds back only its own URLs, never the rest
+    of the batch. Items with equal priority come out in the order added.
+
+    With ``probe_hosts`` a new host gets a single connection until
+    host_ready() is called for it, so its robots.txt can be consulted before
+    the rest of its URLs go out.
+    """
+
+    def __init__(self, per_host: int = 2, delay: float = 0.0, probe_hosts: bool = False):
+        if per_host < 1:
+            raise ValueError("per_host must be at least 1")
+        self.per_host = per_host
+        self.delay = delay
+        self.probe_hosts = probe_hosts
+        self._hosts = {}  # host -> {"queue": heap, "active", "cap", "delay", "last_start"}
+        self._pending = 0
+        self._active = 0
+        self._sequence = 0
+        self._closed = False
+        self._changed = asyncio.Condition()
+
+    def _host(self, host: str) -> dict:
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = {"queue": [], "active": 0, "cap": 1 if self.probe_hosts else self.per_host,
+                                         "delay": self.delay, "last_start": float("-inf")}
+        return state
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def add(self, item, url: str, priority: float = 0):
+        """Queue ``item`` for fetching ``url``; lower priorities are handed out first."""
+        self._sequence += 1
+        heapq.heappush(self._host(host_key(url))["queue"], (priority, self._sequence, item))
+        self._pending += 1
+        await self._notify()
+
+    async def close(self):
+        """No more items will be added: next() returns None once everything queued has been handed out."""
+        self._closed = True
+        await self._notify()
+
+    async def host_ready(self, host: str, delay: Optional[float] = None):
+        """Lift a probed host to the full connection cap, spacing its requests at least ``delay`` seconds apart."""
+        state = self._host(host)
+        state["cap"] = self.per_host
+        state["delay"] = max(self.delay, delay or 0.0)
+        await self._notify()
+
+    async def next(self) -> Optional[tuple]:
+        """
+        Wait for the next item that may be fetched now.
+
+        Returns:
+            Optional[tuple]: (item, host), or None when the scheduler is closed and drained.
+            Call done(host) when the fetch has finished.
+        """
+        async with self._changed:
+            while True:
+                now = time.monotonic()
+                best = None
+                wake_at = None
+                for host, state in self._hosts.items():
+                    if not state["queue"] or state["active"] >= state["cap"]:
+                        continue
+                    next_at = state["last_start"] + state["delay"]
+                    if next_at > now:
+                        wake_at = next_at if wake_at is None else min(wake_at, next_at)
+                    elif best is None or state["queue"][0] < self._hosts[best]["queue"][0]:
+                        best = host
+                if best is not None:
+                    state = self._hosts[best]
+                    item = heapq.heappop(state["queue"])[2]
+                    state["active"] += 1
+                    state["last_start"] = now
+                    self._pending -= 1
+                    self._active += 1
+                    return item, best
+                if self._closed and not self._pending:
+                    return None
+                try:
+                    await asyncio.wait_for(self._changed.wait(), None if wake_at is None else wake_at - now)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def done(self, host: str):
+        """Release the connection slot taken by next()."""
+        state = self._hosts[host]
+        state["active"] -= 1
+        self._active -= 1
+        if not state["queue"] and not state["active"] and time.monotonic() >= state["last_start"] + state["delay"]:
+            del self._hosts[host]  # Keep the host table small for long crawls
+        await self._notify()
+
+ROBOTS_USER_AGENT = "web_scraper"
+
+class RobotsCache:
+    """
+    robots.txt rules per host, fetched once per run.
+
+    A missing robots.txt (or one that cannot be fetched) allows everything; a
+    401 or 403 forbids everything, as urllib.robotparser does.
+    """
+
+    def __init__(self, client=None, user_agent: str = ROBOTS_USER_AGENT):
+        self.user_agent = user_agent
+        self._client = client
+        self._own_client = client is None
+        self._parsers = {}  # scheme://host -> RobotFileParser
+        self._locks = {}
+
+    async def _parser(self, url: str) -> urllib.robotparser.RobotFileParser:
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc.lower()}"
+        if origin in self._parsers:
+            return self._parsers[origin]
+        lock = self._locks.setdefault(origin, asyncio.Lock())
+        async with lock:
+            if origin not in self._parsers:
+                if self._client is None:
+                    self._client = create_http_client(4)
+                parser = urllib.robotparser.RobotFileParser(origin + "/robots.txt")
+                try:
+                    response = await self._client.get(origin + "/robots.txt")
+                    if response.status_code in (401, 403):
+                        parser.disallow_all = True
+                    elif response.status_code < 400:
+                        parser.parse(response.text.splitlines())
+                    else:
+                        parser.allow_all = True
+                except Exception as e:
+                    logger.debug(f"Could not fetch {origin}/robots.txt: {e}")
+                    parser.allow_all = True
+                self._parsers[origin] = parser
+                self._locks.pop(origin, None)
+        return self._parsers[origin]
+
+    async def allowed(self, url: str) -> bool:
+        return (await self._parser(url)).can_fetch(self.user_agent, url)
+
+    async def crawl_delay(self, url: str) -> Optional[float]:
+        delay = (await self._parser(url)).crawl_delay(self.user_agent)
+        return float(delay) if delay is not None else None
+
+    async def close(self):
+        if self._own_client and self._client is not None:
+            await self._client.aclose()
+
+async def fetch_pages(urls: List[str], max_concurrent: int = 5, tier: str = "auto",
+                      browser_hosts: Iterable[str] = (), http_concurrency: int = 20,
+                      browser_options: Optional[BrowserOptions] = None) -> List[PageResult]:
+    """
+    Fetch URLs concurrently, over plain HTTP where possible (see PageFetcher).
+
+    Args:
+        urls: URLs to fetch
+        max_concurrent: Maximum number of concurrent browser pages
+        tier: "auto", "http" or "browser"
+        browser_hosts: Hosts always fetched with the browser
+        http_concurrency: Maximum number of concurrent HTTP requests
+        browser_options: How the browser loads pages (default: BrowserOptions())
+
+    Returns:
+        List[PageResult]: In input order, with ``html`` set and ``text`` empty
+    """
+    async with PageFetcher(min(len(urls), max_concurrent) or 1, tier, browser_hosts, http_concurrency,
+                           browser_options) as fetcher:
+        pages = await asyncio.gather(*(fetcher.fetch(url) for url in urls))
+    for index, page in enumerate(pages):
+        page.index = index
+    return pages
+
+_parse_pool = None
+_parse_pool_size = 0
+
+def _ignore_interrupts():
+    # Ctrl-C reaches the whole process group; the main process shuts the pool down itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def get_parse_pool(workers: Optional[int] = None) -> tuple:
+    """
+    Return the process-wide pool of parse workers, starting it on first use.
+
+    Returns:
+        tuple: (ProcessPoolExecutor, number of workers)
+    """
+    global _parse_pool, _parse_pool_size
+    if _parse_pool is None:
+        _parse_pool_size = workers or os.cpu_count() or 1
+        _parse_pool = ProcessPoolExecutor(max_workers=_parse_pool_size, initializer=_ignore_interrupts)
+        atexit.register(_parse_pool.shutdown, cancel_futures=True)
+    return _parse_pool, _parse_pool_size
+
+class SeenSet:
+    """
+    Set of URLs kept as 64-bit hashes of their normalized form.
+
+    New hashes go into a small Python set that is periodically merged into a
+    sorted array, so a million URLs take about 8 MB instead of the hundreds a
+    set of strings would.
+    """
+
+    def __init__(self, hashes: bytes = b"", merge_every: int = 65536):
+        self._sorted = array("Q")
+        self._sorted.frombytes(hashes)
+        self._recent = set()
+        self.merge_every = merge_every
+
+    @staticmethod
+    def _hash(url: str) -> int:
+        return int.from_bytes(hashlib.blake2b(normalize_url(url).encode("utf-8"), digest_size=8).digest(), "big")
+
+    def _in_sorted(self, key: int) -> bool:
+        position = bisect.bisect_left(self._sorted, key)
+        return position < len(self._sorted) and self._sorted[position] == key
+
+    def __contains__(self, url: str) -> bool:
+        key = self._hash(url)
+        return key in self._recent or self._in_sorted(key)
+
+    def __len__(self) -> int:
+        return len(self._sorted) + len(self._recent)
+
+    def add(self, url: str) -> bool:
+        """Add ``url``; returns False if it (or an equivalent URL) was already present."""
+        key = self._hash(url)
+        if key in self._recent or self._in_sorted(key):
+            return False
+        self._recent.add(key)
+        if len(self._recent) >= self.merge_every:
+            self._merge()
+        return True
+
+    def _merge(self):
+        self._sorted = array("Q", heapq.merge(self._sorted, sorted(self._recent)))
+        self._recent.clear()
+
+    def to_bytes(self) -> bytes:
+        self._merge()
+        return self._sorted.tobytes()
+
+class Crawler:
+    """
+    Frontier and bookkeeping for crawl mode; pass one to iter_pages.
+
+    Links found on a page are followed up to ``max_depth`` hops from the
+    seeds: only to the seeds' hosts with ``same_host``, only if they match one
+    of the ``include`` regular expressions (when any are given) and none of
+    the ``exclude`` ones, and only until ``max_pages`` pages have been
+    scheduled. With ``checkpoint`` the seen-set and the unfinished frontier
+    are saved to that file every ``checkpoint_interval`` seconds and when the
+    crawl stops, and a later crawl with the same file resumes from them.
+    """
+
+    def __init__(self, max_depth: int = 1, same_host: bool = False, include: Iterable[str] = (),
+                 exclude: Iterable[str] = (), max_pages: Optional[int] = None, checkpoint: Optional[str] = None,
+                 checkpoint_interval: float = 30.0):
+        self.max_depth = max_depth
+        self.same_host = same_host
+        self.include = [re.compile(pattern) for pattern in include]
+        self.exclude = [re.compile(pattern) for pattern in exclude]
+        self.max_pages = max_pages
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.seen = SeenSet()
+        self.hosts = set()
+        self.scheduled = 0
+        self.completed = 0
+        self._pending = {}  # URL -> depth, for pages scheduled but not finished
+        self._saved_at = time.monotonic()
+
+    def start(self, seeds: Iterable[str]) -> List[Tuple[str, int]]:
+        """Return the initial (url, depth) work: the unfinished frontier of a checkpoint, else the seeds."""
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                state = json.load(f)
+            self.seen = SeenSet(base64.b64decode(state["seen"]))
+            self.hosts = set(state["hosts"])
+            self.scheduled = state["scheduled"]
+            self.completed = state["completed"]
+            frontier = [(url, depth) for url, depth in state["frontier"]]
+            if frontier:
+                logger.info(f"Resuming crawl from {self.checkpoint}: {self.completed} pages done, "
+                            f"{len(frontier)} in the frontier")
+            else:
+                logger.info(f"The crawl in {self.checkpoint} is complete; delete the file to crawl again")
+        else:
+            frontier = []
+            for url in seeds:
+                if self.seen.add(url):
+                    self.hosts.add(host_key(url))
+                    frontier.append((url, 0))
+            self.scheduled = len(frontier)
+        self._pending = dict(frontier)
+        return frontier
+
+    def wanted(self, url: str) -> bool:
+        """Whether a discovered link passes the host and pattern filters."""
+        if self.same_host and host_key(url) not in self.hosts:
+            return False
+        if self.include and not any(pattern.search(url) for pattern in self.include):
+            return False
+        return not any(pattern.search(url) for pattern in self.exclude)
+
+    def discovered(self, page: PageResult) -> List[Tuple[str, int]]:
+        """Return the new (url, depth) work a parsed page's links lead to, and add it to the frontier."""
+        found = []
+        if page.depth < self.max_depth:
+            for url in page.links or ():
+                if self.max_pages is not None and self.scheduled >= self.max_pages:
+                    break
+                if self.wanted(url) and self.seen.add(url):
+                    found.append((url, page.depth + 1))
+                    self.scheduled += 1
+        self._pending.update(found)
+        return found
+
+    def finished(self, page: PageResult):
+        """
+        Record a page as done once it has been handed to the caller.
+
+        Pages parsed but not yet handed over stay in the frontier, so a crawl
+        stopped in between fetches them again on resume instead of losing them.
+        """
+        self._pending.pop(page.url, None)
+        self.completed += 1
+        if self.checkpoint and time.monotonic() - self._saved_at >= self.checkpoint_interval:
+            self.save()
+
+    def save(self):
+        """Write the checkpoint atomically."""
+        if not self.checkpoint:
+            return
+        state = {
+            "seen": base64.b64encode(self.seen.to_bytes()).decode("ascii"),
+            "hosts": sorted(self.hosts),
+            "scheduled": self.scheduled,
+            "completed": self.completed,
+            "frontier": list(self._pending.items()),
+        }
+        with open(self.checkpoint + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.checkpoint + ".tmp", self.checkpoint)
+        self._saved_at = time.monotonic()
+
+SHINGLE_WORDS = 4
+_WORD = re.compile(r"\w+")
+# bytes.translate tables mapping a byte to 1 if the given bit is set in it, else 0
+_BIT_TABLES = [bytes(value >> bit & 1 for value in range(256)) for bit in range(8)]
+
+def simhash(text: str) -> int:
+    """
+    64-bit SimHash of a text's overlapping word 4-grams; similar texts differ in few bits.
+
+    Each bit is the majority vote of that bit over the shingle hashes. The
+    votes are counted on the concatenated hashes with bytes.translate and
+    strided slices, so the per-shingle work stays in C.
+    """
+    words = _WORD.findall(text.lower())
+    shingles = [" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))]
+    digests = b"".join(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest() for shingle in shingles)
+    fingerprint = 0
+    for bit, table in enumerate(_BIT_TABLES):
+        votes = digests.translate(table)
+        for position in range(8):
+            if 2 * votes[position::8].count(1) > len(shingles):
+                fingerprint |= 1 << (8 * position + bit)
+    return fingerprint
+
+class Deduplicator:
+    """
+    Suppresses near-duplicate pages and repeated paragraphs across one run.
+
+    A page whose SimHash is within ``threshold`` similarity (the share of its
+    64 bits that agree) of an earlier page's is collapsed: its text is
+    dropped and ``duplicate_of`` names the earlier page. Other pages lose the
+    lines of at least ``min_chars`` characters that an earlier page already
+    had, such as footers, disclaimers and syndicated paragraphs, so each
+    one is output once. Candidates are found with the pigeonhole trick:
+    fingerprints within k differing bits agree exactly on at least one of
+    k + 1 bands, so only pages sharing a band are compared.
+    """
+
+    def __init__(self, threshold: float = 0.9, min_chars: int = 30):
+        if not 0.75 <= threshold <= 1:
+            raise ValueError(f"Near-duplicate threshold must be between 0.75 and 1, got {threshold}")
+        self.threshold = threshold
+        self.min_chars = min_chars
+        self.max_distance = int((1 - threshold) * 64 + 1e-9)
+        bands = self.max_distance + 1
+        edges = [64 * band // bands for band in range(bands + 1)]
+        self._bands = [(start, (1 << (end - start)) - 1) for start, end in zip(edges, edges[1:])]
+        self._index = [{} for _ in self._bands]  # Per band: band value -> [(fingerprint, url)]
+        self._lines = set()  # Hashes of the long lines output so far
+        self._repeated = {}  # Line hash -> [line, times suppressed]
+        self.pages = 0
+        self.duplicates = []  # (url, duplicate_of, similarity)
+        self.chars_in = 0
+        self.chars_suppressed = 0
+
+    def _find(self, fingerprint: int) -> Optional[Tuple[str, int]]:
+        best = None
+        for (shift, mask), index in zip(self._bands, self._index):
+            for other, url in index.get(fingerprint >> shift & mask, ()):
+                distance = bin(fingerprint ^ other).count("1")
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (url, distance)
+        return best
+
+    def apply(self, page: PageResult):
+        """Collapse ``page`` if it nearly duplicates an earlier one, else drop its repeated lines."""
+        if not page.text:
+            return
+        self.pages += 1
+        self.chars_in += len(page.text)
+        fingerprint = page.fingerprint if page.fingerprint is not None else simhash(page.text)
+        match = self._find(fingerprint)
+        if match is not None:
+            page.duplicate_of, distance = match
+            page.similarity = 1 - distance / 64
+            self.duplicates.append((page.url, page.duplicate_of, page.similarity))
+            self.chars_suppressed += len(page.text)
+            page.text = ""
+            return
+        for (shift, mask), index in zip(self._bands, self._index):
+            index.setdefault(fingerprint >> shift & mask, []).append((fingerprint, page.url))
+
+        kept = []
+        new = []
+        for line in page.text.split("\n"):
+            key = " ".join(line.lower().split())
+            if len(key) < self.min_chars:
+                kept.append(line)
+                continue
+            key = hash(key)
+            if key in self._lines:
+                self._repeated.setdefault(key, [line.strip(), 0])[1] += 1
+                page.repeated_lines += 1
+                self.chars_suppressed += len(line) + 1
+            else:
+                kept.append(line)
+                new.append(key)
+        self._lines.update(new)
+        if page.repeated_lines:
+            page.text = "\n".join(kept)
+
+    def report(self, top: int = 50) -> Dict:
+        """What was suppressed: near-duplicate pages and the most repeated lines."""
+        repeated = sorted(self._repeated.values(), key=lambda item: -item[1])[:top]
+        return {
+            "pages": self.pages,
+            "threshold": self.threshold,
+            "chars_in": self.chars_in,
+            "chars_suppressed": self.chars_suppressed,
+            "near_duplicates": [{"url": url, "duplicate_of": original, "similarity": round(similarity, 3)}
+                                for url, original, similarity in self.duplicates],
+            "repeated_lines": [{"text": line[:200], "suppressed": count} for line, count in repeated],
+        }
+
+    def summary(self) -> str:
+        share = self.chars_suppressed / self.chars_in if self.chars_in else 0.0
+        return (f"Suppressed {len(self.duplicates)} near-duplicate pages and "
+                f"{sum(count for _, count in self._repeated.values())} repeated lines "
+                f"({share:.0%} of {self.pages} pages' text)")
+
+async def _cancel_all(tasks: List[asyncio.Future]):
+    """Cancel tasks and wait until every one has finished."""
+    while True:
+        for task in tasks:
+            task.cancel()
+        # asyncio.wait_for (before Python 3.12) can swallow a cancellation that races with its result,
+        # leaving the task running, so cancel again until none is left
+        _, pending = await asyncio.wait(tasks, timeout=0.1)
+        if not pending:
+            break
+    for task in tasks:
+        if not task.cancelled():
+            task.exception()  # Mark it retrieved
+
+async def iter_pages(urls: Iterable[str], max_concurrent: int = 5, tier: str = "auto",
+                     browser_hosts: Iterable[str] = (), http_concurrency: int = 20,
+                     max_pending: Optional[int] = None, keep_html: bool = False,
+                     parser: Optional[str] = None,
+                     browser_options: Optional[BrowserOptions] = None, cache: Optional[PageCache] = None,
+                     max_age: float = 0.0, offline: bool = False, refresh: bool = False,
+                     per_host: int = 4, host_delay: float = 0.0, timeout: Optional[float] = None,
+                     robots: bool = False, crawler: Optional[Crawler] = None,
+                     links: bool = False, main_content: int = 0,
+                     deduplicator: Optional[Deduplicator] = None,
+                     max_page_size: Optional[int] = DEFAULT_MAX_PAGE_SIZE) -> AsyncIterator[PageResult]:
+    """
+    Fetch and parse URLs as a pipeline, yielding each PageResult as soon as it is parsed.
+
+    A fixed set of fetch workers takes URLs from a FetchScheduler, so at most
+    ``max(http_concurrency, max_concurrent)`` fetches run at once and no host
+    gets more than ``per_host`` of them. Every fetched page goes straight to
+    the long-lived parse worker pool. At most ``max_pending`` fetched pages
+    wait for a parser; when parsing (or the consumer of this iterator) falls
+    behind, fetching pauses instead of holding every page in memory.
+
+    Args:
+        urls, max_concurrent, tier, browser_hosts, http_concurrency, browser_options: As for fetch_pages
+        max_pending: Fetched pages allowed to wait for a parser (default: twice the parse workers)
+        keep_html: Keep the raw HTML on each result (dropped by default to save memory)
+        parser: HTML parser for extraction, as for parse_html
+        cache: Page cache to read and fill (default: none)
+        max_age, offline, refresh: Cache freshness, as for fetch_cached
+        per_host: Maximum concurrent fetches per host
+        host_delay: Minimum seconds between the starts of two fetches from one host
+        timeout: Seconds allowed per URL, including any browser escalation (default: no limit)
+        robots: Skip URLs that robots.txt disallows and honour its crawl delay
+        crawler: Crawl from ``urls`` as seeds, following links as the Crawler allows.
+                 Pages are scheduled breadth-first and each result has ``links`` and ``depth`` set.
+        links: Set ``links`` on each result without crawling
+        main_content: Keep only each page's main content, as for parse_html, and set ``reduction``
+        deduplicator: Collapse near-duplicate pages and drop repeated lines before yielding them
+                      (fingerprints are computed in the parse workers). Pages are then yielded
+                      in ``index`` order, so the same input keeps the same page of each
+                      duplicate group however the fetches finish
+        max_page_size: Bytes after which a page is cut off (see fetch_page_http and fetch_page); None for no limit
+
+    Yields:
+        PageResult: In completion order (``index`` order with a ``deduplicator``);
+        ``index`` is the URL's position in ``urls`` (in crawl mode, the order in
+        which pages were discovered)
+    """
+    work = crawler.start(urls) if crawler is not None else [(url, 0) for url in urls]
+    if not work:
+        return
+    loop = asyncio.get_running_loop()
+    pool, parse_workers = get_parse_pool()
+    fetched = asyncio.Queue(maxsize=max_pending or 2 * parse_workers)
+    parsed = asyncio.Queue(maxsize=parse_workers)
+    scheduler = FetchScheduler(per_host, host_delay, probe_hosts=robots and not offline)
+    for index, (url, depth) in enumerate(work):
+        await scheduler.add((index, url, depth), url, depth)
+    next_index = len(work)
+    outstanding = len(work)  # Pages scheduled but not yet parsed; a crawl is over when none are left
+    if crawler is None:
+        await scheduler.close()
+    # A crawl's size is unknown up front, so it gets the full worker and browser context counts
+    width = len(work) if crawler is None else float("inf")
+    fetch_workers = int(min(width, max(http_concurrency if tier != "browser" else 0, max_concurrent)))
+    parse = functools.partial(parse_page, parser=parser, main_content=main_content)
+    links = links or crawler is not None
+    # Cached text is reused only if it was extracted the same way
+    extraction = f"{parser or DEFAULT_PARSER}:main{main_content}" if main_content else parser
+
+    async def fetch_one(fetcher: PageFetcher, url: str, host: str) -> PageResult:
+        if robots_cache is not None:
+            if not await robots_cache.allowed(url):
+                return PageResult(url, error="Disallowed by robots.txt")
+            await scheduler.host_ready(host, await robots_cache.crawl_delay(url))
+        if cache is not None:
+            return await fetch_cached(fetcher, cache, url, extraction, max_age, offline, refresh)
+        return await fetcher.fetch(url)
+
+    async def fetch_worker(fetcher: PageFetcher):
+        while True:
+            job = await scheduler.next()
+            if job is None:
+                return
+            (index, url, depth), host = job
+            started = time.monotonic()
+            try:
+                page = await asyncio.wait_for(fetch_one(fetcher, url, host), timeout)
+            except asyncio.TimeoutError:
+                page = PageResult(url, error=f"Timed out after {timeout:g}s", elapsed=time.monotonic() - started)
+            except Exception as e:
+                # A failing cache or fetcher costs this page only; a dead worker would lose its index and stall the run
+                page = PageResult(url, error=f"{type(e).__name__}: {e}", elapsed=time.monotonic() - started)
+            finally:
+                await scheduler.done(host)
+            page.index = index
+            page.depth = depth
+            await fetched.put(page)
+
+    async def parse_worker():
+        nonlocal next_index, outstanding
+        while True:
+            page = await fetched.get()
+            if page is None:
+                return
+            try:
+                # Cached text from the same parser needs no parsing, unless the page's links or reduction are wanted
+                if links or main_content or not (page.cache and page.text):
+                    started = time.monotonic()
+                    base_url = (page.final_url or page.url) if links and page.ok else None
+                    page.text, found, page.reduction = await loop.run_in_executor(pool, parse, page.html, base_url)
+                    page.timings = {**(page.timings or {}), "parse": time.monotonic() - started}
+                    # A truncated copy must not stand in for the page in runs with a larger limit
+                    if cache is not None and page.cache is None and page.ok and page.html and not page.truncated:
+                        try:
+                            await asyncio.to_thread(cache.put, page, extraction)
+                        except Exception as e:
+                            logger.warning(f"Could not cache {page.url}: {e}")
+                    if links:
+                        page.links = found
+                    if crawler is not None:
+                        for url, depth in crawler.discovered(page):
+                            await scheduler.add((next_index, url, depth), url, depth)
+                            next_index += 1
+                            outstanding += 1
+                if deduplicator is not None and page.text:
+                    page.fingerprint = await loop.run_in_executor(pool, simhash, page.text)
+            except Exception as e:
+                # Every page must reach the consumer, or the run would wait for it forever
+                page.error = page.error or f"{type(e).__name__}: {e}"
+            if not keep_html:
+                page.html = None
+            outstanding -= 1
+            if outstanding == 0 and crawler is not None:
+                await scheduler.close()
+            await parsed.put(page)
+
+    async with PageFetcher(int(min(width, max_concurrent)), tier, browser_hosts, http_concurrency,
+                           browser_options, max_page_size) as fetcher:
+        robots_cache = RobotsCache(fetcher.client) if robots and not offline else None
+        parsers = [asyncio.ensure_future(parse_worker()) for _ in range(parse_workers)]
+        fetchers = [asyncio.ensure_future(fetch_worker(fetcher)) for _ in range(fetch_workers)]
+
+        async def finish():
+            await asyncio.gather(*fetchers)
+            for _ in parsers:
+                await fetched.put(None)
+            await asyncio.gather(*parsers)
+            await parsed.put(None)
+
+        finisher = asyncio.ensure_future(finish())
+        held = {}  # index -> page parsed ahead of an earlier one, with a deduplicator
+        next_index_out = 0
         try:
-            # Create browser contexts
-            n_contexts = min(len(urls), max_concurrent)
-            contexts = [await browser.new_context() for _ in range(n_contexts)]
-            
-            # Create tasks for each URL
-            tasks = []
-            for i, url in enumerate(urls):
-                context = contexts[i % len(contexts)]
-                task = fetch_page(url, context)
-                tasks.append(task)
-            
-            # Gather results
-            html_contents = await asyncio.gather(*tasks)
-            
-            # Parse HTML contents in parallel
-            with Pool() as pool:
-                results = pool.map(parse_html, html_contents)
-                
-            return results
-            
+            while True:
+                page = await parsed.get()
+                if page is None:
+                    break
+                if deduplicator is None:
+                    ready = [page]
+                else:
+                    # The first page of a duplicate group is kept, so pages are compared in index order
+                    held[page.index] = page
+                    ready = []
+                    while next_index_out in held:
+                        ready.append(held.pop(next_index_out))
+                        next_index_out += 1
+                for page in ready:
+                    if deduplicator is not None:
+                        deduplicator.apply(page)
+                    if crawler is not None:
+                        crawler.finished(page)
+                    yield page
+            await finisher  # Surface any error from the workers
         finally:
-            # Cleanup
-            for context in contexts:
-                await context.close()
-            await browser.close()
+            await _cancel_all(fetchers + parsers + [finisher])
+            if robots_cache is not None:
+                await robots_cache.close()
+            if crawler is not None:
+                crawler.save()
+
+async def process_pages(urls: List[str], max_concurrent: int = 5, tier: str = "auto",
+                        browser_hosts: Iterable[str] = ()) -> List[PageResult]:
+    """Fetch and parse URLs concurrently; like process_urls, but returns PageResult objects."""
+    pages = [page async for page in iter_pages(urls, max_concurrent, tier, browser_hosts)]
+    return sorted(pages, key=lambda page: page.index)
+
+async def process_urls(urls: List[str], max_concurrent: int = 5, tier: str = "auto",
+                       browser_hosts: Iterable[str] = ()) -> List[str]:
+    """Process multiple URLs concurrently."""
+    return [page.text for page in await process_pages(urls, max_concurrent, tier, browser_hosts)]
 
 def validate_url(url: str) -> bool:
     """Validate if the given string is a valid URL."""
@@ -162,18 +2414,282 @@ def validate_url(url: str) -> bool:
     except:
         return False
 
+def format_timings(timings: Dict[str, float]) -> str:
+    """Render a PageResult's timings as e.g. "http 0.12s, navigate 0.80s, ..., 14 requests blocked"."""
+    parts = [f"{phase} {seconds:.2f}s" for phase, seconds in timings.items() if phase != "blocked"]
+    if timings.get("blocked"):
+        parts.append(f"{timings['blocked']} requests blocked")
+    return ", ".join(parts)
+
+def page_record(page: PageResult) -> Dict:
+    """The JSON-serializable record written for a page by ``--format jsonl``."""
+    return {
+        "url": page.url,
+        "final_url": page.final_url or page.url,
+        "index": page.index,
+        "depth": page.depth,
+        "status": page.status,
+        "tier": page.tier,
+        "cache": page.cache,
+        "escalation": page.escalation,
+        "error": page.error,
+        "elapsed": round(page.elapsed, 4),
+        "timings": {phase: round(value, 4) if isinstance(value, float) else value
+                    for phase, value in (page.timings or {}).items()},
+        "html_bytes": page.size,
+        "truncated": page.truncated,
+        "text_bytes": len(page.text.encode("utf-8")),
+        "reduction": None if page.reduction is None else round(page.reduction, 4),
+        "duplicate_of": page.duplicate_of,
+        "similarity": None if page.similarity is None else round(page.similarity, 3),
+        "repeated_lines": page.repeated_lines,
+        "text": page.text,
+        "links": page.links or [],
+    }
+
+class JsonlWriter:
+    """
+    Writes page records as JSON lines, to stdout or to gzip-compressed shards.
+
+    Shards in ``output_dir`` are named pages-00000.jsonl.gz, pages-00001... and
+    hold up to ``shard_size`` records each. A shard is written under a
+    ``.part`` name and renamed once complete, so consumers can pick up every
+    ``*.jsonl.gz`` file while the run is still going. Numbering continues
+    after any shards already in the directory, e.g. from a resumed crawl.
+    """
+
+    def __init__(self, output_dir: Optional[str] = None, shard_size: int = 10000):
+        if shard_size < 1:
+            raise ValueError("shard_size must be at least 1")
+        self.output_dir = Path(output_dir) if output_dir else None
+        self.shard_size = shard_size
+        self._file = None
+        self._path = None
+        self._count = 0
+        self._shard = 0
+        if self.output_dir is not None:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            existing = [int(match.group(1)) for path in self.output_dir.iterdir()
+                        if (match := re.fullmatch(r"pages-(\d+)\.jsonl\.gz", path.name))]
+            self._shard = max(existing, default=-1) + 1
+
+    def write(self, page: PageResult):
+        line = json.dumps(page_record(page), ensure_ascii=False)
+        if self.output_dir is None:
+            print(line, flush=True)
+            return
+        if self._file is None:
+            self._path = self.output_dir / f"pages-{self._shard:05d}.jsonl.gz"
+            self._file = gzip.open(f"{self._path}.part", "wt", encoding="utf-8")
+        self._file.write(line + "\n")
+        self._count += 1
+        if self._count >= self.shard_size:
+            self._finish_shard()
+
+    def _finish_shard(self):
+        self._file.close()
+        os.replace(f"{self._path}.part", self._path)
+        logger.info(f"Wrote {self._count} pages to {self._path}")
+        self._file = None
+        self._count = 0
+        self._shard += 1
+
+    def close(self):
+        """Complete the current shard."""
+        if self._file is not None:
+            self._finish_shard()
+
+async def _print_pages(urls: List[str], args) -> List[str]:
+    """Print or write each page as soon as it has been parsed; returns the tier that served each page."""
+    tiers = []
+    writer = JsonlWriter(args.output_dir, args.shard_size) if args.format == "jsonl" else None
+    deduplicator = Deduplicator(args.dedupe_threshold) if args.dedupe else None
+    cache = None if args.no_cache else PageCache(args.cache_dir)
+    crawler = None
+    if args.crawl_depth > 0:
+        crawler = Crawler(args.crawl_depth, args.same_host, args.include, args.exclude, args.max_pages,
+                          args.checkpoint)
+    try:
+        async for page in iter_pages(urls, args.max_concurrent, args.tier, args.browser_host,
+                                     parser=args.parser, browser_options=args.browser_options, cache=cache,
+                                     max_age=args.max_age, offline=args.offline, refresh=args.refresh,
+                                     per_host=args.per_host, host_delay=args.host_delay, timeout=args.timeout,
+                                     robots=args.robots or crawler is not None, crawler=crawler,
+                                     links=writer is not None,
+                                     main_content=args.main_content_level if args.main_content else 0,
+                                     deduplicator=deduplicator,
+                                     max_page_size=int(args.max_page_size * 1024 * 1024) or None):
+            if writer is not None:
+                writer.write(page)
+            else:
+                print(f"\n=== Content from {page.url} ===")
+                print(page.text if page.duplicate_of is None else
+                      f"(near-duplicate of {page.duplicate_of}, {page.similarity:.0%} similar; omitted)")
+                print("=" * 80, flush=True)
+            detail = f", escalated: {page.escalation}" if page.escalation else ""
+            detail += f", error: {page.error}" if page.error else ""
+            detail += f", truncated to {page.size} bytes" if page.truncated else ""
+            detail += f", main content {1 - page.reduction:.0%} of the text" if page.reduction is not None else ""
+            detail += f", near-duplicate of {page.duplicate_of}" if page.duplicate_of else ""
+            detail += f", {page.repeated_lines} repeated lines dropped" if page.repeated_lines else ""
+            detail += f" ({format_timings(page.timings)})" if page.timings else ""
+            served = f"the cache ({page.cache}, fetched by {page.tier})" if page.cache else page.tier
+            logger.info(f"{page.url}: served by {served} in {page.elapsed:.2f}s{detail}" if served
+                        else f"{page.url}: not fetched{detail}")
+            tiers.append("cache" if page.cache else page.tier)
+    finally:
+        if writer is not None:
+            writer.close()
+        if deduplicator is not None:
+            logger.info(deduplicator.summary())
+            if args.dedupe_report:
+                Path(args.dedupe_report).write_text(json.dumps(deduplicator.report(), indent=2) + "\n")
+    return tiers
+
 def main():
     parser = argparse.ArgumentParser(description='Fetch and extract text content from webpages.')
-    parser.add_argument('urls', nargs='+', help='URLs to process')
+    parser.add_argument('urls', nargs='*', help='URLs to process')
     parser.add_argument('--max-concurrent', type=int, default=5,
                        help='Maximum number of concurrent browser instances (default: 5)')
+    parser.add_argument('--tier', choices=['auto', 'http', 'browser'], default='auto',
+                       help='Fetch over plain HTTP and escalate JS-rendered pages to the browser (auto, default), '
+                            'or use only one fetcher')
+    parser.add_argument('--browser-host', action='append', default=[], metavar='HOST',
+                       help='Always fetch this host (and its subdomains) with the browser; repeatable')
+    parser.add_argument('--ready', default='networkidle', metavar='STRATEGY',
+                       help='When a browser page counts as loaded: networkidle (default), load, domcontentloaded, '
+                            'selector:CSS (element present) or quiet:MS (no DOM changes for MS milliseconds)')
+    parser.add_argument('--browser-timeout', type=float, default=30.0, metavar='SECONDS',
+                       help='Browser navigation and readiness timeout (default: 30)')
+    parser.add_argument('--block-resources', default=','.join(DEFAULT_BLOCKED_RESOURCES), metavar='TYPES',
+                       help='Comma-separated Playwright resource types the browser does not load, or "none" '
+                            f'(default: {",".join(DEFAULT_BLOCKED_RESOURCES)})')
+    parser.add_argument('--block-domain', action='append', default=[], metavar='HOST',
+                       help='Also block requests to this host (and its subdomains) in the browser; repeatable')
+    parser.add_argument('--allow-trackers', action='store_true',
+                       help='Do not block the built-in list of ad and analytics domains')
+    parser.add_argument('--cdp-url', metavar='URL',
+                       help='Browser service to connect to (default: $WEB_SCRAPER_CDP_URL or the running '
+                            '--serve-browser service); pass "" to always launch Chromium')
+    parser.add_argument('--recycle-after', type=int, default=50, metavar='PAGES',
+                       help='Replace a browser context after it has served this many pages (default: 50)')
+    parser.add_argument('--serve-browser', action='store_true',
+                       help='Run a long-lived headless Chromium that later runs connect to instead of launching their own')
+    parser.add_argument('--port', type=int, default=0,
+                       help='CDP port for --serve-browser (default: a random free port on each launch)')
+    parser.add_argument('--max-browser-memory', type=int, default=2048, metavar='MB',
+                       help='Restart the --serve-browser Chromium when idle and above this memory use (default: 2048)')
+    parser.add_argument('--per-host', type=int, default=4, metavar='N',
+                       help='Maximum concurrent requests to one host (default: 4)')
+    parser.add_argument('--host-delay', type=float, default=0.0, metavar='SECONDS',
+                       help='Minimum time between two requests to the same host (default: 0)')
+    parser.add_argument('--timeout', type=float, default=60.0, metavar='SECONDS',
+                       help='Give up on a URL after this long, browser escalation included (default: 60)')
+    parser.add_argument('--robots', action='store_true',
+                       help='Skip URLs disallowed by robots.txt and honour its Crawl-delay')
+    parser.add_argument('--crawl-depth', type=int, default=0, metavar='N',
+                       help='Also fetch pages linked from the given URLs, up to N links away (default: 0, no crawl). '
+                            'Crawls always honour robots.txt')
+    parser.add_argument('--same-host', action='store_true',
+                       help='Only follow links to the hosts of the given URLs')
+    parser.add_argument('--include', action='append', default=[], metavar='REGEX',
+                       help='Only follow links matching this regular expression; repeatable')
+    parser.add_argument('--exclude', action='append', default=[], metavar='REGEX',
+                       help='Never follow links matching this regular expression; repeatable')
+    parser.add_argument('--max-pages', type=int, metavar='N',
+                       help='Stop scheduling new pages once a crawl has this many')
+    parser.add_argument('--checkpoint', metavar='FILE',
+                       help='Save crawl progress to FILE periodically and on exit, and resume from it if it exists')
+    parser.add_argument('--max-age', type=float, default=0, metavar='SECONDS',
+                       help='Use cached pages younger than this without contacting the server; older ones are '
+                            'revalidated with ETag/Last-Modified (default: 0, always revalidate)')
+    parser.add_argument('--offline', action='store_true',
+                       help='Serve only cached pages, however old, without any network access')
+    parser.add_argument('--refresh', action='store_true',
+                       help='Ignore cached pages and fetch everything again (the cache is still updated)')
+    parser.add_argument('--no-cache', action='store_true',
+                       help='Neither read nor write the page cache. Without it every fetched page is cached in '
+                            '--cache-dir (up to 512 MB; entries not revalidated for 30 days expire)')
+    parser.add_argument('--cache-dir', type=str,
+                       help='Page cache directory, used unless --no-cache is given '
+                            '(default: $WEB_SCRAPER_CACHE_DIR or ~/.cache/web_scraper)')
+    parser.add_argument('--parser', choices=PARSERS,
+                       help=f'HTML parser used for text extraction (default: {DEFAULT_PARSER}, or lxml read '
+                            f'incrementally for pages over {INCREMENTAL_PARSE_SIZE // (1024 * 1024)} MB when '
+                            'installed; an explicit parser is used for every page)')
+    parser.add_argument('--max-page-size', type=float, default=DEFAULT_MAX_PAGE_SIZE / (1024 * 1024), metavar='MB',
+                       help='Cut pages off after this many megabytes, and do not render pages declaring more in the '
+                            f'browser; 0 for no limit (default: {DEFAULT_MAX_PAGE_SIZE // (1024 * 1024)})')
+    parser.add_argument('--main-content', action='store_true',
+                       help='Keep only the article body, dropping navigation, headers, footers, sidebars, banners and '
+                            'link lists; each page logs the share of its text kept')
+    parser.add_argument('--main-content-level', type=int, default=2, choices=sorted(MAIN_CONTENT_LEVELS),
+                       help='How aggressively --main-content drops text, from 1 (only clear boilerplate) to 3 '
+                            '(default: 2)')
+    parser.add_argument('--dedupe', action='store_true',
+                       help='Omit pages that nearly duplicate a page earlier in the input (mirrors, paginated or '
+                            'syndicated copies) and drop lines earlier pages already had (footers, disclaimers); '
+                            'pages are then output in input order')
+    parser.add_argument('--dedupe-threshold', type=float, default=0.9, metavar='SIMILARITY',
+                       help='Fingerprint similarity, 0.75 to 1, from which --dedupe treats pages as near-duplicates '
+                            '(default: 0.9)')
+    parser.add_argument('--dedupe-report', metavar='FILE',
+                       help='Write what --dedupe suppressed to FILE as JSON (implies --dedupe)')
+    parser.add_argument('--format', choices=['text', 'jsonl'], default='text',
+                       help='Print each page as a text banner (default) or as one JSON record per line with its '
+                            'status, tier, timings, byte counts, text and links')
+    parser.add_argument('--output-dir', metavar='DIR',
+                       help='Write JSONL records to gzip-compressed shards in DIR instead of stdout '
+                            '(implies --format jsonl)')
+    parser.add_argument('--shard-size', type=int, default=10000, metavar='PAGES',
+                       help='Records per --output-dir shard (default: 10000)')
     parser.add_argument('--debug', action='store_true',
                        help='Enable debug logging')
     
     args = parser.parse_args()
+    try:
+        args.browser_options = BrowserOptions(
+            block_resources=[] if args.block_resources == "none" else
+                            [kind.strip() for kind in args.block_resources.split(",") if kind.strip()],
+            block_domains=([] if args.allow_trackers else list(DEFAULT_BLOCKED_DOMAINS)) + args.block_domain,
+            ready=args.ready,
+            timeout=args.browser_timeout,
+            cdp_url=args.cdp_url,
+            recycle_after=args.recycle_after,
+        )
+    except ValueError as e:
+        parser.error(str(e))
     
     if args.debug:
         logger.setLevel(logging.DEBUG)
+
+    if args.serve_browser:
+        try:
+            BrowserService(args.port, args.max_browser_memory).serve()
+        except Exception as e:
+            logger.error(f"Browser service failed: {e}")
+            sys.exit(1)
+        return
+    if not args.urls:
+        parser.error("the following arguments are required: urls")
+    for pattern in args.include + args.exclude:
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            parser.error(f"Invalid pattern {pattern!r}: {e}")
+    if args.per_host < 1:
+        parser.error("--per-host must be at least 1")
+    if args.max_page_size < 0:
+        parser.error("--max-page-size cannot be negative")
+    if args.shard_size < 1:
+        parser.error("--shard-size must be at least 1")
+    if args.output_dir:
+        args.format = "jsonl"
+    if not 0.75 <= args.dedupe_threshold <= 1:
+        parser.error("--dedupe-threshold must be between 0.75 and 1")
+    args.dedupe = args.dedupe or bool(args.dedupe_report)
+    if args.offline and (args.refresh or args.no_cache):
+        parser.error("--offline cannot be combined with --refresh or --no-cache")
     
     # Validate URLs
     valid_urls = []
@@ -189,16 +2705,14 @@ def main():
     
     start_time = time.time()
     try:
-        results = asyncio.run(process_urls(valid_urls, args.max_concurrent))
-        
-        # Print results to stdout
-        for url, text in zip(valid_urls, results):
-            print(f"\n=== Content from {url} ===")
-            print(text)
-            print("=" * 80)
-        
-        logger.info(f"Total processing time: {time.time() - start_time:.2f}s")
+        tiers = asyncio.run(_print_pages(valid_urls, args))
+        logger.info(f"Total processing time: {time.time() - start_time:.2f}s "
+                    f"({tiers.count('http')} via HTTP, {tiers.count('browser')} via browser, "
+                    f"{tiers.count('cache')} from cache)")
         
+    except KeyboardInterrupt:
+        logger.info("Interrupted")
+        sys.exit(130)
     except Exception as e:
         logger.error(f"Error during execution: {str(e)}")
         sys.exit(1)